@@ -45,16 +45,6 @@ def move_figure(f, x, y):
         f.canvas.manager.window.move(x, y)
     plt.show()
 
-def get_trial_types(name, directory='~/dev/ArduFSM/stim_sets'):
-    """Loads and returns the trial types file"""
-    
-    filename = os.path.join(os.path.expanduser(directory), name)
-    try:
-        trial_types = pandas.read_csv(filename)
-    except IOError:
-        raise ValueError("cannot find trial type file %s" % name)
-    return trial_types
-
 # Load the parameters file
 with file('parameters.json') as fi:
     runner_params = json.load(fi)
@@ -117,7 +107,7 @@ params_table['current-value'] = params_table['init_val'].copy()
 
 ## Load the specified trial types
 trial_types_name = runner_params['stimulus_set'] + '_r'
-trial_types = get_trial_types(trial_types_name)
+trial_types = mainloop.get_trial_types(trial_types_name)
 
 
 ## User interaction
@@ -0,0 +1,208 @@
+"""Cached lookup of specific parameters, for many sessions at once.
+
+Looking up each session in the Database takes three queries (box, board,
+and mouse). A ParameterCache instead loads every box, board, and mouse
+at once (see Database.get_all_parameters) and answers all lookups from
+memory. It can be passed as the `getter` to the functions in base.
+
+The cache is reloaded when it is older than `max_age`, and immediately
+when a box, board, or mouse is saved or deleted in this process. A name
+that is not in the cache (eg, a mouse added since it was loaded) is
+looked up on its own.
+
+Every successful load is written to a snapshot file. If the database
+cannot be read, or takes longer than `timeout`, the snapshot is used
+instead, so sessions can start without the database. Note that tuples
+in the parameters become lists in the snapshot.
+
+Usage:
+    cache = ParamLookups.Cache.ParameterCache()
+    specific_parameters_l = cache.resolve_sessions(session_list)
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+import os
+import copy
+import json
+import time
+import threading
+from . import base
+
+# Where the last parameters loaded from the database are kept
+SNAPSHOT_FILENAME = '~/sandbox_root/.parameter_snapshot.json'
+
+PARAMETER_KINDS = ('box', 'board', 'mouse')
+
+
+def read_snapshot(snapshot_filename=SNAPSHOT_FILENAME):
+    """Returns the parameters saved by write_snapshot"""
+    try:
+        with open(os.path.expanduser(snapshot_filename)) as fi:
+            return json.load(fi)
+    except (IOError, ValueError) as e:
+        raise IOError("cannot read parameter snapshot %s: %s" % (
+            snapshot_filename, e))
+
+def write_snapshot(parameters, snapshot_filename=SNAPSHOT_FILENAME):
+    """Save `parameters` for use when the database is unavailable.
+
+    The snapshot is written to a temporary file and renamed, so it is
+    always complete.
+    """
+    snapshot_filename = os.path.expanduser(snapshot_filename)
+    snapshot_dir = os.path.dirname(snapshot_filename)
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    temp_filename = '%s.%d.tmp' % (snapshot_filename, os.getpid())
+    with open(temp_filename, 'w') as fi:
+        json.dump(parameters, fi, indent=1, sort_keys=True)
+    os.rename(temp_filename, snapshot_filename)
+
+
+class ParameterCache(object):
+    """Specific parameters of every box, board, and mouse, in memory.
+
+    getter : Database or Hardcoded. If None, as chosen in base.
+        A getter without get_all_parameters (eg, Hardcoded) is not
+        preloaded or snapshotted, only cached one name at a time.
+        If it has close_connections, that is called in the loading
+        thread after each load.
+    max_age : seconds after which the parameters are reloaded, or None
+        to never reload
+    timeout : seconds to wait for the database before using the snapshot
+    """
+    def __init__(self, getter=None, max_age=60., timeout=10.,
+        snapshot_filename=SNAPSHOT_FILENAME):
+        if getter is None:
+            getter = base.Getter
+        self.getter = getter
+        self.max_age = max_age
+        self.timeout = timeout
+        self.snapshot_filename = snapshot_filename
+
+        # Dict from kind ('box', 'board', 'mouse') to name to parameters
+        self.parameters = None
+        self.load_time = None
+
+        # 'database', 'snapshot', or 'getter'
+        self.source = None
+
+        self.lock = threading.RLock()
+
+        if hasattr(getter, 'connect_change_handler'):
+            getter.connect_change_handler(self.on_change)
+
+    def on_change(self, sender, **kwargs):
+        """Called when a box, board, or mouse is saved or deleted"""
+        self.invalidate()
+
+    def invalidate(self):
+        """Reload everything at the next lookup"""
+        with self.lock:
+            self.parameters = None
+
+    def get_all_parameters(self):
+        """Returns the getter's get_all_parameters, or raises IOError
+        if it fails or takes longer than `timeout`
+        """
+        # The query runs in a thread so that it can be abandoned. The
+        # thread's connection is closed when it is done, or one would be
+        # left open on every reload.
+        result = {}
+        def target():
+            try:
+                result['parameters'] = self.getter.get_all_parameters()
+            except Exception as e:
+                result['error'] = e
+            finally:
+                if hasattr(self.getter, 'close_connections'):
+                    try:
+                        self.getter.close_connections()
+                    except Exception as e:
+                        print("warning: cannot close database connection: "
+                            "%s" % e)
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+
+        if 'parameters' in result:
+            return result['parameters']
+        elif 'error' in result:
+            raise IOError("cannot load parameters: %s" % result['error'])
+        else:
+            raise IOError("loading parameters took longer than %0.1fs" %
+                self.timeout)
+
+    def load(self):
+        """Load every box, board, and mouse, from the snapshot if need be"""
+        with self.lock:
+            if not hasattr(self.getter, 'get_all_parameters'):
+                parameters = dict([(kind, {}) for kind in PARAMETER_KINDS])
+                source = 'getter'
+            else:
+                try:
+                    parameters = self.get_all_parameters()
+                    source = 'database'
+                except IOError as e:
+                    print("warning: %s; using snapshot %s" % (
+                        e, self.snapshot_filename))
+                    parameters = read_snapshot(self.snapshot_filename)
+                    source = 'snapshot'
+                else:
+                    try:
+                        write_snapshot(parameters, self.snapshot_filename)
+                    except (IOError, OSError, TypeError, ValueError) as e:
+                        print("warning: cannot write parameter snapshot: %s"
+                            % e)
+
+            self.parameters = parameters
+            self.source = source
+            self.load_time = time.time()
+
+    def get_parameters(self, kind, name):
+        """Returns the specific parameters of one box, board, or mouse.
+
+        kind : 'box', 'board', or 'mouse'
+
+        The result is a copy, so it can be modified.
+        """
+        with self.lock:
+            if (self.parameters is None or (self.max_age is not None and
+                time.time() - self.load_time > self.max_age)):
+                self.load()
+
+            try:
+                parameters = self.parameters[kind][name]
+            except KeyError:
+                # Without the database, there is nowhere else to look
+                if self.source == 'snapshot':
+                    raise ValueError("unknown %s: %s" % (kind, name))
+                parameters = getattr(self.getter,
+                    'get_%s_parameters' % kind)(name)
+                self.parameters[kind][name] = parameters
+
+            return copy.deepcopy(parameters)
+
+    def get_box_parameters(self, box_name):
+        return self.get_parameters('box', box_name)
+
+    def get_board_parameters(self, board_name):
+        return self.get_parameters('board', board_name)
+
+    def get_mouse_parameters(self, mouse_name):
+        return self.get_parameters('mouse', mouse_name)
+
+    def resolve_sessions(self, session_list):
+        """Returns the specific parameters of many sessions.
+
+        session_list : list of user_input dicts, with keys 'mouse',
+            'board', and 'box'
+
+        Returns : list of specific parameters, as from
+            base.get_specific_parameters_from_user_input
+        """
+        return [base.get_specific_parameters_from_user_input(user_input,
+            getter=self) for user_input in session_list]
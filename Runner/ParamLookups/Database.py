@@ -27,6 +27,7 @@ don't define it?
 """
 from __future__ import absolute_import
 import django
+import django.db.models.signals
 import runner.models
 from . import Hardcoded
 
@@ -89,9 +90,8 @@ def remove_None_from_dict(d):
     
     return res
 
-def get_box_parameters(box_name):
-    box = runner.models.Box.objects.get(name=box_name)
-
+def format_box_parameters(box):
+    """Returns the specific parameters of a Box row"""
     return remove_None_from_dict({
             'C': {},
             'Python': {
@@ -114,9 +114,8 @@ def get_box_parameters(box_name):
             },
         })
 
-def get_board_parameters(board_name):
-    board = runner.models.Board.objects.get(name=board_name)
-    
+def format_board_parameters(board):
+    """Returns the specific parameters of a Board row"""
     res = {
         'C': {
             'stepper_driver': board.stepper_driver,
@@ -141,10 +140,8 @@ def get_board_parameters(board_name):
 
     return remove_None_from_dict(res)
     
-def get_mouse_parameters(mouse_name):
-    """Extract and format mouse parameters from database"""
-    mouse = runner.models.Mouse.objects.get(name=mouse_name)
-
+def format_mouse_parameters(mouse):
+    """Returns the specific parameters of a Mouse row"""
     res = {
         'C': {
             'use_ir_detector': mouse.use_ir_detector,
@@ -172,4 +169,54 @@ def get_mouse_parameters(mouse_name):
     # Fix the ir_detector params
     res = fix_ir_detector_params(res)
 
-    return remove_None_from_dict(res)
\ No newline at end of file
+    return remove_None_from_dict(res)
+
+def get_box_parameters(box_name):
+    box = runner.models.Box.objects.get(name=box_name)
+    return format_box_parameters(box)
+
+def get_board_parameters(board_name):
+    board = runner.models.Board.objects.get(name=board_name)
+    return format_board_parameters(board)
+    
+def get_mouse_parameters(mouse_name):
+    """Extract and format mouse parameters from database"""
+    mouse = runner.models.Mouse.objects.get(name=mouse_name)
+    return format_mouse_parameters(mouse)
+
+def get_all_parameters():
+    """Returns the parameters of every box, board, and mouse
+    
+    Each table is read in a single query, rather than one query per
+    name as in get_box_parameters etc.
+    
+    Returns : dict with keys 'box', 'board', and 'mouse', each a dict
+        from name to specific parameters
+    """
+    return {
+        'box': dict([(box.name, format_box_parameters(box))
+            for box in runner.models.Box.objects.all()]),
+        'board': dict([(board.name, format_board_parameters(board))
+            for board in runner.models.Board.objects.all()]),
+        'mouse': dict([(mouse.name, format_mouse_parameters(mouse))
+            for mouse in runner.models.Mouse.objects.all()]),
+    }
+
+def close_connections():
+    """Close this thread's connections to the database
+    
+    Django opens a connection in each thread that queries, and does not
+    close it when the thread ends.
+    """
+    django.db.connections.close_all()
+
+def connect_change_handler(handler):
+    """Call `handler(sender, **kwargs)` whenever a box, board, or mouse
+    is saved or deleted in this process (eg, from the admin interface)
+    """
+    for model in (runner.models.Box, runner.models.Board, 
+        runner.models.Mouse):
+        django.db.models.signals.post_save.connect(
+            handler, sender=model, weak=False)
+        django.db.models.signals.post_delete.connect(
+            handler, sender=model, weak=False)
@@ -24,6 +24,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 from . import base
 from . import Hardcoded
+from . import Cache
 try:
     from . import Database
 except ImportError:
@@ -13,18 +13,25 @@ except ImportError:
     Getter = Hardcoded
 
 
-def get_specific_parameters_from_mouse_name(mouse_name):
-    """Extract default board and box and use that to start session"""
+def get_specific_parameters_from_mouse_name(mouse_name, getter=None):
+    """Extract default board and box and use that to start session
+    
+    getter : where to get parameters, as in
+        get_specific_parameters_from_user_input
+    """
+    if getter is None:
+        getter = Getter
+    
     # Get mouse parameters
-    mouse_parameters = Getter.get_mouse_parameters(mouse_name)
+    mouse_parameters = getter.get_mouse_parameters(mouse_name)
     
     # Use that to get board and box
     board = mouse_parameters['build']['default_board']
     box = mouse_parameters['build']['default_box']
 
     # Get board and box parameters
-    board_parameters = Getter.get_board_parameters(board)
-    box_parameters = Getter.get_box_parameters(box)
+    board_parameters = getter.get_board_parameters(board)
+    box_parameters = getter.get_box_parameters(box)
     
     # Boilerplate
     # Split into C, Python, and build parameters
@@ -54,7 +61,7 @@ def get_specific_parameters_from_mouse_name(mouse_name):
     
     return specific_parameters    
 
-def get_specific_parameters_from_user_input(user_input):
+def get_specific_parameters_from_user_input(user_input, getter=None):
     """Converts session parameters to specific parameters.
     
     user_input : dict with following keys
@@ -71,11 +78,18 @@ def get_specific_parameters_from_user_input(user_input):
     
     Finally a few build parameters (serial_port, box, mouse, baord) are 
     copied from build to Python because they are needed for the UI.
+    
+    getter : anything with get_box_parameters, get_board_parameters, and
+        get_mouse_parameters, such as a Cache.ParameterCache. If None,
+        Database is used if available, otherwise Hardcoded.
     """
+    if getter is None:
+        getter = Getter
+    
     # Convert session parameters into specific parameters
-    board_parameters = Getter.get_board_parameters(user_input['board'])
-    box_parameters = Getter.get_box_parameters(user_input['box'])
-    mouse_parameters = Getter.get_mouse_parameters(user_input['mouse'])    
+    board_parameters = getter.get_board_parameters(user_input['board'])
+    box_parameters = getter.get_box_parameters(user_input['box'])
+    mouse_parameters = getter.get_mouse_parameters(user_input['mouse'])    
     
     # Split into C, Python, and build parameters
     specific_parameters = {}
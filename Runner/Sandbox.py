@@ -12,10 +12,73 @@ import subprocess
 import shutil
 import json
 from . import ParamLookups
+from .. import content_store
 import datetime 
 import time
 import platform
 import shlex
+import hashlib
+import tempfile
+import threading
+import signal
+from queue import Queue, Empty
+
+## Build cache
+# Compiled sketches are cached here by the hash of everything that goes
+# into the build, so an unchanged protocol is not compiled again
+BUILD_CACHE_DIR = '~/.ardufsm_build_cache'
+
+# The sketchbook, whose libraries are included in the build
+SKETCHBOOK_PATH = '~/dev/ArduFSM'
+
+DEFAULT_BOARD_TYPE = 'arduino:avr:uno'
+
+# How to upload a compiled sketch with avrdude, by board type
+# Other board types are compiled and uploaded by the IDE without caching
+AVRDUDE_PARAMETERS = {
+    'arduino:avr:uno': {
+        'mcu': 'atmega328p', 'programmer': 'arduino', 'baud_rate': '115200'},
+}
+
+# The avrdude bundled with the IDE, and its configuration, relative to the
+# IDE's directory. This is used in preference to any avrdude on the PATH,
+# because the IDE is what uploads uncached builds.
+IDE_AVRDUDE_PATH = os.path.join('hardware', 'tools', 'avr', 'bin', 'avrdude')
+IDE_AVRDUDE_CONF_PATH = os.path.join('hardware', 'tools', 'avr', 'etc', 
+    'avrdude.conf')
+
+# The IDE's version, relative to its directory
+IDE_VERSION_PATH = os.path.join('lib', 'version.txt')
+
+# Known avrdude errors and what to tell the user if retrying fails
+AVRDUDE_ERRORS = [
+    ('ser_open(): can', "cannot open serial port"),
+    ('programmer is not responding', "not responding; unplug and replug"),
+]
+
+# Known Arduino IDE errors, which also include the avrdude errors
+ARDUINO_ERRORS = AVRDUDE_ERRORS
+
+# Lines of the IDE output that begin each phase of the build, in order.
+# Before the first of these is the 'startup' phase, loading the IDE.
+# The compile and link lines are only printed with --verbose-build.
+ARDUINO_PHASE_PATTERNS = [
+    ('compile', 'Compiling sketch'),
+    ('link', 'Linking everything together'),
+    ('upload', 'Uploading'),
+]
+
+# Seconds to wait before trying an upload again
+RETRY_DELAY = 1.
+
+# Seconds after which a hung build command is killed and tried again:
+# the IDE, which compiles (and uploads) the sketch, and avrdude, which
+# uploads or verifies a cached build
+ARDUINO_TIMEOUT = 300.
+AVRDUDE_TIMEOUT = 60.
+
+# Uploads to several boards may finish at once
+upload_record_lock = threading.Lock()
 
 def create_sandbox(user_input, sandbox_root):
     """Create a sandbox directory for Autosketch and Script
@@ -32,6 +95,8 @@ def create_sandbox(user_input, sandbox_root):
         'sandbox': Path to sandbox directory
         'sketch': Path to directory that will contain sketch
         'script': Path to directory that will contain script
+        'content_store': Path to the content store for sandbox_root
+            (see content_store.get_store_dir)
     
     All of these directories are created if they don't already exist.
     Also, a logfiles directory is created in the script directory.
@@ -69,6 +134,7 @@ def create_sandbox(user_input, sandbox_root):
         'sandbox': sandbox_path,
         'sketch': sketch_path,
         'script': script_path,
+        'content_store': content_store.get_store_dir(sandbox_root),
     }
 
 def copy_protocol_to_sandbox(sandbox_paths,
@@ -84,7 +150,14 @@ def copy_protocol_to_sandbox(sandbox_paths,
         sketch_path and call it Autosketch.ino
     *   If it ends in '.py' then we copy it to the script_path
     *   Everything else is copied to sketch_path.
+    
+    Files are linked from the content store (see content_store) rather
+    than copied, so unchanged protocol files share a single copy. The
+    store is `sandbox_paths['content_store']`, if present.
     """
+    store_dir = sandbox_paths.get('content_store', 
+        content_store.CONTENT_STORE_DIR)
+
     # Find the protocol_path
     protocol_path = os.path.join(protocol_root,
         build_parameters['protocol_name'])
@@ -99,21 +172,24 @@ def copy_protocol_to_sandbox(sandbox_paths,
         elif filename == build_parameters['protocol_name'] + '.ino':
             # This is the actual protocol *.ino
             # Rename it Autosketch.ino
-            shutil.copyfile(
+            content_store.copy_file(
                 os.path.join(protocol_path, filename),
-                os.path.join(sandbox_paths['sketch'], 'Autosketch.ino'))
+                os.path.join(sandbox_paths['sketch'], 'Autosketch.ino'),
+                store_dir)
                 
         elif filename.endswith('.py'):
             # Python files go to script_path
-            shutil.copyfile(
+            content_store.copy_file(
                 os.path.join(protocol_path, filename),
-                os.path.join(sandbox_paths['script'], filename))
+                os.path.join(sandbox_paths['script'], filename),
+                store_dir)
                 
         else:
             # All other files go to sketch_path
-            shutil.copyfile(
+            content_store.copy_file(
                 os.path.join(protocol_path, filename),
-                os.path.join(sandbox_paths['sketch'], filename))
+                os.path.join(sandbox_paths['sketch'], filename),
+                store_dir)
 
 def write_c_config_file(sketch_path, c_parameters, verbose=False):
     """Write the C config file to sketch_path
@@ -164,120 +240,514 @@ def write_c_config_file(sketch_path, c_parameters, verbose=False):
     if verbose:
         print("C code written to %s:" % config_filename)
         print(config_file_contents)
+    # Remove any config.h from the protocol first, because it may be
+    # linked to the content store and must not be overwritten in place
+    if os.path.lexists(config_filename):
+        os.remove(config_filename)
     with open(config_filename, 'w') as fi:
         fi.write(config_file_boilerplate_header)
         fi.write(config_file_contents)
         fi.write(config_file_boilerplate_footer)
 
-def compile_and_upload(sandbox_paths, specific_parameters, verbose=False):
-    """Compile and upload the code in the sandbox to the arduino"""
-    # Name of the Arduino sketch
-    sketch_filename = os.path.join(sandbox_paths['sketch'],
-        'Autosketch.ino')
+def hash_directory(path, hasher, skip_dirs=()):
+    """Update `hasher` with the names and contents of all files in `path`
+    
+    Files are visited in sorted order so that the hash is reproducible.
+    Hidden files and directories, and directories named in `skip_dirs`,
+    are skipped.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted([dirname for dirname in dirnames
+            if not dirname.startswith('.') and dirname not in skip_dirs])
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            full_filename = os.path.join(dirpath, filename)
+            hasher.update(os.path.relpath(full_filename, path).encode('utf-8'))
+            with open(full_filename, 'rb') as fi:
+                hasher.update(hashlib.sha256(fi.read()).digest())
 
-    # Check the serial port and sketch exist
-    if not os.path.exists(specific_parameters['build']['serial_port']):
-        raise OSError("serial port %s does not exist" % 
-            specific_parameters['build']['serial_port'])
-    if not os.path.exists(sketch_filename):
-        raise OSError("sketch filename %s does not exist" %
-            sketch_filename)
+def find_executable(name):
+    """Returns the full path to the executable `name` on the PATH, or None"""
+    try:
+        return shutil.which(name)
+    except AttributeError:
+        # Python 2
+        from distutils.spawn import find_executable as find
+        return find(name)
 
-    # Form a command string for compilation
-    cmd_string = [
-        'arduino',
-        '--board',
-        'arduino:avr:uno',
-        '--port',
-        specific_parameters['build']['serial_port'],
-        '--pref',
-        'sketchbook.path=%s' % os.path.expanduser('~/dev/ArduFSM'),
-        '--upload',
-        sketch_filename,
-    ]
+def get_ide_dir():
+    """Returns the directory the Arduino IDE is installed in, or None
+    
+    This is where the `arduino` on the PATH links to.
+    """
+    arduino_path = find_executable('arduino')
+    if arduino_path is None:
+        return None
+    return os.path.dirname(os.path.realpath(arduino_path))
+
+def get_avrdude_command():
+    """Returns the start of the command to run avrdude, or None
+    
+    This is the avrdude bundled with the IDE and its configuration, if 
+    found, or else the avrdude on the PATH. None if there is neither.
+    """
+    ide_dir = get_ide_dir()
+    if ide_dir is not None:
+        avrdude_path = os.path.join(ide_dir, IDE_AVRDUDE_PATH)
+        conf_path = os.path.join(ide_dir, IDE_AVRDUDE_CONF_PATH)
+        if os.path.exists(avrdude_path) and os.path.exists(conf_path):
+            return [avrdude_path, '-C', conf_path]
+    
+    avrdude_path = find_executable('avrdude')
+    if avrdude_path is None:
+        return None
+    return [avrdude_path]
+
+def get_toolchain_version():
+    """Returns a string identifying the installed IDE and its toolchain
     
-    # Run the compilation and collect output
-    # http://stackoverflow.com/questions/375427/non-blocking-read-on-a-subprocess-pipe-in-python
-    # Non-blocking read magic
-    import sys
-    from threading import Thread
-    from queue import Queue, Empty
-    def enqueue_output(out, queue):
+    This is the IDE's directory and its version, or the modification time
+    of the `arduino` executable if the version is not found. Empty if the
+    IDE is not found.
+    """
+    ide_dir = get_ide_dir()
+    if ide_dir is None:
+        return ''
+    version_filename = os.path.join(ide_dir, IDE_VERSION_PATH)
+    if os.path.exists(version_filename):
+        with open(version_filename) as fi:
+            version = fi.read().strip()
+    else:
+        version = '%d' % os.path.getmtime(
+            os.path.realpath(find_executable('arduino')))
+    return '%s %s' % (ide_dir, version)
+
+def get_build_hash(sketch_path, board_type, sketchbook_path=SKETCHBOOK_PATH):
+    """Returns a hash of everything that determines the compiled sketch
+    
+    This is the sketch directory (including config.h), the libraries in
+    the sketchbook, the board type, and the IDE that compiles it (see
+    get_toolchain_version).
+    """
+    hasher = hashlib.sha256()
+    hasher.update(board_type.encode('utf-8'))
+    hasher.update(get_toolchain_version().encode('utf-8'))
+    hash_directory(sketch_path, hasher)
+    hasher.update(b'libraries')
+    library_path = os.path.join(os.path.expanduser(sketchbook_path), 
+        'libraries')
+    if os.path.isdir(library_path):
+        hash_directory(library_path, hasher)
+    return hasher.hexdigest()
+
+def get_upload_record_filename(build_cache_dir=BUILD_CACHE_DIR):
+    """Returns the file recording the last build uploaded to each port"""
+    return os.path.join(os.path.expanduser(build_cache_dir), 'uploaded.json')
+
+def read_upload_record(build_cache_dir=BUILD_CACHE_DIR):
+    """Returns a dict from serial port to the hash of the last upload"""
+    try:
+        with open(get_upload_record_filename(build_cache_dir)) as fi:
+            return json.load(fi)
+    except (IOError, ValueError):
+        return {}
+
+def write_upload_record(serial_port, build_hash, 
+    build_cache_dir=BUILD_CACHE_DIR):
+    """Record that `build_hash` was uploaded to `serial_port`"""
+    with upload_record_lock:
+        upload_record = read_upload_record(build_cache_dir)
+        upload_record[serial_port] = build_hash
+        with open(get_upload_record_filename(build_cache_dir), 'w') as fi:
+            json.dump(upload_record, fi, indent=4)
+
+def add_timings(timings, phase_times):
+    """Add the durations in `phase_times` to the dict `timings`, if any"""
+    if timings is None:
+        return
+    for phase, duration in list(phase_times.items()):
+        timings[phase] = timings.get(phase, 0.) + duration
+
+def format_timings(timings):
+    """Returns the durations in `timings` as a string"""
+    return ', '.join(['%s %0.1fs' % (phase, duration)
+        for phase, duration in list(timings.items())])
+
+def run_build_command(cmd_string, phase_patterns=(), error_patterns=(),
+    first_phase='startup', timeout=None, verbose=False):
+    """Run a build command, handling its output as soon as it arrives.
+    
+    A thread reads each of stdout and stderr into a queue, and this waits
+    on the queue, so it returns as soon as the process exits. The process
+    is killed as soon as a line matches one of `error_patterns`, or after
+    `timeout` seconds. It is started in its own process group, and the
+    whole group is killed, because the IDE runs the compiler and avrdude
+    as child processes, which would otherwise keep running.
+    
+    phase_patterns : list of (phase, string). The phase begins at the 
+        first line containing the string. Phases must be in order.
+    error_patterns : list of (string, message)
+    first_phase : name of the phase from the start to the first pattern
+    
+    Returns: dict with keys
+        'returncode' : of the process
+        'stdout', 'stderr' : everything written, as strings
+        'error' : the message of the matched error pattern, or 'timed out',
+            or None
+        'phase_times' : dict from phase to its duration in seconds
+    """
+    start_time = time.time()
+    if verbose:
+        print("running: " + ' '.join(cmd_string))
+    if os.name == 'posix':
+        # Equivalent to start_new_session=True, which Python 2 lacks
+        popen_kwargs = {'preexec_fn': os.setsid}
+    else:
+        popen_kwargs = {}
+    proc = subprocess.Popen(cmd_string, 
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, **popen_kwargs)
+    
+    # Read each stream into the queue, then mark its end with None
+    q = Queue()
+    def enqueue_output(stream_name, out):
         for line in iter(out.readline, b''):
-            queue.put(line)
+            q.put((stream_name, line))
         out.close()
-    
-    # Create the subprocess
-    n_repeats = 0
-    stop_looping = False
-    while (not stop_looping and n_repeats < 2):
-        n_repeats = n_repeats + 1
-        if verbose:
-            print("compiling and uploading: " + ' '.join(cmd_string))
-        compile_proc = subprocess.Popen(cmd_string, 
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1)
-
-        # Non-blocking read magic
-        q = Queue()
-        t = Thread(target=enqueue_output, args=(compile_proc.stderr, q))
+        q.put((stream_name, None))
+    for stream_name, out in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        t = threading.Thread(target=enqueue_output, args=(stream_name, out))
         t.daemon = True
         t.start()
+    
+    # Handle lines until both streams end or an error is matched
+    output = {'stdout': '', 'stderr': ''}
+    phase_starts = [(first_phase, start_time)]
+    remaining_phases = list(phase_patterns)
+    error = None
+    n_open_streams = 2
+    while n_open_streams > 0:
+        if timeout is None:
+            wait = None
+        else:
+            wait = max(timeout - (time.time() - start_time), 0)
+        try:
+            stream_name, line = q.get(timeout=wait)
+        except Empty:
+            error = 'timed out'
+            break
         
-        # Wait till compilation is finished
-        stderr_temp = ''
-        killed = False
-        while compile_proc.poll() is None:
-            time.sleep(2)
-            print("working...")
-            
-            # Check for any new results on STDERR
-            try:
-                while True:
-                    line = q.get_nowait().decode('utf-8')
-                    stderr_temp += line
-            except Empty:
-                # no output
-                pass
-            
-            # Kill if necessary
-            if 'avrdude: stk500_recv(): programmer is not responding' in stderr_temp:
-                #~ print "not responding, hit CTRL+C to end this"
-                #~ compile_proc.terminate()
-                killed = True
-                #~ compile_proc.poll()
+        if line is None:
+            n_open_streams -= 1
+            continue
+        line = line.decode('utf-8', 'replace')
+        output[stream_name] += line
+        
+        # Check for the start of the next phase
+        for nphase, (phase, pattern) in enumerate(remaining_phases):
+            if pattern in line:
+                phase_starts.append((phase, time.time()))
+                remaining_phases = remaining_phases[nphase + 1:]
                 break
         
-        # compile process either completed or was killed
-        if killed:
-            raise IOError("avrdude process killed; unplug and replug")
+        # Check for errors
+        for error_string, error_message in error_patterns:
+            if error_string in line:
+                error = error_message
+                break
+        if error is not None:
+            break
+    
+    # Kill on error, with its children, and wait for exit
+    if error is not None and proc.poll() is None:
+        if os.name == 'posix':
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                # Exited in the meantime
+                pass
         else:
-            # Check if upload failed
-            if 'avrdude: ser_open(): can' in stderr_temp:
-                if n_repeats < 2:
-                    print("upload failed; trying again ...")
-                    time.sleep(3)
-                else:
-                    raise IOError("repeated ser_open errors, giving up")
-            else:
-                stop_looping = True
-            
-            stdout = compile_proc.stdout.read()
-            if verbose:
-                print("COMPILATION STDOUT:")
-                print(stdout)
-                print("COMPILATION STDERR:")
-                print(stderr_temp)
+            proc.kill()
+    proc.wait()
+    stop_time = time.time()
+    
+    # Duration of each phase
+    phase_times = {}
+    for nphase, (phase, phase_start) in enumerate(phase_starts):
+        if nphase + 1 < len(phase_starts):
+            phase_stop = phase_starts[nphase + 1][1]
+        else:
+            phase_stop = stop_time
+        phase_times[phase] = phase_stop - phase_start
+    
+    if verbose:
+        print("STDOUT:")
+        print(output['stdout'])
+        print("STDERR:")
+        print(output['stderr'])
+    
+    return {
+        'returncode': proc.returncode,
+        'stdout': output['stdout'],
+        'stderr': output['stderr'],
+        'error': error,
+        'phase_times': phase_times,
+        }
+
+def compile_to_cache(sketch_filename, board_type, build_hash,
+    build_cache_dir=BUILD_CACHE_DIR, verbose=False, timings=None):
+    """Compile the sketch with the IDE and store the hex file in the cache
+    
+    timings : if not None, the duration of each phase is added to it
+    
+    Returns: the name of the cached hex file
+    """
+    build_cache_dir = os.path.expanduser(build_cache_dir)
+    hex_filename = os.path.join(build_cache_dir, build_hash + '.hex')
+    
+    # Compile in a temporary build directory
+    build_path = tempfile.mkdtemp(dir=build_cache_dir)
+    try:
+        cmd_string = [
+            'arduino',
+            '--board',
+            board_type,
+            '--pref',
+            'sketchbook.path=%s' % os.path.expanduser(SKETCHBOOK_PATH),
+            '--pref',
+            'build.path=%s' % build_path,
+            '--verbose-build',
+            '--verify',
+            sketch_filename,
+        ]
+        run_arduino(cmd_string, verbose=verbose, timings=timings)
         
-            # Check for compilation errors
-            if compile_proc.returncode != 0:
-                print("error in compiling:")
-                print(stderr_temp)
-                raise IOError("compilation error")
-            else:
-                print("successfully compiled and uploaded")
+        # Move the hex into the cache, atomically
+        built_hex_filename = os.path.join(build_path, 
+            os.path.split(sketch_filename)[1] + '.hex')
+        if not os.path.exists(built_hex_filename):
+            raise IOError("compiled hex file %s not found" % 
+                built_hex_filename)
+        os.rename(built_hex_filename, hex_filename)
+    finally:
+        shutil.rmtree(build_path, ignore_errors=True)
+    
+    return hex_filename
+
+def run_avrdude(hex_filename, serial_port, board_type, operation='w',
+    verbose=False, timings=None):
+    """Write (operation 'w') or verify ('v') the flash against a hex file
+    
+    avrdude is killed as soon as it prints one of AVRDUDE_ERRORS, rather 
+    than waiting for its own retries to time out, or after AVRDUDE_TIMEOUT
+    seconds.
     
+    timings : if not None, the duration is added to its 'upload' or 
+        'verify' entry
+    
+    Returns: success, error
+        success : True if avrdude succeeded
+        error : the message of the matched AVRDUDE_ERRORS, or 'timed out',
+            or None
+    Raises IOError if avrdude is not found (see get_avrdude_command).
+    """
+    avrdude_parameters = AVRDUDE_PARAMETERS[board_type]
+    avrdude_command = get_avrdude_command()
+    if avrdude_command is None:
+        raise IOError("avrdude not found")
+    cmd_string = avrdude_command + [
+        '-p', avrdude_parameters['mcu'],
+        '-c', avrdude_parameters['programmer'],
+        '-P', serial_port,
+        '-b', avrdude_parameters['baud_rate'],
+        '-D',
+        '-U', 'flash:%s:%s:i' % (operation, hex_filename),
+    ]
+    result = run_build_command(cmd_string, error_patterns=AVRDUDE_ERRORS,
+        first_phase='verify' if operation == 'v' else 'upload', 
+        timeout=AVRDUDE_TIMEOUT, verbose=verbose)
+    add_timings(timings, result['phase_times'])
+    success = result['returncode'] == 0 and result['error'] is None
+    return success, result['error']
+
+def prepare_build(sandbox_paths, board_type, build_cache_dir=BUILD_CACHE_DIR,
+    verbose=False, timings=None):
+    """Compile the sketch in the sandbox, unless it is already cached
+    
+    timings : if not None, the duration of each phase is added to it
+    
+    Returns: build_hash, hex_filename
+    """
+    sketch_filename = os.path.join(sandbox_paths['sketch'],
+        'Autosketch.ino')
+    if not os.path.exists(os.path.expanduser(build_cache_dir)):
+        os.makedirs(os.path.expanduser(build_cache_dir))
+    hash_start = time.time()
+    build_hash = get_build_hash(sandbox_paths['sketch'], board_type)
+    add_timings(timings, {'hash': time.time() - hash_start})
+    hex_filename = os.path.join(os.path.expanduser(build_cache_dir),
+        build_hash + '.hex')
+    if os.path.exists(hex_filename):
+        print("using cached build %s" % build_hash[:12])
+    else:
+        print("compiling %s ..." % build_hash[:12])
+        hex_filename = compile_to_cache(sketch_filename, board_type, 
+            build_hash, build_cache_dir=build_cache_dir, verbose=verbose,
+            timings=timings)
+        print("successfully compiled %s" % build_hash[:12])
+    return build_hash, hex_filename
+
+def upload_build(hex_filename, build_hash, serial_port, board_type,
+    build_cache_dir=BUILD_CACHE_DIR, n_tries=2, verbose=False, 
+    timings=None):
+    """Upload a cached build to the board, unless it is already there
+    
+    If `build_hash` was the last build uploaded to this serial port, the
+    flash is only verified against it, and written only if it differs.
+    The upload is tried up to `n_tries` times, including after a timeout.
+    
+    timings : if not None, the duration of each phase is added to it
+    
+    Returns: 'uploaded', or 'unchanged' if it was already on the board
+    Raises IOError if every try fails, describing the avrdude error.
+    """
+    if read_upload_record(build_cache_dir).get(serial_port) == build_hash:
+        success, error = run_avrdude(hex_filename, serial_port, board_type, 
+            operation='v', verbose=verbose, timings=timings)
+        if success:
+            return 'unchanged'
+
+    for n_try in range(n_tries):
+        success, error = run_avrdude(hex_filename, serial_port, board_type, 
+            operation='w', verbose=verbose, timings=timings)
+        if success:
+            write_upload_record(serial_port, build_hash, build_cache_dir)
+            return 'uploaded'
+        if n_try < n_tries - 1:
+            print("upload to %s failed; trying again ..." % serial_port)
+            time.sleep(RETRY_DELAY)
+    
+    # Describe the error
+    message = error if error is not None else "upload error"
+    raise IOError("%s: %s after %d tries" % (serial_port, message, n_tries))
+
+def compile_and_upload(sandbox_paths, specific_parameters, verbose=False,
+    use_build_cache=True, build_cache_dir=BUILD_CACHE_DIR):
+    """Compile and upload the code in the sandbox to the arduino
+    
+    If `use_build_cache`, the sketch is compiled only if no build with the
+    same hash (see get_build_hash) is in `build_cache_dir`, and the cached
+    hex file is uploaded with avrdude. If that same build was the last
+    one uploaded to this serial port, the flash is only verified against 
+    it, and written only if it differs.
+    
+    The board type is `specific_parameters['build']['board_type']`, 
+    defaulting to DEFAULT_BOARD_TYPE. Board types not in 
+    AVRDUDE_PARAMETERS are always compiled and uploaded by the IDE, as is
+    everything if avrdude is not found.
+    
+    The duration of each phase is written to build_timing.json in the
+    sandbox.
+    
+    Returns: dict from phase to its duration in seconds
+    """
+    # Name of the Arduino sketch
+    sketch_filename = os.path.join(sandbox_paths['sketch'],
+        'Autosketch.ino')
+    serial_port = specific_parameters['build']['serial_port']
+    board_type = specific_parameters['build'].get('board_type', 
+        DEFAULT_BOARD_TYPE)
+
+    # Check the serial port and sketch exist
+    if not os.path.exists(serial_port):
+        raise OSError("serial port %s does not exist" % serial_port)
+    if not os.path.exists(sketch_filename):
+        raise OSError("sketch filename %s does not exist" %
+            sketch_filename)
+
+    # The cached build is uploaded with avrdude
+    if use_build_cache and board_type in AVRDUDE_PARAMETERS and (
+        get_avrdude_command() is None):
+        print("warning: avrdude not found, uploading with the IDE")
+        use_build_cache = False
+
+    # Without the cache, compile and upload with the IDE
+    if not use_build_cache or board_type not in AVRDUDE_PARAMETERS:
+        cmd_string = [
+            'arduino',
+            '--board',
+            board_type,
+            '--port',
+            serial_port,
+            '--pref',
+            'sketchbook.path=%s' % os.path.expanduser(SKETCHBOOK_PATH),
+            '--verbose-build',
+            '--upload',
+            sketch_filename,
+        ]
+        timings = {}
+        run_arduino(cmd_string, verbose=verbose, timings=timings)
+        print("successfully compiled and uploaded")
+    
+    else:
+        ## Compile, unless cached, and upload, unless already on the board
+        timings = {}
+        build_hash, hex_filename = prepare_build(sandbox_paths, board_type, 
+            build_cache_dir=build_cache_dir, verbose=verbose, 
+            timings=timings)
+        status = upload_build(hex_filename, build_hash, serial_port, 
+            board_type, build_cache_dir=build_cache_dir, verbose=verbose,
+            timings=timings)
+        if status == 'unchanged':
+            print("board already has this build, not uploading")
+        else:
+            print("successfully uploaded")
+    
+    print("build timing: " + format_timings(timings))
+    write_build_timing(sandbox_paths, timings)
+    return timings
+
+def write_build_timing(sandbox_paths, timings):
+    """Write the duration of each build phase to the sandbox"""
+    if 'sandbox' not in sandbox_paths:
+        return
+    with open(os.path.join(sandbox_paths['sandbox'], 'build_timing.json'),
+        'w') as fi:
+        json.dump(timings, fi, indent=4)
+
+def run_arduino(cmd_string, verbose=False, timings=None, n_tries=2,
+    timeout=ARDUINO_TIMEOUT):
+    """Run the Arduino IDE with `cmd_string`, retrying if the upload
+    cannot open the serial port, or if the IDE hangs for `timeout` seconds.
+    
+    timings : if not None, the duration of each phase is added to it
+    
+    Raises IOError if the compilation or the upload fails.
+    """
+    for n_try in range(n_tries):
+        result = run_build_command(cmd_string, 
+            phase_patterns=ARDUINO_PHASE_PATTERNS,
+            error_patterns=ARDUINO_ERRORS, timeout=timeout, verbose=verbose)
+        add_timings(timings, result['phase_times'])
+        
+        if result['error'] in ('cannot open serial port', 'timed out'):
+            if n_try < n_tries - 1:
+                print("%s; trying again ..." % result['error'])
+                time.sleep(RETRY_DELAY)
+                continue
+            if result['error'] == 'timed out':
+                raise IOError("arduino timed out after %d tries" % n_tries)
+            raise IOError("repeated ser_open errors, giving up")
+        elif result['error'] is not None:
+            raise IOError("avrdude process killed; %s" % result['error'])
+        
+        # Check for compilation errors
+        if result['returncode'] != 0:
+            print("error in compiling:")
+            print(result['stderr'])
+            raise IOError("compilation error")
+        return
+
 def write_python_parameters(sandbox_paths, python_parameters, script_name,
     verbose=False):
     """Write python_parameters to script directory in sandbox"""
@@ -289,7 +759,7 @@ def write_python_parameters(sandbox_paths, python_parameters, script_name,
         json.dump(python_parameters, fi, indent=4)
   
 def call_python_script(script_path, script_name, ncols=80, nrows=23, 
-    xpos=0, ypos=270, zoom=.6):
+    xpos=0, ypos=270, zoom=.6, pylab=True):
     """Run the Python script in a subprocess.
     
     A new gnome-terminal window is created at the specified position.
@@ -299,18 +769,22 @@ def call_python_script(script_path, script_name, ncols=80, nrows=23,
     script_name : Name of the script
     ncols, nrows : size of gnome-terminal window
     zoom : zoom of gnome-terminal window
+    pylab : whether to start ipython with --pylab. This imports matplotlib
+        before the script starts, so it is disabled for scripts that
+        import matplotlib themselves when they need it (fast_start).
     """
     # Launch a new terminal window in a certain position
     # Within that window, execute ipython
     # Tell ipython to run the script
 
     if (platform.system().lower() == "darwin"):
-        cmd = "xterm -geometry {}x{}+{}+{} -e 'cd {} && ipython --pylab=tk -i {}' ".format(
+        cmd = "xterm -geometry {}x{}+{}+{} -e 'cd {} && ipython {}-i {}' ".format(
             ncols,
             nrows,
             xpos,
             ypos,
             os.path.abspath(script_path),
+            '--pylab=tk ' if pylab else '',
             script_name
         )
         subprocess.Popen(shlex.split(cmd))
@@ -322,5 +796,5 @@ def call_python_script(script_path, script_name, ncols=80, nrows=23,
             '--zoom=%0.2f' % zoom,  
             '--', # used to be -x
             'bash', '-l', '-c',
-            "ipython --pylab=qt -i %s" % script_name,
+            "ipython %s-i %s" % ('--pylab=qt ' if pylab else '', script_name),
             ])
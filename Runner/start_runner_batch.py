@@ -0,0 +1,281 @@
+#!/usr/bin/python
+"""Start a block of behavioral sessions on many boards at once.
+
+This does the same as start_runner_cli for each of a list of sessions,
+but the slow steps are shared and run in parallel:
+
+1.  The specific parameters of every box, board, and mouse are loaded
+    at once (see ParamLookups.Cache). For each session, the sandbox is
+    created and filled, as in start_runner_cli.
+
+2.  Each distinct firmware (see Sandbox.get_build_hash) is compiled once,
+    unless it is already in the build cache. Distinct firmwares are
+    compiled in parallel.
+
+3.  The firmware is uploaded to every board in parallel, with retries
+    for the known avrdude errors. Boards that already have the right
+    firmware are only verified.
+
+4.  A table of the status of each session is printed, and the Python
+    script is called for each session whose board is ready.
+
+Usage:
+    python -m ArduFSM.Runner.start_runner_batch --experimenter chris \\
+        KF79,CR1,B1 KF80,CR2,B2
+or with a CSV file with columns mouse, board, box:
+    python -m ArduFSM.Runner.start_runner_batch --experimenter chris \\
+        --sessions morning.csv
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import csv
+import argparse
+from multiprocessing.pool import ThreadPool
+from . import Sandbox
+from . import ParamLookups
+
+
+def prepare_session(user_input, sandbox_root, protocol_root, getter=None):
+    """Look up parameters and create and fill the sandbox for one session
+
+    getter : passed to get_specific_parameters_from_user_input
+
+    Returns: dict with keys 'user_input', 'specific_parameters',
+        'sandbox_paths', 'board_type'
+    """
+    specific_parameters = \
+        ParamLookups.base.get_specific_parameters_from_user_input(user_input,
+            getter=getter)
+
+    sandbox_paths = Sandbox.create_sandbox(user_input,
+        sandbox_root=sandbox_root)
+
+    Sandbox.copy_protocol_to_sandbox(
+        sandbox_paths,
+        build_parameters=specific_parameters['build'],
+        protocol_root=protocol_root)
+
+    Sandbox.write_c_config_file(
+        sketch_path=sandbox_paths['sketch'],
+        c_parameters=specific_parameters['C'])
+
+    Sandbox.write_python_parameters(
+        sandbox_paths,
+        python_parameters=specific_parameters['Python'],
+        script_name=specific_parameters['build']['script_name'])
+
+    return {
+        'user_input': user_input,
+        'specific_parameters': specific_parameters,
+        'sandbox_paths': sandbox_paths,
+        'board_type': specific_parameters['build'].get('board_type',
+            Sandbox.DEFAULT_BOARD_TYPE),
+        }
+
+def format_status_table(sessions):
+    """Returns a table of the status of each session as a string"""
+    columns = ['mouse', 'board', 'box', 'port', 'build', 'time', 'status']
+    rows = []
+    for session in sessions:
+        user_input = session['user_input']
+        specific_parameters = session.get('specific_parameters', {})
+        rows.append([
+            user_input['mouse'],
+            user_input['board'],
+            user_input['box'],
+            specific_parameters.get('build', {}).get('serial_port', ''),
+            session.get('build_hash', '')[:12],
+            '%0.1fs' % sum(session['timings'].values())
+                if 'timings' in session else '',
+            session['status'],
+            ])
+
+    widths = [max([len(str(row[ncol])) for row in rows] + [len(column)])
+        for ncol, column in enumerate(columns)]
+    lines = ['  '.join([column.ljust(width)
+        for column, width in zip(columns, widths)]).rstrip()]
+    lines.append('  '.join(['-' * width for width in widths]))
+    for row in rows:
+        lines.append('  '.join([str(value).ljust(width)
+            for value, width in zip(row, widths)]).rstrip())
+    return '\n'.join(lines)
+
+def main(session_list, experimenter, n_workers=8, verbose=False,
+    call_scripts=True):
+    """Prepare, compile, and upload many sessions, and call their scripts.
+
+    session_list : list of dicts with keys 'mouse', 'board', 'box'
+    experimenter : passed to create_sandbox
+    n_workers : number of compiles or uploads to run at once
+
+    Returns: list of session dicts, with 'status' being 'ready' or
+        a description of what went wrong
+    """
+    # Create a place to keep sandboxes
+    sandbox_root = os.path.expanduser('~/sandbox_root')
+    if not os.path.exists(sandbox_root):
+        os.mkdir(sandbox_root)
+
+    # Where to look for protocols by name
+    protocol_root = os.path.expanduser('~/dev/ArduFSM')
+
+    ## Prepare each sandbox
+    # All of the parameters are loaded once, for every session
+    parameter_cache = ParamLookups.Cache.ParameterCache()
+    sessions = []
+    for session_input in session_list:
+        user_input = dict(session_input)
+        user_input['experimenter'] = experimenter
+        try:
+            session = prepare_session(user_input, sandbox_root,
+                protocol_root, getter=parameter_cache)
+            session['status'] = 'prepared'
+        except Exception as e:
+            session = {'user_input': user_input,
+                'status': 'setup error: %s' % e}
+        sessions.append(session)
+    prepared = [session for session in sessions
+        if session['status'] == 'prepared']
+
+    # Each serial port can only be used by one session
+    port2session = {}
+    for session in prepared:
+        serial_port = session['specific_parameters']['build']['serial_port']
+        if serial_port in port2session:
+            session['status'] = 'port %s already used by %s' % (
+                serial_port, port2session[serial_port]['user_input']['mouse'])
+        elif not os.path.exists(serial_port):
+            session['status'] = 'serial port %s does not exist' % serial_port
+        elif session['board_type'] not in Sandbox.AVRDUDE_PARAMETERS:
+            session['status'] = 'no avrdude parameters for %s' % (
+                session['board_type'])
+        else:
+            port2session[serial_port] = session
+    prepared = [session for session in prepared
+        if session['status'] == 'prepared']
+
+    # Cached builds are uploaded with avrdude
+    if len(prepared) > 0 and Sandbox.get_avrdude_command() is None:
+        for session in prepared:
+            session['status'] = 'avrdude not found'
+        prepared = []
+
+    pool = ThreadPool(n_workers)
+    try:
+        ## Compile each distinct firmware once
+        # Hash each sandbox to find the distinct firmwares
+        hash2sessions = {}
+        for session in prepared:
+            session['build_hash'] = Sandbox.get_build_hash(
+                session['sandbox_paths']['sketch'], session['board_type'])
+            hash2sessions.setdefault(session['build_hash'], []).append(
+                session)
+
+        def compile_one(build_hash):
+            session = hash2sessions[build_hash][0]
+            timings = {}
+            try:
+                build_hash, hex_filename = Sandbox.prepare_build(
+                    session['sandbox_paths'], session['board_type'],
+                    verbose=verbose, timings=timings)
+                return build_hash, hex_filename, timings, None
+            except Exception as e:
+                return build_hash, None, timings, e
+
+        for build_hash, hex_filename, timings, error in pool.map(compile_one,
+            sorted(hash2sessions.keys())):
+            for session in hash2sessions[build_hash]:
+                session['timings'] = dict(timings)
+                if error is None:
+                    session['hex_filename'] = hex_filename
+                    session['status'] = 'compiled'
+                else:
+                    session['status'] = 'compile error: %s' % error
+        compiled = [session for session in prepared
+            if session['status'] == 'compiled']
+
+        ## Upload to every board at once
+        def upload_one(session):
+            try:
+                return Sandbox.upload_build(session['hex_filename'],
+                    session['build_hash'],
+                    session['specific_parameters']['build']['serial_port'],
+                    session['board_type'], verbose=verbose,
+                    timings=session['timings']), None
+            except IOError as e:
+                return None, e
+
+        for session, (upload_status, error) in zip(compiled,
+            pool.map(upload_one, compiled)):
+            if error is None:
+                session['status'] = 'ready'
+                session['upload_status'] = upload_status
+            else:
+                session['status'] = 'upload error: %s' % error
+    finally:
+        pool.close()
+        pool.join()
+
+    ## Report
+    for session in sessions:
+        if 'timings' in session:
+            Sandbox.write_build_timing(session['sandbox_paths'],
+                session['timings'])
+    print(format_status_table(sessions))
+
+    ## Call the Python scripts for each ready session
+    if call_scripts:
+        for session in sessions:
+            if session['status'] != 'ready':
+                continue
+            build_parameters = session['specific_parameters']['build']
+            subprocess_kwargs = {}
+            for kwarg in ['nrows', 'ncols', 'xpos', 'ypos', 'zoom']:
+                try:
+                    subprocess_kwargs[kwarg] = build_parameters[
+                        'subprocess_window_' + kwarg]
+                except KeyError:
+                    continue
+            Sandbox.call_python_script(
+                script_path=session['sandbox_paths']['script'],
+                script_name=build_parameters['script_name'],
+                pylab=not session['specific_parameters']['Python'].get(
+                    'fast_start', False),
+                **subprocess_kwargs
+                )
+
+    return sessions
+
+def read_session_list(filename):
+    """Read a CSV file with columns mouse, board, box"""
+    with open(filename) as fi:
+        return [dict([(key, row[key]) for key in ('mouse', 'board', 'box')])
+            for row in csv.DictReader(fi)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Start sessions on many boards at once')
+    parser.add_argument('sessions', nargs='*',
+        help='sessions as mouse,board,box')
+    parser.add_argument('--sessions', dest='sessions_file',
+        help='CSV file with columns mouse, board, box')
+    parser.add_argument('--experimenter', required=True)
+    parser.add_argument('--workers', type=int, default=8,
+        help='number of compiles or uploads to run at once')
+    parser.add_argument('--verbose', action='store_true')
+    pargs = parser.parse_args()
+
+    session_list = []
+    if pargs.sessions_file is not None:
+        session_list += read_session_list(pargs.sessions_file)
+    for session_string in pargs.sessions:
+        mouse, board, box = session_string.split(',')
+        session_list.append({'mouse': mouse, 'board': board, 'box': box})
+    if len(session_list) == 0:
+        parser.error("no sessions given")
+
+    main(session_list, experimenter=pargs.experimenter,
+        n_workers=pargs.workers, verbose=pargs.verbose)
@@ -66,8 +66,10 @@ def main(mouse, board, box, experimenter, **other_python_parameters):
         'experimenter': experimenter}
 
     # Look up the specific parameters
+    # The cache falls back to a snapshot if the database is unavailable
     specific_parameters = \
-        ParamLookups.base.get_specific_parameters_from_user_input(user_input)
+        ParamLookups.base.get_specific_parameters_from_user_input(user_input,
+            getter=ParamLookups.Cache.ParameterCache())
     
     # Add in the other python parameters
     specific_parameters['Python'].update(other_python_parameters)
@@ -108,6 +110,7 @@ def main(mouse, board, box, experimenter, **other_python_parameters):
     Sandbox.call_python_script(
         script_path=sandbox_paths['script'], 
         script_name=specific_parameters['build']['script_name'],
+        pylab=not specific_parameters['Python'].get('fast_start', False),
         **subprocess_kwargs
         )
 
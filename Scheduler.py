@@ -35,6 +35,7 @@ import numpy as np
 import my
 from .TrialSpeak import YES, NO, HIT
 from . import TrialSpeak, TrialMatrix
+from . import stim_registry
 
 # How many errors before direct delivery
 n_dd_trials = 4
@@ -51,6 +52,17 @@ OPTO_FORCED = True
 # If 2, then code opto as NO/4/5
 N_OPTO_TARGETS = 2 
 
+def pick_trial_types(trial_types, **kwargs):
+    """Returns the rows of trial_types matching kwargs, as my.pick_rows
+    
+    If trial_types came from the stim registry, the precomputed subset is
+    returned instead. Do not modify the result.
+    """
+    stim_set = stim_registry.find_stim_set(trial_types)
+    if stim_set is not None:
+        return stim_set.get_subset(**kwargs)
+    return my.pick_rows(trial_types, **kwargs)
+
 class ForcedAlternation(object):
     def __init__(self, trial_types, **kwargs):
         self.name = 'forced alternation'
@@ -107,7 +119,7 @@ class ForcedAlternation(object):
                 assert len(sub_trial_types) > 0                
             else:
                 # Choose from trials from the forced side
-                sub_trial_types = my.pick_rows(self.trial_types, 
+                sub_trial_types = pick_trial_types(self.trial_types, 
                     rewside=res['RWSD'])
                 assert len(sub_trial_types) > 0
             
@@ -207,7 +219,7 @@ class ForcedAlternationGNG(ForcedAlternation):
                 assert len(sub_trial_types) > 0                
             else:
                 # Choose from trials from the forced side
-                sub_trial_types = my.pick_rows(self.trial_types, 
+                sub_trial_types = pick_trial_types(self.trial_types, 
                     rewside=res['RWSD'])
                 assert len(sub_trial_types) > 0
             
@@ -274,7 +286,7 @@ class ForcedAlternationLickTrain(object):
             self.params['FD'] = res['RWSD']
 
             # Choose from trials from the forced side
-            sub_trial_types = my.pick_rows(self.trial_types, 
+            sub_trial_types = pick_trial_types(self.trial_types, 
                 rewside=res['RWSD'])
             assert len(sub_trial_types) > 0
             
@@ -433,7 +445,7 @@ class ForcedSide(object):
         res = {}
         
         # Choose from trials from the forced side
-        sub_trial_types = my.pick_rows(self.trial_types, 
+        sub_trial_types = pick_trial_types(self.trial_types, 
             rewside=self.params['side'])
         assert len(sub_trial_types) > 0
         idx = sub_trial_types.index[np.random.randint(0, len(sub_trial_types))]
@@ -511,10 +523,10 @@ class SessionStarter(ForcedAlternation):
 
         # For simplicity, slice trial_types
         # Later, might want to reimplement the choosing rule instead
-        lefts = my.pick_rows(self.trial_types, rewside='left')
+        lefts = pick_trial_types(self.trial_types, rewside='left')
         closest_left = lefts.srvpos.argmin()
         
-        rights = my.pick_rows(self.trial_types, rewside='right')
+        rights = pick_trial_types(self.trial_types, rewside='right')
         closest_right = rights.srvpos.argmin()
         
         # Because we maintain the indices, plotter will work correctly
@@ -536,10 +548,10 @@ class SessionStarterSrvMax(ForcedAlternation):
 
         # For simplicity, slice trial_types
         # Later, might want to reimplement the choosing rule instead
-        lefts = my.pick_rows(self.trial_types, rewside='left')
+        lefts = pick_trial_types(self.trial_types, rewside='left')
         closest_left = lefts.srvpos.idxmax()
         
-        rights = my.pick_rows(self.trial_types, rewside='right')
+        rights = pick_trial_types(self.trial_types, rewside='right')
         closest_right = rights.srvpos.idxmax()
         
         # Because we maintain the indices, plotter will work correctly
@@ -7,6 +7,7 @@ by TrialSpeak.
 from __future__ import absolute_import
 from __future__ import division
 from past.utils import old_div
+from builtins import object
 from . import TrialSpeak
 import pandas, my, numpy as np
 
@@ -153,12 +154,9 @@ def numericate_trial_matrix(translated_trial_matrix):
         outcome=['hit', 'error'])
     
     # Replace and intify
-    df['choice'] = df['choice'].replace(
-        {'left': -1, 'right': 1}).astype(np.int)
-    df['prevchoice'] = df['prevchoice'].replace(
-        {'left': -1, 'right': 1}).astype(np.int)
-    df['rewside'] = df['rewside'].replace(
-        {'left': -1, 'right': 1}).astype(np.int)    
+    # Only left and right remain, so this works for strings or categoricals
+    for col in ['choice', 'prevchoice', 'rewside']:
+        df[col] = np.where(df[col] == 'left', -1, 1).astype(np.int)
     
     return df
 
@@ -281,4 +279,76 @@ def add_rwin_and_choice_times_to_trial_matrix(tm, bfile):
     tm['rwin_time'] = old_div(TrialSpeak.identify_state_change_times(
         bfile, state1=7, warn_on_multiple_changes=False), 1000.)
     tm['rt'] = (tm['choice_time'] - tm['rwin_time'])  
-    return tm
\ No newline at end of file
+    return tm
+
+
+class TrialTypeLookup(object):
+    """Matches trials to trial types by a tuple of key columns.
+    
+    This is built once for a set of trial types and then assigns a trial
+    type to any number of trials with a single hashed join, instead of
+    calling my.pick on trial_types once per trial.
+    
+    Key columns that are numeric in trial_types are compared as floats,
+    because the trial matrix stores parameters as floats. All others are
+    compared as objects.
+    """
+    def __init__(self, trial_types, keys):
+        """Build the lookup.
+        
+        trial_types : DataFrame of trial types. The index labels are 
+            returned as the trial types.
+        keys : list of columns in trial_types to match on
+        """
+        self.trial_types = trial_types
+        self.keys = list(keys)
+        
+        # How to cast each key
+        self.key2dtype = {}
+        for key in self.keys:
+            if np.issubdtype(trial_types[key].dtype, np.number):
+                self.key2dtype[key] = np.float
+            else:
+                self.key2dtype[key] = np.object
+        key_df = self.cast_keys(trial_types)
+        
+        # Only the first of each set of duplicated keys is matched, as
+        # my.pick()[0] would. Keep track of which keys had duplicates.
+        first_msk = ~key_df.duplicated(keep='first').values
+        self.labels = trial_types.index.values[first_msk]
+        self.has_duplicates = key_df.duplicated(keep=False).values[first_msk]
+        self.index = pandas.MultiIndex.from_arrays(
+            [key_df[key].values[first_msk] for key in self.keys],
+            names=self.keys)
+    
+    def cast_keys(self, df):
+        """Return the key columns of df cast to the lookup dtypes.
+        
+        Raises ValueError or TypeError if they cannot be cast.
+        """
+        return pandas.DataFrame(dict([
+            (key, df[key].values.astype(self.key2dtype[key]))
+            for key in self.keys]), index=df.index, columns=self.keys)
+    
+    def lookup(self, key_df):
+        """Find the trial type of each row of key_df.
+        
+        key_df : DataFrame with a column for each key, without nulls
+        
+        Returns: labels, multiple_matches
+            labels : array of trial type labels, or None for rows 
+                without a match
+            multiple_matches : boolean array, True where more than one
+                trial type matched
+        Raises ValueError or TypeError if the keys cannot be cast.
+        """
+        key_df = self.cast_keys(key_df)
+        positions = self.index.get_indexer(pandas.MultiIndex.from_arrays(
+            [key_df[key].values for key in self.keys], names=self.keys))
+        
+        matched = positions >= 0
+        labels = np.empty(len(positions), dtype=np.object)
+        labels[matched] = self.labels[positions[matched]]
+        multiple_matches = np.zeros(len(positions), dtype=np.bool)
+        multiple_matches[matched] = self.has_duplicates[positions[matched]]
+        return labels, multiple_matches
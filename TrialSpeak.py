@@ -9,9 +9,12 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import str
 from builtins import range
+from builtins import object
 from past.utils import old_div
 import pandas, numpy as np, my
 import io
+import os
+from . import chunked_log
 
 ack_token = 'ACK'
 release_trial_token = 'RELEASE_TRL'
@@ -20,6 +23,13 @@ start_trial_token = 'TRL_START'
 trial_param_token = 'TRLP'
 trial_result_token = 'TRLR'
 
+# Written to the log by the chatter when the device is reconnected, as
+# "<time> DBG RECONNECT <n_reconnects> <date>". Reconnecting resets the
+# device, so its clock restarts at zero after this line. The time of the
+# line is the last time received before the reset. The parsers continue
+# the times across the reset (see get_reconnect_offsets).
+reconnect_token = 'RECONNECT'
+
 # dictionary for actions
 # this must match the arduino code
 LEFT = 1
@@ -37,6 +47,191 @@ YES = 3
 NO = 2
 MD = 0 # "must-define"
 
+# Reward events, as in "EV R_L", by side and how they were triggered:
+# auto (after a correct choice), manual (from the UI), or direct
+reward_name2event = {
+    'left auto' : 'R_L',
+    'right auto' : 'R_R',
+    'left manual' : 'AAR_L',
+    'right manual' : 'AAR_R',
+    'left direct' : 'DDR_L',
+    'right direct' : 'DDR_R',
+    }
+
+## Trial index sidecar
+# Chatter can write a binary sidecar next to the logfile, named 
+# logfilename + '.trial_index', with one record for each TRL_START line,
+# each TRL_RELEASED line, and the first TRLR line after each TRL_START.
+# Each record is the byte offset of the line in the logfile, the Arduino
+# time of the line (-1 if it cannot be parsed), and the kind of line.
+TRIAL_INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'), ('time', '<i8'), ('kind', 'u1')])
+TRIAL_INDEX_START = 0
+TRIAL_INDEX_RELEASED = 1
+TRIAL_INDEX_RESULTS = 2
+trial_index_token2kind = {
+    start_trial_token: TRIAL_INDEX_START,
+    trial_released_token: TRIAL_INDEX_RELEASED,
+    trial_result_token: TRIAL_INDEX_RESULTS,
+    }
+
+def get_trial_index_filename(logfilename):
+    """Returns the name of the trial index sidecar for `logfilename`"""
+    return logfilename + '.trial_index'
+
+def pack_trial_index_record(offset, time, kind):
+    """Returns the bytes of one trial index record"""
+    return np.array([(offset, time, kind)], dtype=TRIAL_INDEX_DTYPE).tobytes()
+
+def read_trial_index(index_filename):
+    """Read a trial index sidecar into a structured array.
+    
+    A partially written record at the end, from a live session, is ignored.
+    """
+    with open(index_filename, 'rb') as fi:
+        data = fi.read()
+    n_records = len(data) // TRIAL_INDEX_DTYPE.itemsize
+    return np.frombuffer(data[:n_records * TRIAL_INDEX_DTYPE.itemsize], 
+        dtype=TRIAL_INDEX_DTYPE)
+
+def build_trial_index(logfilename, index_filename=None):
+    """Write a trial index sidecar for an existing logfile.
+    
+    This reads the whole logfile once, for logfiles that were recorded 
+    without the sidecar.
+    
+    Returns: the trial index, as from read_trial_index
+    """
+    if index_filename is None:
+        index_filename = get_trial_index_filename(logfilename)
+    
+    rec_l = []
+    offset = 0
+    results_seen = True
+    with open(logfilename, 'rb') as fi:
+        for bline in fi:
+            sp_line = bline.decode('utf-8', 'replace').split()
+            if len(sp_line) > 1 and sp_line[1] in trial_index_token2kind:
+                kind = trial_index_token2kind[sp_line[1]]
+                if kind == TRIAL_INDEX_START:
+                    results_seen = False
+                if kind != TRIAL_INDEX_RESULTS or not results_seen:
+                    try:
+                        time = int(sp_line[0])
+                    except ValueError:
+                        time = -1
+                    rec_l.append((offset, time, kind))
+                if kind == TRIAL_INDEX_RESULTS:
+                    results_seen = True
+            offset += len(bline)
+    
+    index = np.array(rec_l, dtype=TRIAL_INDEX_DTYPE)
+    with open(index_filename, 'wb') as fi:
+        fi.write(index.tobytes())
+    return index
+
+def read_trial_lines(logfilename, start_trial, stop_trial=None, 
+    index_filename=None, include_setup=False):
+    """Read only the lines of some trials, using the trial index sidecar.
+    
+    Trials are numbered from 0 as in the trial matrix. Returns the lines 
+    from the TRL_START of `start_trial` up to, but not including, the 
+    TRL_START of `stop_trial`. If `stop_trial` is None or has not started 
+    yet, reads to the end of the file.
+    
+    include_setup : if True, also include the setup lines before the 
+        first trial, so that the result can be parsed like a whole logfile
+    
+    The trial numbers in a trial matrix made from the result begin at 0,
+    so add `start_trial` to get the real trial numbers.
+    
+    If `logfilename` is a compressed log (see chunked_log), only the
+    chunks containing the requested trials are decompressed, and
+    `index_filename` is ignored.
+    
+    Raises IOError if there is no trial index.
+    """
+    if not os.path.exists(logfilename) and os.path.exists(
+        chunked_log.get_chunked_log_filename(logfilename)):
+        logfilename = chunked_log.get_chunked_log_filename(logfilename)
+    if chunked_log.is_chunked_log(logfilename):
+        return read_chunked_trial_lines(logfilename, start_trial, stop_trial,
+            include_setup=include_setup)
+    
+    if index_filename is None:
+        index_filename = get_trial_index_filename(logfilename)
+    if not os.path.exists(index_filename):
+        raise IOError("no trial index %s, use build_trial_index" % 
+            index_filename)
+    index = read_trial_index(index_filename)
+    start_offsets = index['offset'][index['kind'] == TRIAL_INDEX_START]
+    
+    if start_trial >= len(start_offsets):
+        return []
+    start = start_offsets[start_trial]
+    if stop_trial is None or stop_trial >= len(start_offsets):
+        stop = None
+    else:
+        stop = start_offsets[stop_trial]
+    
+    with open(logfilename, 'rb') as fi:
+        setup = b''
+        if include_setup and len(start_offsets) > 0:
+            setup = fi.read(start_offsets[0])
+        fi.seek(start)
+        if stop is None:
+            data = fi.read()
+        else:
+            data = fi.read(stop - start)
+    
+    return (setup + data).decode('utf-8').splitlines(True)
+
+def read_chunked_trial_lines(filename, start_trial, stop_trial=None, 
+    include_setup=False):
+    """Read only the lines of some trials from a compressed log.
+    
+    See read_trial_lines.
+    """
+    index = chunked_log.read_chunk_index(filename)
+    if index is None:
+        raise IOError("no chunk index for %s" % filename)
+    
+    # Each chunk begins at the start of trial `first_trial`, except the
+    # first which begins with the setup lines
+    first_trials = index['first_trial']
+    start_chunk = max(
+        np.searchsorted(first_trials, start_trial, side='right') - 1, 0)
+    if stop_trial is None:
+        stop_chunk = None
+    else:
+        stop_chunk = np.searchsorted(first_trials, stop_trial, side='right')
+    lines = chunked_log.read_chunks(filename, start_chunk, stop_chunk, 
+        index=index)
+    
+    # Keep the lines from the start of `start_trial` to the start of
+    # `stop_trial`, counting the trials that start in these chunks
+    ntrial = first_trials[start_chunk] - 1 if len(index) > 0 else -1
+    res = []
+    for line in lines:
+        sp_line = line.split(None, 2)
+        if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+            ntrial += 1
+        if stop_trial is not None and ntrial >= stop_trial:
+            break
+        if ntrial >= start_trial:
+            res.append(line)
+    
+    if include_setup:
+        setup = []
+        for line in chunked_log.read_chunks(filename, 0, 1, index=index):
+            sp_line = line.split(None, 2)
+            if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+                break
+            setup.append(line)
+        res = setup + res
+    return res
+
+
 ## Reading functions
 def load_splines_from_file(filename):
     """Reads lines from file and split into list of lists by trial"""
@@ -51,43 +246,170 @@ def load_splines_from_file(filename):
 def split_by_trial(lines):
     """Splits lines from logfile into list of lists by trial.
 
-    Returns: splines, a list of list of lines, each beginning with
-    TRIAL START (which is when the current trial params are determined).
+    Returns: splines, a Splines object that acts like a list of list of
+    lines, each beginning with TRIAL START (which is when the current trial
+    params are determined). No lines are copied.
     
     Note that this means that the first entry (if it exists) will always be 
     setup info, not trial info.
     """
-    if len(lines) == 0:
-        return [[]]
-    
-    # Find the trial start lines
-    # This could be done in a couple of ways. Which is most efficient?
-    # This method: split by space, check for token in position 1
-    trial_starts = [0]
-    for nline, line in enumerate(lines):        
-        sp_line = line.split()
-        if len(sp_line) > 1 and sp_line[1] == start_trial_token:
-            trial_starts.append(nline)
+    return Splines(lines)
 
-    # Now iterate over trial_starts and append the chunks
-    splines = []
-    for nstart in range(len(trial_starts)-1):
-        splines.append(lines[trial_starts[nstart]:trial_starts[nstart+1]])
+class SplineView(object):
+    """The lines of one trial, as a view into the lines of a Splines.
     
-    # Append the leftovers as the last trial, if there is anything
-    if len(trial_starts) >= 1:
-        splines.append(lines[trial_starts[-1]:])
+    Acts like a read-only list. The boundaries are looked up on each access,
+    so the view of the current trial grows as new lines arrive, and stops
+    at the next TRL_START once it does.
+    """
+    def __init__(self, splines, ntrial):
+        self.splines = splines
+        self.ntrial = ntrial
+    
+    def bounds(self):
+        """Returns (start, stop) of this trial in the line buffer"""
+        return self.splines.get_bounds(self.ntrial)
+    
+    def __len__(self):
+        start, stop = self.bounds()
+        return stop - start
+    
+    def __iter__(self):
+        start, stop = self.bounds()
+        lines = self.splines.lines
+        for nline in range(start, stop):
+            yield lines[nline]
+    
+    def __getitem__(self, key):
+        start, stop = self.bounds()
+        if isinstance(key, slice):
+            return [self.splines.lines[nline] 
+                for nline in range(start, stop)[key]]
+        return self.splines.lines[range(start, stop)[key]]
+    
+    def __repr__(self):
+        return 'SplineView(%r)' % list(self)
+
+class Splines(object):
+    """Lines from a logfile, split by trial without copying.
     
-    return splines
+    Stores one buffer of lines and the offset at which each trial starts.
+    Acts like the list of lists that split_by_trial used to return: 
+    indexing gives a SplineView of the lines of that trial, and the first
+    entry is always setup info.
+    
+    For a live logfile, call `update` with the latest lines on each loop.
+    Only the new lines are scanned for TRL_START.
+    """
+    def __init__(self, lines=None):
+        # The line buffer. This is the caller's list, not a copy.
+        self.lines = []
+        
+        # Offset of the start of each trial. The first "trial" is setup.
+        self.starts = [0]
+        
+        # Number of lines already scanned for trial starts
+        self.n_scanned = 0
+        
+        if lines is not None:
+            self.update(lines, complete=True)
+    
+    def update(self, lines, complete=False):
+        """Update with the latest lines from a logfile that is appended to.
+        
+        lines : all lines so far, eg from read_lines_from_file. If this
+            is shorter than before, the logfile was replaced and everything
+            is rescanned.
+        complete : if False, a last line without a newline is assumed to
+            be partially written, and is scanned on a later update.
+        """
+        if len(lines) < self.n_scanned:
+            self.starts = [0]
+            self.n_scanned = 0
+        self.lines = lines
+        
+        # Don't scan a partially written last line
+        n_to_scan = len(lines)
+        if (not complete and n_to_scan > self.n_scanned and 
+            not lines[-1].endswith('\n')):
+            n_to_scan -= 1
+        
+        # Find the trial start lines
+        # Check for the token with `in` before splitting, which is faster
+        for nline in range(self.n_scanned, n_to_scan):
+            line = lines[nline]
+            if start_trial_token in line:
+                sp_line = line.split()
+                if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+                    self.starts.append(nline)
+        self.n_scanned = n_to_scan
+    
+    def get_bounds(self, ntrial):
+        """Returns (start, stop) offsets of trial `ntrial` in self.lines"""
+        start = self.starts[ntrial]
+        if ntrial == len(self.starts) - 1 or ntrial == -1:
+            stop = len(self.lines)
+        else:
+            stop = self.starts[ntrial + 1]
+        return start, stop
+    
+    def __len__(self):
+        # As before, there is always at least the (maybe empty) setup info
+        return len(self.starts)
+    
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [SplineView(self, ntrial) 
+                for ntrial in range(len(self))[key]]
+        return SplineView(self, range(len(self))[key])
+    
+    def __iter__(self):
+        for ntrial in range(len(self)):
+            yield SplineView(self, ntrial)
     
 def read_lines_from_file(filename):
-    """Reads all lines from file and returns as list"""
+    """Reads all lines from file and returns as list
+    
+    If `filename` is a compressed log, or does not exist but its 
+    compressed version does, the compressed log is read instead.
+    """
+    if not chunked_log.is_chunked_log(filename) and not os.path.exists(
+        filename):
+        compressed_filename = chunked_log.get_chunked_log_filename(filename)
+        if os.path.exists(compressed_filename):
+            filename = compressed_filename
+    if chunked_log.is_chunked_log(filename):
+        return chunked_log.read_lines(filename)
+    
     with open(filename) as fi:
         lines = fi.readlines()
     return lines
 
 
 ## Parsing functions
+def find_reconnect_lines(lines):
+    """Returns a boolean array, True for each reconnect marker in `lines`"""
+    res = []
+    for line in lines:
+        sp_line = line.split()
+        res.append(len(sp_line) > 2 and sp_line[1] == 'DBG' and 
+            sp_line[2] == reconnect_token)
+    return np.array(res, dtype=np.bool)
+
+def get_reconnect_offsets(times, is_reconnect):
+    """Returns the offset to add to each time to undo resets of the device
+    
+    times : array of device times (ms)
+    is_reconnect : boolean array, True for each reconnect marker
+    
+    The device clock restarts at zero after each reconnect marker. The
+    time of the marker, the last time before the reset, is added to every
+    time after it, so that the times continue in order across the reset.
+    The time spent disconnected is not counted.
+    """
+    marker_times = np.where(is_reconnect, np.maximum(times, 0), 0)
+    return np.cumsum(marker_times) - marker_times
+
 def parse_lines_into_df(lines):
     """Parse every line into time, command, and argument.
     
@@ -96,6 +418,9 @@ def parse_lines_into_df(lines):
     In trial speak, each line has the same format: the time in milliseconds,
     space, a string command, space, an optional argument. This function parses
     each line into those three components and returns as a dataframe.
+    
+    Times after a reconnect marker continue from before it (see
+    get_reconnect_offsets).
     """
     # Split each line
     rec_l = []
@@ -118,6 +443,15 @@ def parse_lines_into_df(lines):
         raise ValueError("cannot extract any lines")
     df = pandas.DataFrame(rec_l, columns=['time', 'command', 'argument'])
     df['time'] = df['time'].astype(np.int)
+    
+    # Continue the times across resets of the device
+    argument = df['argument'].fillna('')
+    is_reconnect = ((df['command'] == 'DBG') & (
+        (argument == reconnect_token) |
+        argument.str.startswith(reconnect_token + ' '))).values
+    if is_reconnect.any():
+        df['time'] = df['time'].values + get_reconnect_offsets(
+            df['time'].values, is_reconnect)
     return df
 
 def parse_lines_into_df_split_by_trial(lines, verbose=False):
@@ -138,22 +472,19 @@ def parse_lines_into_df_split_by_trial(lines, verbose=False):
         print("warning: lost %d lines" % n_lost_lines)
     
     # Split by trial
-    trl_start_idxs = my.pick_rows(df, command=start_trial_token).index
+    trl_start_offsets = np.flatnonzero(
+        df['command'].values == start_trial_token)
     
     # Return [empty df] if nothing
-    if len(trl_start_idxs) == 0:
+    if len(trl_start_offsets) == 0:
         return None
     
-    # Split df
+    # Split df by position
     # In each case, we include the first line but exclude the last
-    res = []
-    for nidx in range(len(trl_start_idxs) - 1):
-        # Slice out, including first but excluding last
-        slc = df.loc[trl_start_idxs[nidx]:trl_start_idxs[nidx + 1] - 1]
-        res.append(slc)
-    
-    # Append anything left at the end (current trial, generally)
-    res.append(df.loc[trl_start_idxs[-1]:])
+    # The last one is anything left at the end (current trial, generally)
+    stops = list(trl_start_offsets[1:]) + [len(df)]
+    res = [df.iloc[start:stop] 
+        for start, stop in zip(trl_start_offsets, stops)]
 
     return res
 
@@ -190,8 +521,75 @@ def my_replace(ser, d, nanval='nanval'):
     return ser
 
 
+def categorize(ser, d, nanval='nanval'):
+    """Like my_replace, but returns a categorical Series.
+    
+    ser : Series of numeric codes
+    d : dict from code to category, eg {LEFT: 'left'}
+    nanval : category for null rows
+    
+    The categories are the values of d in order of their codes, then 
+    nanval, then any codes in ser that are not in d (left unchanged, as
+    in my_replace). Codes are translated with a lookup table instead of 
+    comparing each key.
+    
+    Comparisons like ser == 'left' then compare integer codes instead of
+    strings. Use stringify_trial_matrix to get plain strings for display.
+    
+    If ser is not numeric, falls back to my_replace.
+    """
+    try:
+        values = np.asarray(ser.values, dtype=np.float)
+    except (ValueError, TypeError):
+        return my_replace(ser, d, nanval=nanval)
+    
+    keys = np.array(sorted(d.keys()), dtype=np.int)
+    categories = [d[key] for key in keys] + [nanval]
+    
+    # Lookup table from code to category number, -1 if not in d
+    table = -np.ones(keys.max() + 1 if len(keys) > 0 else 1, dtype=np.int)
+    table[keys] = np.arange(len(keys))
+    
+    # Null rows are nanval
+    null_msk = np.isnan(values)
+    codes = np.full(len(values), len(keys), dtype=np.int)
+    
+    # Known codes through the table
+    in_table_msk = (~null_msk & (values >= 0) & (values < len(table)) & 
+        (values == np.round(values)))
+    codes[in_table_msk] = table[values[in_table_msk].astype(np.int)]
+    
+    # Unknown codes become their own categories
+    unknown_msk = ~null_msk & ~in_table_msk
+    unknown_msk[in_table_msk] = codes[in_table_msk] == -1
+    if unknown_msk.any():
+        extra = np.unique(values[unknown_msk])
+        codes[unknown_msk] = len(categories) + np.searchsorted(
+            extra, values[unknown_msk])
+        categories += list(extra)
+    
+    return pandas.Series(pandas.Categorical.from_codes(codes, categories),
+        index=ser.index, name=ser.name)
+
+def stringify_trial_matrix(trial_matrix):
+    """Returns a copy of trial_matrix with categorical columns as strings.
+    
+    The translated trial matrix stores rewside, choice, and outcome as
+    categoricals. This is for display, or for code that needs plain
+    object columns.
+    """
+    trial_matrix = trial_matrix.copy()
+    for col in trial_matrix.columns:
+        if pandas.api.types.is_categorical_dtype(trial_matrix[col]):
+            trial_matrix[col] = trial_matrix[col].astype(np.object)
+    return trial_matrix
+
 def translate_trial_matrix(trial_matrix):
-    """Replace shorthand with longhand, eg, resp -> response."""
+    """Replace shorthand with longhand, eg, resp -> response.
+    
+    The rewside, choice, and outcome columns are categoricals (see 
+    categorize). isrnd is boolean.
+    """
     trial_matrix = trial_matrix.copy()
     trial_matrix = trial_matrix.rename(columns={
         'rwsd': 'rewside',
@@ -204,15 +602,15 @@ def translate_trial_matrix(trial_matrix):
     
     # How to deal with current trial here?
     if 'outcome' in trial_matrix:
-        trial_matrix['outcome'] = my_replace(trial_matrix['outcome'], {
+        trial_matrix['outcome'] = categorize(trial_matrix['outcome'], {
             HIT: 'hit', ERROR: 'error', SPOIL: 'spoil'},
             nanval='curr')
     if 'choice' in trial_matrix:
-        trial_matrix['choice'] = my_replace(trial_matrix['choice'], {
+        trial_matrix['choice'] = categorize(trial_matrix['choice'], {
             LEFT: 'left', RIGHT: 'right', NOGO: 'nogo'},
             nanval='curr')
     if 'rewside' in trial_matrix:
-        trial_matrix['rewside'] = my_replace(trial_matrix['rewside'], {
+        trial_matrix['rewside'] = categorize(trial_matrix['rewside'], {
             LEFT: 'left', RIGHT: 'right', NOGO: 'nogo'})
     if 'isrnd' in trial_matrix:
         assert trial_matrix['isrnd'].isin([YES, NO]).all()
@@ -429,6 +827,10 @@ def get_trial_timings(pldf, logfile_lines,
     ):
     """Parse out lines with trial timing tokens using pldf and logfile_lines.
     
+    The times are taken from pldf, so they continue across resets of the
+    device. If a token occurs more than once in a trial (eg, a trial that
+    was released again after a reconnect), the last one is used.
+    
     Returns df pivoted on trial.
     """
         
@@ -436,18 +838,11 @@ def get_trial_timings(pldf, logfile_lines,
     idxs = pldf.index[pldf['command'].isin(token_l)]
     if len(idxs) == 0:
         return None
-    
-    # read into table
-    sio = io.StringIO("".join([logfile_lines[idx] for idx in idxs]))
-    parsed_command_lines = pandas.read_table(sio, sep=' ',
-        names=('time', 'command'))
-    
-    # Add trial marker
-    parsed_command_lines['trial'] = pldf['trial'][idxs].values
+    parsed_command_lines = pldf.loc[idxs, ['time', 'command', 'trial']]
     
     # Pivot by trial
     piv = old_div(parsed_command_lines.pivot_table(index='trial', values='time', 
-        columns='command'), 1000.)
+        columns='command', aggfunc='last'), 1000.)
     
     # Drop the "-1" trial
     piv = piv.drop(-1)
@@ -579,6 +974,9 @@ def read_logfile_into_df(logfile, nargs=4, add_trial_column=True,
     The dtype will always be int for the time column and object (ie, string)
     for every other column. This is to ensure consistency. You may want
     to coerce certain columns into numeric dtypes.
+    
+    Times after a reconnect marker continue from before it (see
+    get_reconnect_offsets).
     """
     # Determine how many argument columns to use
     arg_cols = ['arg%d' % n for n in range(nargs)]
@@ -617,6 +1015,13 @@ def read_logfile_into_df(logfile, nargs=4, add_trial_column=True,
         except ValueError:
             raise IOError("cannot coerce %s to %r" % (col, dtyp))
     
+    # Continue the times across resets of the device
+    is_reconnect = ((rdf['command'] == 'DBG') & 
+        (rdf['arg0'] == reconnect_token)).values
+    if is_reconnect.any():
+        rdf['time'] = rdf['time'].values + get_reconnect_offsets(
+            rdf['time'].values, is_reconnect)
+    
     # Join on trial number
     if add_trial_column:
         # Find the boundaries between trials in logfile_lines
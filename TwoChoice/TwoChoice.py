@@ -14,25 +14,34 @@ from past.utils import old_div
 # logfile and there is more overhead overall.
 
 import time
+
+# When the script started, for the startup timing
+STARTUP_TIME = time.time()
+
 import json
 import os
 import sys
 import os
 import numpy as np, pandas
-import my
 import time
 import curses
-import matplotlib
-matplotlib.rcParams['toolbar'] = 'None'
-import matplotlib.pyplot as plt
 import ArduFSM
 from ArduFSM import TrialSpeak, TrialMatrix
 from ArduFSM import trial_setter_ui
 from ArduFSM import Scheduler
 from ArduFSM import trial_setter
 from ArduFSM import mainloop
+from ArduFSM import content_store
+from ArduFSM.loop_timer import LoopTimer
+from ArduFSM.startup_timer import StartupTimer
+from ArduFSM.watchdog import LinkWatchdog
+from ArduFSM.metrics import SessionMetrics
 import ParamsTable
-import shutil
+
+# matplotlib is slow to import, so it is imported by start_display, and
+# my.video only if SHOW_WEBCAM
+startup_timer = StartupTimer(start_time=STARTUP_TIME)
+startup_timer.mark('imports')
 
 def move_figure(f, x, y):
     """Move figure's upper left corner to pixel (x, y)"""
@@ -47,16 +56,6 @@ def move_figure(f, x, y):
         f.canvas.manager.window.move(x, y)
     plt.show()
 
-def get_trial_types(name, directory='~/dev/ArduFSM/stim_sets'):
-    """Loads and returns the trial types file"""
-    
-    filename = os.path.join(os.path.expanduser(directory), name)
-    try:
-        trial_types = pandas.read_csv(filename)
-    except IOError:
-        raise ValueError("cannot find trial type file %s" % name)
-    return trial_types
-
 # Load the parameters file
 with open('parameters.json') as fi:
     runner_params = json.load(fi)
@@ -90,6 +89,55 @@ SHOW_IR_PLOT = False
 # sensor plot
 SHOW_SENSOR_PLOT = False
 
+## Whether to time each stage of the main loop, and the startup
+INSTRUMENT_LOOP = runner_params.get('instrument_loop', False)
+
+## Whether to reopen the serial port if it is lost, and continue
+# The interrupted trial is ended as spoiled (see TrialSetter.resync)
+RECONNECT = runner_params.get('reconnect', True)
+
+## Whether to watch for stalls in the serial link
+# Unacknowledged commands are retransmitted and then given up on, and
+# stalls are logged and shown in the UI (see watchdog.py). Once trials
+# are running, the device is reset after WATCHDOG_RESET_TIMEOUT seconds
+# without a line (it announces the time every second), or if a release is
+# not received, unless None. It is never reset during setup.
+WATCHDOG = runner_params.get('watchdog', True)
+WATCHDOG_RESET_TIMEOUT = runner_params.get('watchdog_reset_timeout', 10.)
+
+## Whether to publish live metrics for the lab-wide view
+# A snapshot is written every few seconds and served along with those of
+# the other sessions by `python -m ArduFSM.metrics` (see metrics.py)
+PUBLISH_METRICS = runner_params.get('publish_metrics', True)
+
+## Whether to start the trials before opening the GUI
+# If so, matplotlib is imported and the GUI opened (and the webcam window
+# moved) only once the first trial has been released. Run the script
+# without ipython --pylab, or matplotlib is imported at launch anyway.
+FAST_START = runner_params.get('fast_start', False)
+
+## Whether to record the host receive time of each line from the device
+# This is needed to sync behavior to the video (see clock_sync.py)
+RECORD_HOST_TIMES = runner_params.get('record_host_times', True)
+
+## Whether to index the trial boundaries in the logfile as it is written
+RECORD_TRIAL_INDEX = runner_params.get('record_trial_index', True)
+
+## When to write the lines from the device to the logfile
+# The logfile is read on every loop, so trial boundaries are flushed
+# immediately and everything else at least every LOG_FLUSH_INTERVAL.
+# Set LOG_FSYNC_ON_RESULTS to force the results of each trial to disk.
+LOG_FLUSH_INTERVAL = runner_params.get('log_flush_interval', 0.1)
+LOG_FSYNC_ON_RESULTS = runner_params.get('log_fsync_on_results', False)
+
+## Whether to also write a compressed log, chunked by trial
+# If so, only the compressed log is copied when the session is saved.
+COMPRESS_LOG = runner_params.get('compress_log', False)
+
+## Whether to also insert the parsed lines into an SQLite event store
+# This can be queried during the session (see event_store.py)
+RECORD_EVENTS = runner_params.get('record_events', False)
+
 
 ## Reward amounts
 # Target amount for this mouse (uL)
@@ -151,14 +199,24 @@ params_table['current-value'] = params_table['init_val'].copy()
 
 ## Load the specified trial types
 trial_types_name = runner_params['stimulus_set'] + '_r'
-trial_types = get_trial_types(trial_types_name)
+trial_types = mainloop.get_trial_types(trial_types_name)
 
 
 ## Print welcome message in background color
+def color_to_rgb(color):
+    """Returns the (r, g, b) floats of a matplotlib color
+    
+    Hex colors are converted here. Only named colors need matplotlib,
+    which is slow to import.
+    """
+    if isinstance(color, str) and color.startswith('#') and len(color) == 7:
+        return tuple([int(color[n:n + 2], 16) / 255. for n in (1, 3, 5)])
+    import matplotlib.colors
+    return matplotlib.colors.ColorConverter().to_rgb(color)
+
 if 'background_color' in runner_params:
     # https://stackoverflow.com/questions/15682537/ansi-color-specific-rgb-sequence-bash
-    rgb_tuple = matplotlib.colors.ColorConverter().to_rgb(
-        runner_params['background_color'])
+    rgb_tuple = color_to_rgb(runner_params['background_color'])
     rcolor, gcolor, bcolor = [int(np.rint(color_float * 255)) 
         for color_float in rgb_tuple]
     color_start_string = "\x1b[38;2;%d;%d;%dm" % (rcolor, gcolor, bcolor)
@@ -197,6 +255,7 @@ if not runner_params['has_side_HE_sensor']:
         params_table.loc['STPIP', 'init_val'])
 
 input("Fill water reservoirs and press Enter to start")
+startup_timer.mark('user_input')
 
 ## Set up the scheduler
 if runner_params['scheduler'] == 'Auto':
@@ -212,8 +271,15 @@ scheduler = scheduler_obj(trial_types=trial_types, reverse_srvpos=True)
 logfilename = None # autodate
 chatter = ArduFSM.chat.Chatter(to_user=logfilename, to_user_dir='./logfiles',
     baud_rate=115200, serial_timeout=.1, 
-    serial_port=runner_params['serial_port'])
+    serial_port=runner_params['serial_port'],
+    record_host_times=RECORD_HOST_TIMES,
+    record_trial_index=RECORD_TRIAL_INDEX,
+    flush_interval=LOG_FLUSH_INTERVAL, flush_on_trial=True,
+    fsync_on_results=LOG_FSYNC_ON_RESULTS, echo_interval=0.5,
+    compress_log=COMPRESS_LOG, record_events=RECORD_EVENTS,
+    reconnect=RECONNECT)
 logfilename = chatter.ofi.name
+startup_timer.mark('chatter')
 
 
 ## Reset video filename
@@ -222,10 +288,36 @@ video_filename = os.path.join(os.path.expanduser('~/Videos'),
     '%s-%s.mkv' % (runner_params['box'], date_s))
 
 
+## Link watchdog
+if WATCHDOG:
+    watchdog = LinkWatchdog(chatter, 
+        reset_timeout=WATCHDOG_RESET_TIMEOUT)
+else:
+    watchdog = None
+
+## Loop instrumentation
+if INSTRUMENT_LOOP:
+    loop_timer = LoopTimer()
+else:
+    loop_timer = None
+
 ## Trial setter
 ts_obj = trial_setter.TrialSetter(chatter=chatter, 
     params_table=params_table,
-    scheduler=scheduler)
+    scheduler=scheduler,
+    loop_timer=loop_timer)
+
+## Live metrics
+# The reward durations are adjusted to deliver target_water_volume each
+if PUBLISH_METRICS:
+    session_metrics = SessionMetrics(chatter, ts_obj=ts_obj, 
+        watchdog=watchdog,
+        labels={'box': runner_params['box'], 
+            'board': runner_params['board'],
+            'mouse': runner_params['mouse']},
+        reward_volume=target_water_volume)
+else:
+    session_metrics = None
 
 ## Initialize UI
 RUN_UI = True
@@ -241,6 +333,8 @@ if RUN_UI:
             runner_params['mouse'],
             os.path.split(logfilename)[1],
         ),
+        loop_timer=loop_timer,
+        watchdog=watchdog,
     )
 
     try:
@@ -257,33 +351,27 @@ if RUN_UI:
     
     finally:
         ui.close()
+    startup_timer.mark('ui')
 
 
-## Main loop
-final_message = None
-try:
-    ## Initialize webcam
-    if SHOW_WEBCAM:
-        window_title = os.path.split(video_filename)[1]
-        try:
-            wc = my.video.WebcamController(device=video_device, 
-                output_filename=video_filename,
-                window_title=window_title,
-                image_controls=webcam_controls,)
-            wc.start()
-        except IOError:
-            print("cannot find webcam at port", video_device)
-            wc = None
-            SHOW_WEBCAM = False
-        except OSError:
-            print("something went wrong with webcam process")
-            wc = None
-            SHOW_WEBCAM = False
-    else:
-        wc = None
+## Opening the GUI
+def start_display():
+    """Import matplotlib, open the GUI, and move the webcam window.
+    
+    The GUI is only opened if RUN_GUI, and the webcam window is only moved
+    if SHOW_WEBCAM.
+    """
+    global matplotlib, plt, plotter, plotter2, sensor_plotter
     
-    ## Initialize GUI
     if RUN_GUI:
+        matplotlib = startup_timer.import_module('matplotlib')
+        matplotlib.rcParams['toolbar'] = 'None'
+        plt = startup_timer.import_module('matplotlib.pyplot')
+        startup_timer.import_module('ArduFSM.plot')
+        
+        # As with ipython --pylab
+        plt.ion()
+        
         plotter = ArduFSM.plot.PlotterWithServoThrow(trial_types)
         plotter.init_handles()
         
@@ -306,8 +394,6 @@ try:
         if SHOW_SENSOR_PLOT:
             sensor_plotter = ArduFSM.plot.SensorPlotter()
             sensor_plotter.init_handles()
-        
-        last_updated_trial = 0
     
     # Move the webcam window once it appears
     if SHOW_WEBCAM:
@@ -318,15 +404,64 @@ try:
             print("Waiting for webcam window")
             time.sleep(.5)
     
+    startup_timer.mark('gui')
+
+
+## Main loop
+final_message = None
+try:
+    ## Initialize webcam
+    if SHOW_WEBCAM:
+        window_title = os.path.split(video_filename)[1]
+        try:
+            import my.video
+            wc = my.video.WebcamController(device=video_device, 
+                output_filename=video_filename,
+                window_title=window_title,
+                image_controls=webcam_controls,)
+            wc.start()
+        except IOError:
+            print("cannot find webcam at port", video_device)
+            wc = None
+            SHOW_WEBCAM = False
+        except OSError:
+            print("something went wrong with webcam process")
+            wc = None
+            SHOW_WEBCAM = False
+    else:
+        wc = None
+    
+    ## Initialize GUI
+    # With FAST_START, this happens in the main loop instead
+    last_updated_trial = 0
+    display_started = False
+    if not FAST_START:
+        start_display()
+        display_started = True
+    
+    # Trial boundaries are found incrementally as lines arrive
+    splines = TrialSpeak.Splines()
+    
     while True:
+        if INSTRUMENT_LOOP:
+            loop_timer.start_iteration()
+        
         ## Chat updates
         # Update chatter
         chatter.update(echo_to_stdout=ECHO_TO_STDOUT)
+        if WATCHDOG:
+            watchdog.update()
+        if PUBLISH_METRICS:
+            session_metrics.update()
+        if INSTRUMENT_LOOP:
+            loop_timer.mark('chatter')
         
         # Read lines and split by trial
         # Could we skip this step if chatter reports no new device lines?
         logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
-        splines = TrialSpeak.split_by_trial(logfile_lines)
+        splines.update(logfile_lines)
+        if INSTRUMENT_LOOP:
+            loop_timer.mark('read_log')
 
         # Run the trial setting logic
         # This try/except is no good because it conflates actual
@@ -335,15 +470,29 @@ try:
         translated_trial_matrix = ts_obj.update(splines, logfile_lines)
         #~ except ValueError:
             #~ raise ValueError("cannot get any lines; try reuploading protocol")
+        if INSTRUMENT_LOOP:
+            loop_timer.mark('trial_setter')
+        
+        ## Open the GUI once the first trial is released, with FAST_START
+        # The trial setter returns None until the initial params are sent
+        if translated_trial_matrix is not None and (
+            len(translated_trial_matrix) > 0):
+            startup_timer.mark('first_trial')
+            if not display_started:
+                start_display()
+                display_started = True
         
         ## Update UI
         if RUN_UI:
-            ui.update_data(logfile_lines=logfile_lines)
+            ui.update_data(
+                logfile_lines=logfile_lines[-ui.panel_height['logfile_lines']:])
             ui.get_and_handle_keypress()
+            if INSTRUMENT_LOOP:
+                loop_timer.mark('ui')
 
         ## Update GUI
         # Put this in it's own try/except to catch plotting bugs
-        if RUN_GUI:
+        if RUN_GUI and display_started:
             if last_updated_trial < len(translated_trial_matrix):
                 # update plot
                 plotter.update(logfilename)     
@@ -366,8 +515,11 @@ try:
                 
             
             plt.pause(.01)
-            
-                
+            if INSTRUMENT_LOOP:
+                loop_timer.mark('gui')
+        
+        if INSTRUMENT_LOOP:
+            loop_timer.end_iteration(chatter)
 
 except KeyboardInterrupt:
     print("Keyboard interrupt received")
@@ -427,10 +579,19 @@ except trial_setter_ui.QuitException as qe:
         json.dump(session_results, fi, indent=4)
     
     # Rename the directory with the mouse name
+    # If compressing, finish the compressed log and copy that instead of
+    # the raw logfile and its trial index
+    ignored_names = ['TO_DEV']
+    if COMPRESS_LOG:
+        chatter.chunked_log_writer.close_chunk()
+        ignored_names += [os.path.split(logfilename)[1],
+            os.path.split(TrialSpeak.get_trial_index_filename(logfilename))[1]]
     def ignore_fifo(src, names):
-        return 'TO_DEV'
+        return ignored_names
     session_dir = os.path.split(os.path.split(logfile_dir)[0])[0]
-    shutil.copytree(session_dir, session_dir + '-saved', ignore=ignore_fifo)
+    # Files are hardlinked, and the copy appears all at once
+    content_store.save_tree(session_dir, session_dir + '-saved',
+        ignore=ignore_fifo)
     final_message += "\n" + "rename %s to %s" % (
         session_dir, session_dir + '-saved')
 
@@ -449,6 +610,9 @@ finally:
     chatter.close()
     print("chatter closed")
     
+    if PUBLISH_METRICS:
+        session_metrics.close()
+    
     if RUN_UI:
         ui.close()
         print("UI closed")
@@ -458,6 +622,17 @@ finally:
         #~ plt.close(plotter.graphics_handles['f'])
         #~ print "GUI closed"
     
+    if WATCHDOG:
+        print(watchdog.summary())
+    
+    if INSTRUMENT_LOOP:
+        print(loop_timer.summary())
+        loop_timer.write_summary(os.path.join(
+            os.path.split(logfilename)[0], 'loop_timing.json'))
+        print(startup_timer.summary())
+        startup_timer.write_summary(os.path.join(
+            os.path.split(logfilename)[0], 'startup_timing.json'))
+    
     if final_message is not None:
         print(final_message)
     
@@ -1,8 +1,26 @@
 from __future__ import absolute_import
-from . import plot
 from . import chat
 from . import TrialMatrix
 from . import TrialSpeak
 from . import trial_setter
 from . import trial_setter_ui
-from . import mainloop
\ No newline at end of file
+from . import mainloop
+from . import emulator
+from . import clock_sync
+from . import chunked_log
+from . import content_store
+from . import event_store
+from . import session_index
+from . import learning_curves
+from . import stim_registry
+
+
+def __getattr__(name):
+    """Import plot, which imports matplotlib, only when it is first used
+
+    This keeps `import ArduFSM` fast for the scripts that run sessions.
+    """
+    if name == 'plot':
+        import importlib
+        return importlib.import_module('.plot', __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,438 @@
+"""Benchmarks for the logfile parsers.
+
+This module generates synthetic ardulines that look like a TwoChoice
+session, runs each of the parser paths on them at several session sizes,
+and records the time and peak memory of each. Results can be saved as a
+baseline and later runs compared against it to catch regressions.
+
+The generated logs contain the setup lines, and for each trial the ACKs
+of the SET and RELEASE_TRL commands, TRL_RELEASED, TRL_START, TRLP and
+TRLR lines, ST_CHG and ST_CHG2 lines, TCH and EV lines, and DBG noise.
+Like real logfiles, some ACK and DBG lines are out of order. Optionally,
+some lines are malformed (missing the time, or missing the first digit
+of the time); the parsers that tolerate this are also benchmarked on
+such lines, as separate '_malformed' cases. The generator is
+deterministic for a given seed.
+
+Before timing, the result of each parser is checked once (eg that the
+trial matrix has one row per trial), and a failed check is reported
+as an error.
+
+The stored baseline, DEFAULT_BASELINE, is of sizes 1000 and 10000 with
+the default seed. Times depend on the computer, so update it on the
+computer being compared. To compare against it, or to update it:
+    python -m ArduFSM.benchmarks --sizes 1000 10000 --compare
+    python -m ArduFSM.benchmarks --sizes 1000 10000 --save benchmarks_baseline.json
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import str
+from builtins import range
+import os
+import sys
+import gc
+import json
+import random
+import argparse
+import tempfile
+import timeit
+import numpy as np
+from . import TrialSpeak
+from . import TrialMatrix
+from . import plot
+from .TrialSpeak import (ack_token, release_trial_token, trial_released_token,
+    start_trial_token, trial_param_token, trial_result_token,
+    LEFT, RIGHT, NOGO, HIT, ERROR, SPOIL, YES, NO)
+from .emulator import TWOCHOICE_REPORTED_PARAMS
+
+# tracemalloc is not available on Python 2
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Baseline results stored with the code
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'benchmarks_baseline.json')
+
+# Probability that a line is malformed, for the '_malformed' cases
+MALFORMED_RATE = 0.0001
+
+# Params that are YES or NO, like in the real protocols
+BOOLEAN_PARAMS = ('ISRND', 'DIRDEL', 'OPTO')
+
+
+## Generating synthetic logfiles
+def generate_ardulines(n_trials, seed=0,
+    reported_params=TWOCHOICE_REPORTED_PARAMS, touch_rate=2.0,
+    dbg_rate=0.5, unsorted_rate=0.01, malformed_rate=0.):
+    """Generate the lines of a synthetic TwoChoice logfile.
+
+    n_trials : number of trials
+    seed : seed for the random number generator
+    reported_params : params reported with TRLP on every trial
+    touch_rate : mean number of touches (TCH pairs) per trial
+    dbg_rate : mean number of DBG noise lines per trial
+    unsorted_rate : probability that an ACK or DBG line has a time
+        earlier than the line before it
+    malformed_rate : probability that any line is malformed. Only some
+        parsers tolerate this (see BENCHMARKS).
+
+    Returns: list of lines, each ending with a newline, as returned by
+        TrialSpeak.read_lines_from_file
+    """
+    rng = random.Random(seed)
+    lines = []
+
+    def write(time_ms, s):
+        lines.append('%d %s\n' % (time_ms, s))
+
+    def choose_param(param_name):
+        if param_name in BOOLEAN_PARAMS:
+            return rng.choice([YES, NO])
+        return rng.randint(1, 2000)
+
+    ## Setup
+    t = 0
+    write(t, 'DBG begin setup')
+    for param_name in reported_params:
+        t += rng.randint(1, 5)
+        write(t, '%s SET %s %d' % (ack_token, param_name,
+            choose_param(param_name)))
+    write(t, 'DBG finished setup')
+
+    ## Trials
+    state = 0
+    for n_trial in range(n_trials):
+        # Params for this trial, which the host sets before release
+        params = dict([(param_name, choose_param(param_name))
+            for param_name in reported_params])
+        params['RWSD'] = rng.choice([LEFT, RIGHT])
+        for param_name in reported_params:
+            t += rng.randint(1, 5)
+            write(t, '%s SET %s %d' % (ack_token, param_name,
+                params[param_name]))
+
+        # Release
+        t += rng.randint(1, 20)
+        write(t, '%s %s' % (ack_token, release_trial_token))
+        write(t, trial_released_token)
+
+        # Start and params
+        t += rng.randint(1, 5)
+        write(t, start_trial_token)
+        for param_name in reported_params:
+            write(t, '%s %s %d' % (trial_param_token, param_name,
+                params[param_name]))
+        write(t, 'ST_CHG %d %d' % (state, 1))
+        write(t, 'ST_CHG2 %d %d' % (state, 1))
+        write(t, 'ST_CHG %d %d' % (1, 7))
+        write(t, 'ST_CHG2 %d %d' % (1, 7))
+
+        # Response window, with touches and noise
+        n_touches = int(rng.expovariate(1. / touch_rate)) if touch_rate else 0
+        for n_touch in range(n_touches):
+            t += rng.randint(10, 500)
+            write(t, 'TCH %d' % rng.choice([1, 2]))
+            t += rng.randint(10, 100)
+            write(t, 'TCH 0')
+        if rng.random() < dbg_rate:
+            t += rng.randint(1, 100)
+            write(t, 'DBG noise %d' % rng.randint(0, 1023))
+
+        # Outcome
+        t += rng.randint(500, 3000)
+        draw = rng.random()
+        if draw < 0.05:
+            response, outcome, state = NOGO, SPOIL, 13
+        elif draw < 0.75:
+            response, outcome, state = params['RWSD'], HIT, 7 + params['RWSD']
+            write(t, 'ST_CHG 7 %d' % state)
+            write(t, 'ST_CHG2 7 %d' % state)
+            write(t, 'EV R_L' if response == LEFT else 'EV R_R')
+        else:
+            response = RIGHT if params['RWSD'] == LEFT else LEFT
+            outcome, state = ERROR, 14
+            write(t, 'ST_CHG 7 14')
+            write(t, 'ST_CHG2 7 14')
+
+        # Occasional manual reward
+        if rng.random() < 0.02:
+            write(t, 'EV %s' % rng.choice(['AAR_L', 'AAR_R']))
+
+        write(t, 'ST_CHG %d 13' % state)
+        write(t, 'ST_CHG2 %d 13' % state)
+        write(t, '%s RESP %d' % (trial_result_token, response))
+        write(t, '%s OUTC %d' % (trial_result_token, outcome))
+        t += rng.randint(1000, 3000)
+        write(t, 'ST_CHG 13 0')
+        write(t, 'ST_CHG2 13 0')
+        state = 0
+
+        # The time announcement, sometimes out of order
+        if rng.random() < unsorted_rate:
+            write(t - rng.randint(1, 50), 'DBG')
+        else:
+            write(t, 'DBG')
+
+    ## Corrupt some lines, like a noisy serial connection
+    # Never corrupt a TRL_START line, because that changes the trial count
+    if malformed_rate > 0:
+        for nline in range(len(lines)):
+            if rng.random() >= malformed_rate:
+                continue
+            if start_trial_token in lines[nline]:
+                continue
+            if rng.random() < 0.5:
+                # Missing the time
+                lines[nline] = lines[nline].split(' ', 1)[1]
+            else:
+                # Missing the first digit of the time
+                lines[nline] = lines[nline][1:]
+
+    return lines
+
+
+## The benchmarks
+# Each takes the dict of inputs from `prepare_inputs`
+def bench_parse_lines_into_df(inputs):
+    return TrialSpeak.parse_lines_into_df(inputs['lines'])
+
+def bench_parse_lines_into_df_malformed(inputs):
+    return TrialSpeak.parse_lines_into_df(inputs['malformed_lines'])
+
+def bench_read_logfile_into_df(inputs):
+    return TrialSpeak.read_logfile_into_df(inputs['filename'],
+        unsorted_times_action='ignore')
+
+def bench_make_trials_matrix_from_logfile_lines2(inputs):
+    return TrialSpeak.make_trials_matrix_from_logfile_lines2(inputs['lines'])
+
+def bench_split_by_trial(inputs):
+    return TrialSpeak.split_by_trial(inputs['lines'])
+
+def bench_split_by_trial_malformed(inputs):
+    return TrialSpeak.split_by_trial(inputs['malformed_lines'])
+
+def bench_make_trials_info_from_splines(inputs):
+    return TrialMatrix.make_trials_info_from_splines(inputs['splines'])
+
+def bench_count_rewards(inputs):
+    return plot.count_rewards(inputs['splines'])
+
+## Checks of the results
+# Each takes the result and the inputs, and raises ValueError if wrong
+def check_n_trials(n_trials, inputs):
+    if n_trials != inputs['n_trials']:
+        raise ValueError("found %d trials, expected %d" % (
+            n_trials, inputs['n_trials']))
+
+def check_trial_matrix(trial_matrix, inputs):
+    check_n_trials(len(trial_matrix), inputs)
+    TrialSpeak.translate_trial_matrix(trial_matrix)
+
+def check_splines(splines, inputs):
+    # The first is setup
+    check_n_trials(len(splines) - 1, inputs)
+
+def check_trials_info(trials_info, inputs):
+    check_n_trials(len(trials_info), inputs)
+
+# Name, function, the largest number of trials to run it on, and the
+# check of its result (or None). The per-trial paths are too slow to run
+# on the largest sessions.
+BENCHMARKS = [
+    ('parse_lines_into_df', bench_parse_lines_into_df, None, None),
+    ('parse_lines_into_df_malformed', bench_parse_lines_into_df_malformed,
+        None, None),
+    ('read_logfile_into_df', bench_read_logfile_into_df, None, None),
+    ('make_trials_matrix_from_logfile_lines2',
+        bench_make_trials_matrix_from_logfile_lines2, None,
+        check_trial_matrix),
+    ('split_by_trial', bench_split_by_trial, None, check_splines),
+    ('split_by_trial_malformed', bench_split_by_trial_malformed, None,
+        check_splines),
+    ('make_trials_info_from_splines', bench_make_trials_info_from_splines,
+        10000, check_trials_info),
+    ('count_rewards', bench_count_rewards, None, None),
+    ]
+
+
+## Running
+def prepare_inputs(n_trials, seed=0, tmpdir=None):
+    """Generate the lines and write them to a file.
+
+    Returns: dict with keys 'n_trials', 'lines', 'malformed_lines',
+        'splines', and 'filename'. The caller should remove 'filename'
+        when done.
+    """
+    lines = generate_ardulines(n_trials, seed=seed)
+    fd, filename = tempfile.mkstemp(prefix='ardulines.', dir=tmpdir)
+    with os.fdopen(fd, 'w') as fi:
+        fi.writelines(lines)
+    return {
+        'n_trials': n_trials,
+        'lines': lines,
+        'malformed_lines': generate_ardulines(n_trials, seed=seed,
+            malformed_rate=MALFORMED_RATE),
+        'splines': TrialSpeak.split_by_trial(lines),
+        'filename': filename,
+        }
+
+def time_call(func, inputs, repeat=3):
+    """Returns the best time (s) of `repeat` calls of func(inputs)"""
+    times = []
+    for n_repeat in range(repeat):
+        gc.collect()
+        t0 = timeit.default_timer()
+        func(inputs)
+        times.append(timeit.default_timer() - t0)
+    return min(times)
+
+def measure_peak_memory(func, inputs):
+    """Returns the peak memory (bytes) allocated during func(inputs)
+
+    Returns None if tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(inputs)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=3, only=None,
+    measure_memory=True, seed=0, verbose=True):
+    """Run each benchmark at each size.
+
+    sizes : list of numbers of trials
+    repeat : the best time of this many runs is reported
+    only : if not None, a list of benchmark names to run
+    measure_memory : if True, also measure the peak memory in a separate
+        call, because tracemalloc slows everything down
+
+    Returns: dict keyed by '<name>/<n_trials>'. Each value is a dict with
+        keys 'time' (s) and 'peak_memory' (bytes, or None), or 'error'
+        if the benchmark raised an exception or its result was wrong.
+    """
+    results = {}
+    for n_trials in sizes:
+        inputs = prepare_inputs(n_trials, seed=seed)
+        try:
+            for name, func, max_trials, check in BENCHMARKS:
+                if only is not None and name not in only:
+                    continue
+                if max_trials is not None and n_trials > max_trials:
+                    continue
+
+                key = '%s/%d' % (name, n_trials)
+                try:
+                    if check is not None:
+                        check(func(inputs), inputs)
+                    res = {'time': time_call(func, inputs, repeat=repeat)}
+                    if measure_memory:
+                        res['peak_memory'] = measure_peak_memory(func, inputs)
+                    else:
+                        res['peak_memory'] = None
+                except Exception as e:
+                    res = {'error': '%s: %s' % (type(e).__name__, str(e).strip())}
+                results[key] = res
+
+                if verbose:
+                    print(format_result(key, res))
+                    sys.stdout.flush()
+        finally:
+            os.remove(inputs['filename'])
+    return results
+
+def format_result(key, res):
+    """Returns a one-line string describing a result"""
+    if 'error' in res:
+        return '%-48s error: %s' % (key, res['error'])
+    s = '%-48s %10.4f s' % (key, res['time'])
+    if res.get('peak_memory') is not None:
+        s += ' %10.1f MB' % (res['peak_memory'] / 1e6)
+    return s
+
+
+## Baselines
+def save_baseline(results, filename):
+    """Write results to `filename` as JSON"""
+    with open(filename, 'w') as fi:
+        json.dump(results, fi, indent=4, sort_keys=True)
+
+def load_baseline(filename):
+    """Read results from `filename`"""
+    with open(filename) as fi:
+        return json.load(fi)
+
+def compare_to_baseline(results, baseline, tolerance=0.25):
+    """Compare results to baseline.
+
+    A time or peak memory more than `tolerance` (fractional) above the
+    baseline is a regression. So is an error on a benchmark that
+    succeeded in the baseline. Benchmarks missing from either are ignored.
+
+    Returns: list of strings describing each regression
+    """
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline or 'error' in baseline[key]:
+            continue
+        res, base = results[key], baseline[key]
+
+        if 'error' in res:
+            regressions.append('%s: %s' % (key, res['error']))
+            continue
+
+        for metric in ('time', 'peak_memory'):
+            if res.get(metric) is None or base.get(metric) is None:
+                continue
+            if res[metric] > base[metric] * (1 + tolerance):
+                regressions.append('%s: %s %0.4g vs baseline %0.4g' % (
+                    key, metric, res[metric], base[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the logfile parsers on synthetic ardulines')
+    parser.add_argument('--sizes', type=int, nargs='+',
+        default=list(DEFAULT_SIZES), help='numbers of trials')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', default=None,
+        help='names of benchmarks to run')
+    parser.add_argument('--no-memory', action='store_true',
+        help='do not measure peak memory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', default=None,
+        help='save results as a baseline to this file')
+    parser.add_argument('--compare', default=None, nargs='?',
+        const=DEFAULT_BASELINE,
+        help='compare results to the baseline in this file, by default '
+        'the stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = run_benchmarks(sizes=args.sizes, repeat=args.repeat,
+        only=args.only, measure_memory=not args.no_memory, seed=args.seed)
+
+    if args.save is not None:
+        save_baseline(results, args.save)
+
+    if args.compare is not None:
+        regressions = compare_to_baseline(results,
+            load_baseline(args.compare), tolerance=args.tolerance)
+        if len(regressions) > 0:
+            print("regressions:")
+            for regression in regressions:
+                print(regression)
+            sys.exit(1)
+        else:
+            print("no regressions")
@@ -9,6 +9,40 @@ import os
 import sys
 import errno
 import platform
+import re
+from .TrialSpeak import (get_trial_index_filename, pack_trial_index_record,
+    trial_index_token2kind, TRIAL_INDEX_START, TRIAL_INDEX_RESULTS,
+    start_trial_token, trial_result_token, reconnect_token)
+from .chunked_log import ChunkedLogWriter, get_chunked_log_filename
+from .event_store import EventSink, get_event_store_filename
+
+# Clock used for host receive times. Unlike time.time, this is not
+# affected by changes to the system clock.
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# A line from the device containing any of these shows that it has just
+# started, so anything received before it is left over from the previous
+# run. Every sketch prints "DBG begin setup" at the start of setup. A
+# sketch may also announce its protocol version with "HELLO <version>".
+READY_TOKENS = ('DBG begin setup', 'HELLO')
+hello_token = 'HELLO'
+
+# The reconnect marker, "<time> DBG RECONNECT <n_reconnects> <date>", is
+# written to the log when the device is reconnected. The time is the last
+# time received before the connection was lost, because the device was
+# reset and its clock restarts (see TrialSpeak.reconnect_token).
+
+# Written to the log for each write to the device that was lost when the
+# connection was, as "<time> DBG DROPPED <line>"
+dropped_token = 'DROPPED'
+
+# Seconds to wait before trying to reopen a lost port, doubling after
+# each failed attempt up to the maximum
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.
 
 ## From device to user
 def read_from_device(device):
@@ -32,6 +66,110 @@ def write_to_user(buffer, data):
         buffer.write(line)
     buffer.flush()
 
+class LogWriter(object):
+    """Buffers lines to a file and writes them according to a policy.
+    
+    Only complete lines are written, so that anything reading the file
+    never sees half a line. A line that was only partially received is
+    held until its newline arrives.
+    
+    The buffered lines are written with a single call and flushed when any
+    of the following is true:
+        * no policy is specified (the default), on every call to `write`
+        * `flush_interval` seconds have passed since the last flush
+        * `flush_bytes` bytes are buffered
+        * `flush_on_trial` and a trial boundary (TRL_START, TRL_RELEASED,
+          or TRLR) is buffered
+    If `fsync_on_results`, the file is also fsynced when a TRLR line is
+    written, so that the results of completed trials survive a crash.
+    
+    Call `write` on every update, even with no new lines, so that the 
+    interval is checked. Call `close` to write everything that is left.
+    """
+    def __init__(self, fi, flush_interval=None, flush_bytes=None,
+        flush_on_trial=False, fsync_on_results=False):
+        self.fi = fi
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.flush_on_trial = flush_on_trial
+        self.fsync_on_results = fsync_on_results
+        self.flush_every_write = (flush_interval is None and 
+            flush_bytes is None and not flush_on_trial)
+        
+        self.buffered_lines = []
+        self.n_buffered_bytes = 0
+        self.partial_line = ''
+        self.trial_boundary_buffered = False
+        self.results_buffered = False
+        self.last_flush_time = monotonic()
+        
+        # Counters
+        self.n_flushes = 0
+        self.n_fsyncs = 0
+    
+    def write(self, lines):
+        """Buffer `lines` and flush if the policy requires it.
+        
+        Returns : True if flushed
+        """
+        for line in lines:
+            if not line.endswith('\n'):
+                self.partial_line += line
+                continue
+            if self.partial_line:
+                line, self.partial_line = self.partial_line + line, ''
+            
+            self.buffered_lines.append(line)
+            self.n_buffered_bytes += len(line)
+            
+            # Check for trial boundaries
+            if 'TRL' in line:
+                sp_line = line.split(None, 2)
+                if len(sp_line) > 1:
+                    if sp_line[1] in ('TRL_START', 'TRL_RELEASED', 'TRLR'):
+                        self.trial_boundary_buffered = True
+                    if sp_line[1] == 'TRLR':
+                        self.results_buffered = True
+        
+        if len(self.buffered_lines) == 0:
+            return False
+        
+        if (self.flush_every_write or
+            (self.flush_on_trial and self.trial_boundary_buffered) or
+            (self.flush_bytes is not None and 
+                self.n_buffered_bytes >= self.flush_bytes) or
+            (self.flush_interval is not None and 
+                monotonic() - self.last_flush_time >= self.flush_interval)):
+            self.flush()
+            return True
+        return False
+    
+    def flush(self):
+        """Write and flush all buffered complete lines"""
+        if len(self.buffered_lines) > 0:
+            self.fi.write(''.join(self.buffered_lines))
+        self.fi.flush()
+        if self.fsync_on_results and self.results_buffered:
+            os.fsync(self.fi.fileno())
+            self.n_fsyncs += 1
+        
+        self.buffered_lines = []
+        self.n_buffered_bytes = 0
+        self.trial_boundary_buffered = False
+        self.results_buffered = False
+        self.last_flush_time = monotonic()
+        self.n_flushes += 1
+    
+    def close(self):
+        """Write everything, including any partial line, and flush.
+        
+        Does not close the file.
+        """
+        if self.partial_line:
+            self.buffered_lines.append(self.partial_line)
+            self.partial_line = ''
+        self.flush()
+
 
 ## From user to device
 def read_from_user(buffer, buffer_size=1024):
@@ -101,7 +239,12 @@ class Chatter(object):
     Call `main_loop` to iterate over `update` calls until CTRL+C is received.
     """
     def __init__(self, serial_port='/dev/ttyACM0', from_user='TO_DEV', 
-        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600):
+        to_user=None, to_user_dir=None, serial_timeout=0.01, baud_rate=9600,
+        record_host_times=False, record_trial_index=False,
+        flush_interval=None, flush_bytes=None, flush_on_trial=False,
+        fsync_on_results=False, echo_interval=None, compress_log=False,
+        record_events=False, ready_timeout=5., ready_tokens=READY_TOKENS,
+        reconnect=False):
         """Initialize a new Chatter.
         
         `serial_port` : where the device is located
@@ -109,6 +252,28 @@ class Chatter(object):
         `to_user` : name of file to print information from the device
             If None, autonames with the datetime
             If `to_user_dir` is not None, puts in that directory
+        `record_host_times` : if True, the host receive time of every
+            line from the device is written to a sidecar file named
+            `to_user` + '.host_times'. See clock_sync.py for the format.
+        `record_trial_index` : if True, the byte offset and time of each
+            trial boundary is written to a binary sidecar as the lines are
+            written. See TrialSpeak.read_trial_lines.
+        `flush_interval`, `flush_bytes`, `flush_on_trial`, 
+        `fsync_on_results` : when to write the lines from the device to 
+            `to_user`. See LogWriter. By default, on every update.
+        `echo_interval` : if not None, lines echoed to stdout are written
+            at most this often (s), instead of on every update.
+        `compress_log` : if True, a compressed copy of `to_user` is also
+            written in chunks aligned to trials, to `to_user` + '.gz'.
+            See chunked_log.py.
+        `record_events` : if True, the parsed lines are also inserted into
+            an SQLite database, `to_user` + '.sqlite'. See event_store.py.
+        `ready_timeout`, `ready_tokens` : wait at most `ready_timeout` 
+            seconds for the device to announce that it has started. See
+            `wait_for_device`. If None, wait for a fixed 2 s instead.
+        `reconnect` : if True, a lost serial port is reopened (see 
+            `handle_disconnect`) instead of raising an error, and the 
+            session continues in the same log. Otherwise errors are raised.
         """
         ## Set up TO_DEV
         platformName = platform.system() #Implementation will depend on OS...
@@ -138,12 +303,101 @@ class Chatter(object):
             self.ofi = file(to_user, 'w')
         else:
             self.ofi = open(to_user, 'w')
+        self.log_writer = LogWriter(self.ofi, flush_interval=flush_interval,
+            flush_bytes=flush_bytes, flush_on_trial=flush_on_trial,
+            fsync_on_results=fsync_on_results)
+        self.echo_writer = LogWriter(sys.stdout, flush_interval=echo_interval)
+        
+        ## Set up the compressed log
+        if compress_log:
+            self.chunked_log_writer = ChunkedLogWriter(
+                get_chunked_log_filename(to_user), 
+                boundary_token=start_trial_token)
+        else:
+            self.chunked_log_writer = None
+        
+        ## Set up the event store
+        if record_events:
+            self.event_sink = EventSink(get_event_store_filename(to_user),
+                start_trial_token=start_trial_token,
+                trial_result_token=trial_result_token)
+        else:
+            self.event_sink = None
+        
+        ## Set up the host times sidecar
+        # The first line anchors the monotonic clock to the wall clock
+        # Each subsequent line is the line number in `to_user` and the
+        # monotonic time at which that line was completely received.
+        if record_host_times:
+            self.host_times_fi = open(to_user + '.host_times', 'w')
+            self.host_times_fi.write('# wall_time %0.6f monotonic %0.6f\n' % (
+                time.time(), monotonic()))
+        else:
+            self.host_times_fi = None
+        self.n_complete_device_lines = 0
+        
+        ## Set up the trial index sidecar
+        if record_trial_index:
+            self.trial_index_fi = open(get_trial_index_filename(to_user), 'wb')
+        else:
+            self.trial_index_fi = None
+        
+        # Byte offset in `to_user` of the line being written. On Windows,
+        # every newline is written as two bytes.
+        self.line_offset = 0
+        self.partial_line = ''
+        self.n_newline_bytes = len(os.linesep)
+        self.trial_results_indexed = True
             
         ## Set up device
+        self.serial_port = serial_port
+        self.baud_rate = baud_rate
+        self.serial_timeout = serial_timeout
+        self.ready_timeout = ready_timeout
+        self.ready_tokens = ready_tokens
+        
+        # Lines received while waiting for the device, or written by the
+        # host, to be handled by the next update
+        self.ready_lines = []
+        self.device_version = None
+        self.n_stale_bytes = 0
+        self.connect_duration = None
+        self.open_device()
+        
+        ## Reconnecting
+        self.reconnect = reconnect
+        self.connected = True
+        self.n_disconnects = 0
+        self.n_reconnects = 0
+        self.disconnect_time = None
+        self.reconnect_delay = RECONNECT_MIN_DELAY
+        self.next_reconnect_time = None
+        self.last_device_line = None
+        self.last_device_time = None
+        
+        self.new_user_text = ''
+        self.new_device_lines = []
+        
+        # Check for acknowledged lines
+        self.last_sent_line = None
+        self.last_sent_line_acknowledged = True
+        self.queued_writes = []
+        
+        # Counters, used for instrumenting the main loop
+        # last_ack_rtt is the round-trip time of an ACK received during
+        # the most recent update, or None if none was received.
+        self.n_bytes_from_device = 0
+        self.n_bytes_to_device = 0
+        self.last_sent_time = None
+        self.last_ack_rtt = None
+
+    def open_device(self):
+        """Open the serial port and wait for the device to start"""
         # 0 means return whatever is available immediately
         # otherwise, wait for specified time
         # 0.01 takes a noticeable but small amount of CPU time
-        self.ser = serial.Serial(serial_port, baud_rate, timeout=serial_timeout)
+        self.ser = serial.Serial(self.serial_port, self.baud_rate, 
+            timeout=self.serial_timeout)
 
         # This should reset arduino with new serial connection
         if (platform.system().lower() == "darwin"):
@@ -152,9 +406,15 @@ class Chatter(object):
             self.ser.setDTR(True)
 
         # Wait for it to initialize the arduino
-        time.sleep(1) # without this sleep, still leftover input from previous run
-        self.ser.flushInput() # otherwise still input from previous run pending
-        time.sleep(1) # without this sleep, it will not send the first line or so to the device
+        connect_start = monotonic()
+        if self.ready_timeout is None:
+            time.sleep(1) # without this sleep, still leftover input from previous run
+            self.ser.flushInput() # otherwise still input from previous run pending
+            time.sleep(1) # without this sleep, it will not send the first line or so to the device
+        else:
+            self.wait_for_device(self.ready_timeout, self.ready_tokens)
+        self.connect_duration = monotonic() - connect_start
+        self.last_receive_time = monotonic()
         
         # these don't appear to be necessary??
         # actually, the chatter still picks up leftover input
@@ -162,14 +422,150 @@ class Chatter(object):
         # uncommenting the below lines doesn't seem to do anything.
         #~ self.ser.flush()
         #~ self.ser.flushOutput()
+
+    def handle_disconnect(self, error):
+        """Close the lost port and schedule attempts to reopen it.
         
-        self.new_user_text = ''
-        self.new_device_lines = []
+        Called by `update` when reading or writing fails, if `reconnect`.
+        Until the port is reopened, `update` does nothing else, and text
+        from the user waits in the pipe. Queued writes, and the last write
+        if it was not acknowledged, are dropped, because the device will be
+        reset. Each is written to the log and printed. The TrialSetter 
+        re-sends the params and the release (see TrialSetter.resync); 
+        other commands, such as a reward from the UI, are not re-sent.
+        """
+        print("warning: lost connection to %s: %s" % (self.serial_port, error))
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
         
-        # Check for acknowledged lines
-        self.last_sent_line = None
-        self.last_sent_line_acknowledged = True
+        # The last time received, to timestamp the reconnect marker
+        self.last_device_time = self.get_last_device_time()
+        
+        # Log the writes that are lost. While disconnected, host lines are
+        # written before the reconnect marker, in the old clock base.
+        dropped_writes = list(self.queued_writes)
+        if not self.last_sent_line_acknowledged:
+            dropped_writes = [self.last_sent_line] + dropped_writes
+        for line in dropped_writes:
+            print("warning: dropped write to device: %s" % line.strip())
+        self.write_host_lines(['%d DBG %s %s\n' % (self.last_device_time,
+            dropped_token, line.strip()) for line in dropped_writes])
+        
+        self.connected = False
+        self.n_disconnects += 1
+        self.disconnect_time = time.time()
+        self.reconnect_delay = RECONNECT_MIN_DELAY
+        self.next_reconnect_time = monotonic() + self.reconnect_delay
         self.queued_writes = []
+        self.last_sent_line_acknowledged = True
+
+    def try_reconnect(self):
+        """Try to reopen the port, and back off if it fails.
+        
+        On success, a reconnect marker is written to the log after any
+        lines written by the host while disconnected (such as the end of
+        the interrupted trial; see TrialSetter.end_interrupted_trial), and
+        before anything from the reset device.
+        
+        Returns : True if reconnected
+        """
+        host_lines, self.ready_lines = self.ready_lines, []
+        try:
+            self.open_device()
+        except (serial.SerialException, OSError):
+            self.ready_lines = host_lines
+            self.reconnect_delay = min(2 * self.reconnect_delay, 
+                RECONNECT_MAX_DELAY)
+            self.next_reconnect_time = monotonic() + self.reconnect_delay
+            return False
+        
+        self.connected = True
+        self.n_reconnects += 1
+        
+        # Finish any partially received line before the host lines. The
+        # newline is its own line, so that it is counted as the end of 
+        # that line (see write_host_times).
+        marker = '%d DBG %s %d %s\n' % (self.last_device_time, 
+            reconnect_token, self.n_reconnects, 
+            datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))
+        host_lines = host_lines + [marker]
+        if self.last_device_line is not None and not (
+            self.last_device_line.endswith('\n')):
+            host_lines = ['\n'] + host_lines
+        self.ready_lines = host_lines + self.ready_lines
+        
+        print("reconnected to %s after %0.1fs" % (self.serial_port, 
+            time.time() - self.disconnect_time))
+        return True
+
+    def get_last_device_time(self):
+        """Returns the time in the last line from the device, or -1"""
+        try:
+            return int(self.last_device_line.split()[0])
+        except (AttributeError, IndexError, ValueError):
+            return -1
+
+    def write_host_lines(self, lines):
+        """Add `lines` to the log, as if received from the device.
+        
+        They are handled by the next `update`, before anything else
+        received from the device.
+        """
+        self.ready_lines += lines
+
+    def wait_for_device(self, timeout=5., ready_tokens=READY_TOKENS):
+        """Wait for the device to announce that it has started.
+        
+        Lines are read until one contains any of `ready_tokens`, right
+        after a time, as the command. Those before it are left over from
+        the previous run and are discarded (their length is in 
+        `n_stale_bytes`). So is anything before the time on that line,
+        because the last line of the previous run may have no newline of
+        its own. The rest of the line and anything after it are kept in
+        `ready_lines` and handled by the next `update`. If it is a HELLO
+        line, the rest of it is stored as `device_version`.
+        
+        Returns : True if the device announced itself within `timeout` s.
+            Otherwise a warning is printed, all input received so far is 
+            discarded, and False is returned.
+        """
+        ready_re = re.compile(r'(\d+) (%s)(?=\s)' % '|'.join(
+            [re.escape(token) for token in ready_tokens]))
+        deadline = monotonic() + timeout
+        partial_line = b''
+        while monotonic() < deadline:
+            # Returns a partial line if serial_timeout expires first
+            data = self.ser.readline()
+            if not data.endswith(b'\n'):
+                partial_line += data
+                continue
+            line, partial_line = (partial_line + data).decode(
+                'utf-8', 'replace'), b''
+            
+            match = ready_re.search(line)
+            if match is None:
+                self.n_stale_bytes += len(line)
+                continue
+            
+            # Drop any stale bytes before the time
+            self.n_stale_bytes += match.start()
+            line = line[match.start():]
+            
+            # Check for a protocol version
+            sp_line = line.split()
+            if len(sp_line) > 2 and sp_line[1] == hello_token:
+                self.device_version = ' '.join(sp_line[2:])
+            
+            self.ready_lines = [line]
+            return True
+        
+        self.n_stale_bytes += len(partial_line)
+        self.ser.flushInput()
+        print("warning: device did not announce itself within %0.1fs" % 
+            timeout)
+        return False
 
     def update(self, echo_to_stdout=True):
         """Called repeatedly to deal with inputs and outputs
@@ -184,26 +580,67 @@ class Chatter(object):
         that this function will get stuck at reading from devices. Need some
         kind of maximum read size check for this. Alternatively, insert delays
         in the Arduino loop function.
+        
+        If `reconnect` and the port is lost, this only tries to reopen it
+        until it succeeds.
         """
+        self.last_ack_rtt = None
+        if not self.connected:
+            self.new_user_text = None
+            self.new_device_lines = []
+            if monotonic() < self.next_reconnect_time or (
+                not self.try_reconnect()):
+                return
         
-        # Read any new text from the user and send to device
-        self.new_user_text = read_from_user(self.pipein)
-        assert (
-            self.new_user_text is None or 
-            type(self.new_user_text) is str
-            )
-        write_to_device(self.ser, self.new_user_text)
+        try:
+            # Read any new text from the user and send to device
+            self.new_user_text = read_from_user(self.pipein)
+            assert (
+                self.new_user_text is None or 
+                type(self.new_user_text) is str
+                )
+            write_to_device(self.ser, self.new_user_text)
+            if self.new_user_text is not None:
+                self.n_bytes_to_device += len(self.new_user_text)
+            
+            # Read any new lines from the device and send to user
+            self.new_device_lines = read_from_device(self.ser)
+        except (serial.SerialException, OSError) as error:
+            if not self.reconnect:
+                raise
+            self.handle_disconnect(error)
+            self.new_device_lines = []
         
-        # Read any new lines from the device and send to user
-        self.new_device_lines = read_from_device(self.ser)
+        if len(self.new_device_lines) > 0:
+            self.last_receive_time = monotonic()
+        if len(self.ready_lines) > 0:
+            self.new_device_lines = self.ready_lines + self.new_device_lines
+            self.ready_lines = []
+        if len(self.new_device_lines) > 0:
+            self.last_device_line = self.new_device_lines[-1]
         for llline in self.new_device_lines:
             assert type(llline) is str
-        write_to_user(self.ofi, self.new_device_lines)
+            self.n_bytes_from_device += len(llline)
+        flushed = self.log_writer.write(self.new_device_lines)
+        
+        # The sidecars are flushed along with the logfile, so that they
+        # do not get ahead of it
+        if self.host_times_fi is not None:
+            self.write_host_times(self.new_device_lines)
+            if flushed:
+                self.host_times_fi.flush()
+        if self.trial_index_fi is not None:
+            self.write_trial_index(self.new_device_lines)
+            if flushed:
+                self.trial_index_fi.flush()
+        if self.chunked_log_writer is not None:
+            self.chunked_log_writer.write(self.new_device_lines)
+        if self.event_sink is not None:
+            self.event_sink.write(self.new_device_lines)
         
         # Echo
         if echo_to_stdout:
-            write_to_user(sys.stdout, self.new_device_lines)
-            sys.stdout.flush()
+            self.echo_writer.write(self.new_device_lines)
         
         # Check whether last_sent_command was acknowledged
         # Note that we always write to device (potentially setting
@@ -216,14 +653,79 @@ class Chatter(object):
                 # Should probably separate this logic somehow.
                 if line.strip().endswith('ACK ' + self.last_sent_line):
                     self.last_sent_line_acknowledged = True
+                    self.last_ack_rtt = time.time() - self.last_sent_time
         
         # Send a queued write if ready
-        if self.last_sent_line_acknowledged and len(self.queued_writes) > 0:            
-            self.write_to_device(self.queued_writes.pop(0))
+        if (self.connected and self.last_sent_line_acknowledged and 
+            len(self.queued_writes) > 0):
+            try:
+                self.write_to_device(self.queued_writes.pop(0))
+            except (serial.SerialException, OSError) as error:
+                if not self.reconnect:
+                    raise
+                self.handle_disconnect(error)
 
+    def write_host_times(self, new_device_lines):
+        """Write the receive time of each complete line to the sidecar.
+        
+        The sidecar is not flushed here; see `update`.
+        
+        A line that was only partially received (because the read timed
+        out) is continued by the next read, so it is only counted, and
+        timed, once its newline arrives.
+        """
+        receive_time = monotonic()
+        for line in new_device_lines:
+            if line.endswith('\n'):
+                self.host_times_fi.write('%d %0.6f\n' % (
+                    self.n_complete_device_lines, receive_time))
+                self.n_complete_device_lines += 1
+    
+    def write_trial_index(self, new_device_lines):
+        """Write a record to the trial index for each trial boundary.
+        
+        Partially received lines are accumulated until their newline 
+        arrives, keeping track of the byte offset of the start of each line.
+        Only the first TRLR line after each TRL_START is recorded.
+        The sidecar is not flushed here; see `update`.
+        """
+        for line in new_device_lines:
+            self.partial_line += line
+            if not self.partial_line.endswith('\n'):
+                continue
+            line, self.partial_line = self.partial_line, ''
+            
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] in trial_index_token2kind:
+                kind = trial_index_token2kind[sp_line[1]]
+                if kind == TRIAL_INDEX_START:
+                    self.trial_results_indexed = False
+                if kind != TRIAL_INDEX_RESULTS or not self.trial_results_indexed:
+                    try:
+                        arduino_time = int(sp_line[0])
+                    except ValueError:
+                        arduino_time = -1
+                    self.trial_index_fi.write(pack_trial_index_record(
+                        self.line_offset, arduino_time, kind))
+                if kind == TRIAL_INDEX_RESULTS:
+                    self.trial_results_indexed = True
+            
+            self.line_offset += (len(line.encode('utf-8')) + 
+                line.count('\n') * (self.n_newline_bytes - 1))
+    
     def close(self):
         self.ser.close()
+        self.log_writer.close()
+        self.echo_writer.close()
         self.ofi.close()
+        if self.host_times_fi is not None:
+            self.host_times_fi.close()
+        if self.trial_index_fi is not None:
+            self.trial_index_fi.close()
+        if self.chunked_log_writer is not None:
+            self.chunked_log_writer.close()
+        if self.event_sink is not None:
+            self.event_sink.close()
         #pipein.close()
     
     def queued_write_to_device(self, s):
@@ -244,10 +746,12 @@ class Chatter(object):
         """
         self.last_sent_line = s 
         self.last_sent_line_acknowledged = False
+        self.last_sent_time = time.time()
         
         if auto_newline and not s.endswith('\n'):
             s = s + '\n'
         write_to_device(self.ser, s)
+        self.n_bytes_to_device += len(s)
 
 
 def loop_till_interrupt(chatter):
@@ -0,0 +1,206 @@
+"""Compressed logfiles in chunks aligned to trial boundaries.
+
+The Chatter can write a compressed copy of the logfile as it runs (see
+the `compress_log` argument of Chatter). The compressed log is a series of
+independently compressed gzip members, each beginning at the start of a
+trial, so the whole file can still be read by gzip or zcat.
+
+Each chunk is described by a record in a binary index next to the
+compressed log, so that individual trials can be read without
+decompressing the whole file:
+    offset : byte offset of the chunk in the compressed log
+    size : compressed size of the chunk in bytes
+    first_trial : number of trials started before this chunk
+    n_lines : number of lines in the chunk
+
+A chunk is only written once the next one begins, so while a session is
+running the compressed log lags behind the raw logfile by up to one chunk.
+
+Usage:
+    lines = chunked_log.read_lines(logfilename + '.gz')
+or, transparently:
+    lines = TrialSpeak.read_lines_from_file(logfilename + '.gz')
+"""
+from __future__ import print_function
+from builtins import object
+import os
+import gzip
+import zlib
+import numpy as np
+
+CHUNK_INDEX_DTYPE = np.dtype([
+    ('offset', '<i8'), ('size', '<i8'), ('first_trial', '<i8'),
+    ('n_lines', '<i8')])
+
+# Extension of the compressed log, and of its index
+CHUNKED_LOG_SUFFIX = '.gz'
+CHUNK_INDEX_SUFFIX = '.chunks'
+
+# Offset to wbits that selects the gzip format in zlib
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_chunked_log_filename(logfilename):
+    """Returns the name of the compressed version of `logfilename`"""
+    return logfilename + CHUNKED_LOG_SUFFIX
+
+def get_chunk_index_filename(filename):
+    """Returns the name of the index of the compressed log `filename`"""
+    return filename + CHUNK_INDEX_SUFFIX
+
+def is_chunked_log(filename):
+    """Returns True if `filename` is named like a compressed log"""
+    return filename.endswith(CHUNKED_LOG_SUFFIX)
+
+def compress_chunk(data, compresslevel=6):
+    """Compress the bytes `data` into a single gzip member"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def decompress_chunk(data):
+    """Decompress a single gzip member into text"""
+    return zlib.decompress(data, GZIP_WBITS).decode('utf-8')
+
+
+class ChunkedLogWriter(object):
+    """Writes lines to a compressed log in chunks aligned to trials.
+
+    A new chunk is begun at the start of a trial once the current chunk
+    holds `chunk_trials` trials or `chunk_bytes` uncompressed bytes.
+    Partially received lines are held until their newline arrives.
+
+    Call `close_chunk` to write the current chunk immediately, for
+    instance before copying the compressed log. Call `close` at the end.
+    """
+    def __init__(self, filename, chunk_trials=20, chunk_bytes=2 ** 20,
+        compresslevel=6, boundary_token='TRL_START'):
+        self.filename = filename
+        self.chunk_trials = chunk_trials
+        self.chunk_bytes = chunk_bytes
+        self.compresslevel = compresslevel
+        self.boundary_token = boundary_token
+
+        self.fi = open(filename, 'wb')
+        self.index_fi = open(get_chunk_index_filename(filename), 'wb')
+
+        self.chunk_lines = []
+        self.n_chunk_bytes = 0
+        self.n_chunk_trials = 0
+        self.chunk_first_trial = 0
+        self.n_trials_started = 0
+        self.partial_line = ''
+        self.offset = 0
+
+    def write(self, lines):
+        """Add lines, writing a chunk whenever a full one is followed by
+        the start of a trial.
+        """
+        for line in lines:
+            if not line.endswith('\n'):
+                self.partial_line += line
+                continue
+            if self.partial_line:
+                line, self.partial_line = self.partial_line + line, ''
+
+            # Check for the start of a trial
+            sp_line = line.split(None, 2)
+            if len(sp_line) > 1 and sp_line[1] == self.boundary_token:
+                if (self.n_chunk_trials >= self.chunk_trials or
+                    self.n_chunk_bytes >= self.chunk_bytes):
+                    self.close_chunk()
+                self.n_chunk_trials += 1
+                self.n_trials_started += 1
+
+            self.chunk_lines.append(line)
+            self.n_chunk_bytes += len(line)
+
+    def close_chunk(self):
+        """Compress and write the current chunk and its index record"""
+        if len(self.chunk_lines) == 0:
+            return
+
+        data = compress_chunk(''.join(self.chunk_lines).encode('utf-8'),
+            self.compresslevel)
+        self.fi.write(data)
+        self.fi.flush()
+
+        record = np.array([(self.offset, len(data), self.chunk_first_trial,
+            len(self.chunk_lines))], dtype=CHUNK_INDEX_DTYPE)
+        self.index_fi.write(record.tobytes())
+        self.index_fi.flush()
+
+        self.offset += len(data)
+        self.chunk_lines = []
+        self.n_chunk_bytes = 0
+        self.n_chunk_trials = 0
+        self.chunk_first_trial = self.n_trials_started
+
+    def close(self):
+        """Write everything, including any partial line, and close"""
+        if self.partial_line:
+            self.chunk_lines.append(self.partial_line)
+            self.partial_line = ''
+        self.close_chunk()
+        self.fi.close()
+        self.index_fi.close()
+
+
+## Reading functions
+def read_chunk_index(filename):
+    """Returns the chunk index of the compressed log `filename`.
+
+    Returns None if there is no index. A partially written record at the
+    end is ignored.
+    """
+    index_filename = get_chunk_index_filename(filename)
+    if not os.path.exists(index_filename):
+        return None
+    with open(index_filename, 'rb') as fi:
+        data = fi.read()
+    n_records = len(data) // CHUNK_INDEX_DTYPE.itemsize
+    return np.frombuffer(data[:n_records * CHUNK_INDEX_DTYPE.itemsize],
+        dtype=CHUNK_INDEX_DTYPE)
+
+def read_chunks(filename, start_chunk=0, stop_chunk=None, index=None):
+    """Read and decompress some of the chunks of a compressed log.
+
+    index : from read_chunk_index. If None, it is read.
+
+    Returns : list of lines, from the start of `start_chunk` to the start
+        of `stop_chunk`, or to the end if `stop_chunk` is None
+    """
+    if index is None:
+        index = read_chunk_index(filename)
+    if index is None:
+        raise IOError("no chunk index for %s" % filename)
+
+    records = index[start_chunk:stop_chunk]
+    if len(records) == 0:
+        return []
+
+    # The chunks are contiguous, so read them all at once
+    start = records['offset'][0]
+    stop = records['offset'][-1] + records['size'][-1]
+    with open(filename, 'rb') as fi:
+        fi.seek(start)
+        data = fi.read(stop - start)
+
+    lines = []
+    for offset, size in zip(records['offset'], records['size']):
+        chunk_start = offset - start
+        lines += decompress_chunk(
+            data[chunk_start:chunk_start + size]).splitlines(True)
+    return lines
+
+def read_lines(filename):
+    """Reads all lines from a compressed log and returns as list.
+
+    Only the chunks in the index are read, so this works on a compressed
+    log that is still being written. Without an index, the whole file is
+    decompressed with gzip.
+    """
+    index = read_chunk_index(filename)
+    if index is None:
+        with gzip.open(filename, 'rb') as fi:
+            return fi.read().decode('utf-8').splitlines(True)
+    return read_chunks(filename, index=index)
@@ -0,0 +1,203 @@
+"""Align the Arduino clock with the host clock.
+
+Times in the logfile come from millis() on the Arduino, which starts at
+zero on reset and drifts relative to the host clock by tens of ppm. To
+sync behavior with video or the manipulator log, the Chatter can record
+the host receive time of every line in a sidecar file (see the
+`record_host_times` argument of Chatter). The format of the sidecar is:
+    # wall_time <time.time()> monotonic <monotonic time>
+    <line number> <monotonic receive time>
+    ...
+where the line number indexes the lines of the logfile.
+
+Each receive time is the true send time plus a positive and variable
+delay (serial buffering, USB polling, the main loop). So the clock
+relation is fit to the lower envelope of the host-vs-Arduino times, not
+to their mean.
+
+Usage:
+    fit = fit_session(logfilename)
+    tm = add_host_times_to_trial_matrix(tm, fit)
+"""
+from __future__ import print_function
+from __future__ import division
+import numpy as np
+import pandas
+from . import TrialSpeak
+
+
+def get_sidecar_filename(logfilename):
+    """Returns the name of the host times sidecar for `logfilename`"""
+    return logfilename + '.host_times'
+
+def read_host_times(filename):
+    """Read a host times sidecar.
+
+    Returns: line_numbers, host_times, anchor
+        line_numbers : int array of logfile line numbers
+        host_times : float array of monotonic receive times (s)
+        anchor : dict with keys 'wall_time' and 'monotonic', or None
+            if the header is missing
+    """
+    # Parse the anchor from the header
+    anchor = None
+    with open(filename) as fi:
+        header = fi.readline().split()
+    if len(header) == 5 and header[0] == '#':
+        anchor = {
+            header[1]: float(header[2]),
+            header[3]: float(header[4]),
+            }
+
+    # Parse the data
+    data = np.loadtxt(filename, comments='#', ndmin=2)
+    if len(data) == 0:
+        return np.array([], dtype=np.int), np.array([]), anchor
+    return data[:, 0].astype(np.int), data[:, 1], anchor
+
+def get_arduino_times(logfile_lines, is_reconnect=None):
+    """Returns the Arduino time (s) of every line, or nan if unparseable
+
+    Times after a reconnect marker continue from before it, as in the
+    trial matrix (see TrialSpeak.get_reconnect_offsets).
+
+    is_reconnect : from TrialSpeak.find_reconnect_lines, or None to find
+        the reconnect markers here
+    """
+    times = pandas.to_numeric(
+        pandas.Series(logfile_lines, dtype=np.object).str.split(
+        ' ', n=1).str[0], errors='coerce').values.astype(np.float)
+    if is_reconnect is None:
+        is_reconnect = TrialSpeak.find_reconnect_lines(logfile_lines)
+    times = times + TrialSpeak.get_reconnect_offsets(times, is_reconnect)
+    return times / 1000.
+
+def fit_clock_drift(arduino_times, host_times, n_iterations=5,
+    envelope_quantile=0.2, outlier_thresh=10.):
+    """Fit host_time = offset + slope * arduino_time
+
+    arduino_times, host_times : arrays of the same length (s)
+        Pairs containing nan are ignored.
+    n_iterations : number of refits to the lower envelope
+    envelope_quantile : after each fit, only the points with residuals
+        in this lower quantile are used for the next fit
+    outlier_thresh : points whose residuals are further than this many
+        median absolute deviations from the median are discarded at each
+        iteration. This removes lines with corrupted times.
+
+    Returns: dict with keys
+        'offset' : host time when the Arduino clock was zero (s)
+        'slope' : host seconds per Arduino second
+        'drift_ppm' : (slope - 1) * 1e6
+        'resid_std' : std of the residuals of the points used (s)
+        'n_points' : number of valid pairs
+        'n_used' : number of pairs used in the final fit
+    """
+    arduino_times = np.asarray(arduino_times, dtype=np.float)
+    host_times = np.asarray(host_times, dtype=np.float)
+    valid = np.isfinite(arduino_times) & np.isfinite(host_times)
+    x = arduino_times[valid]
+    y = host_times[valid]
+    if len(x) < 2 or np.ptp(x) == 0:
+        raise ValueError("need at least two distinct times to fit")
+
+    # Initial fit to everything
+    mask = np.ones(len(x), dtype=np.bool)
+    slope, offset = np.polyfit(x, y, 1)
+
+    for n_iteration in range(n_iterations):
+        resid = y - (offset + slope * x)
+
+        # Drop gross outliers
+        median = np.median(resid)
+        mad = np.median(np.abs(resid - median))
+        inliers = np.abs(resid - median) <= outlier_thresh * max(mad, 1e-6)
+
+        # Keep the lower envelope of the inliers
+        thresh = np.percentile(resid[inliers], 100 * envelope_quantile)
+        new_mask = inliers & (resid <= thresh)
+        if new_mask.sum() < 2 or np.ptp(x[new_mask]) == 0:
+            break
+
+        mask = new_mask
+        slope, offset = np.polyfit(x[mask], y[mask], 1)
+
+    resid = y[mask] - (offset + slope * x[mask])
+    return {
+        'offset': float(offset),
+        'slope': float(slope),
+        'drift_ppm': float((slope - 1) * 1e6),
+        'resid_std': float(np.std(resid)),
+        'n_points': int(len(x)),
+        'n_used': int(mask.sum()),
+        }
+
+def fit_session(logfilename, host_times_filename=None, **kwargs):
+    """Fit the clock relation for a session.
+
+    logfilename : the ardulines
+    host_times_filename : the sidecar. If None, uses the default name.
+    kwargs : passed to fit_clock_drift
+
+    Returns: the dict from fit_clock_drift, plus 'anchor' from the sidecar
+    """
+    if host_times_filename is None:
+        host_times_filename = get_sidecar_filename(logfilename)
+
+    logfile_lines = TrialSpeak.read_lines_from_file(logfilename)
+    line_numbers, host_times, anchor = read_host_times(host_times_filename)
+
+    # Ignore lines in the sidecar that are not in the logfile, which
+    # happens if the logfile was not flushed
+    keep = line_numbers < len(logfile_lines)
+    is_reconnect = TrialSpeak.find_reconnect_lines(logfile_lines)
+    arduino_times = get_arduino_times(logfile_lines, is_reconnect)[
+        line_numbers[keep]]
+
+    # Only use the times since the last Arduino reset. This is after the
+    # last reconnect marker, or when millis goes backwards by more than a
+    # second and stays there. A single corrupted line also goes backwards,
+    # but then jumps forward again.
+    diffs = np.diff(arduino_times)
+    resets = np.where(
+        (diffs[:-1] < -1.) & (np.abs(diffs[1:]) < 1.))[0]
+    start = resets[-1] + 1 if len(resets) > 0 else 0
+    reconnects = np.flatnonzero(is_reconnect[line_numbers[keep]])
+    if len(reconnects) > 0:
+        start = max(start, reconnects[-1] + 1)
+
+    fit = fit_clock_drift(arduino_times[start:], host_times[keep][start:],
+        **kwargs)
+    fit['anchor'] = anchor
+    return fit
+
+def arduino_to_host(arduino_times, fit):
+    """Convert Arduino times (s) to monotonic host times (s)"""
+    return fit['offset'] + fit['slope'] * np.asarray(arduino_times)
+
+def host_to_wall(host_times, anchor):
+    """Convert monotonic host times (s) to wall clock times (s since epoch)
+
+    anchor : from read_host_times, or the 'anchor' key of fit_session
+    """
+    return anchor['wall_time'] + (np.asarray(host_times) - anchor['monotonic'])
+
+def add_host_times_to_trial_matrix(trial_matrix, fit,
+    columns=('start_time', 'release_time')):
+    """Add host and wall clock versions of time columns to trial matrix.
+
+    For each column in `columns` that is present, adds `column`_host,
+    and also `column`_wall if `fit` has an anchor.
+
+    Returns: trial_matrix, with the new columns added in place
+    """
+    anchor = fit.get('anchor')
+    for column in columns:
+        if column not in trial_matrix.columns:
+            continue
+        host_times = arduino_to_host(
+            trial_matrix[column].values.astype(np.float), fit)
+        trial_matrix[column + '_host'] = host_times
+        if anchor is not None:
+            trial_matrix[column + '_wall'] = host_to_wall(host_times, anchor)
+    return trial_matrix
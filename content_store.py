@@ -0,0 +1,159 @@
+"""Share unchanged files between sandboxes through a content store.
+
+Every session gets a new sandbox containing a copy of the protocol, and
+a '-saved' copy of the whole session directory at the end. Most of these
+files are the same from session to session, so rather than copying them,
+each file is stored once under the hash of its contents and hardlinked
+into place. The store is in the sandbox root, so that it is on the same
+filesystem as the sandboxes (see get_store_dir):
+    <sandbox_root>/.content_store/ab/abcdef...
+
+If a hardlink cannot be made (eg, the store is on another filesystem, or
+the filesystem does not support them), the file is copied instead.
+
+Because hardlinked files share their contents, a file in a sandbox must
+be replaced (written to a new file, or removed first), never edited in
+place, or the change would appear in every sandbox linked to it. To
+prevent this, stored files are read-only, and a stored file is checked
+against its hash before it is reused.
+
+Usage:
+    store_dir = content_store.get_store_dir(sandbox_root)
+    content_store.copy_file(protocol_filename, sandbox_filename, store_dir)
+    content_store.save_tree(session_dir, session_dir + '-saved')
+"""
+from __future__ import print_function
+import os
+import stat
+import shutil
+import hashlib
+
+# Where stored files are kept, by hash, if no sandbox root is given
+CONTENT_STORE_DIR = '~/sandbox_root/.content_store'
+
+# Stored files are read-only
+STORED_FILE_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def get_store_dir(sandbox_root):
+    """Returns the content store for the sandboxes in `sandbox_root`"""
+    return os.path.join(sandbox_root, '.content_store')
+
+
+def hash_file(filename):
+    """Returns the sha256 hex digest of the contents of `filename`"""
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as fi:
+        for block in iter(lambda: fi.read(2 ** 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def get_store_filename(digest, store_dir=CONTENT_STORE_DIR):
+    """Returns the name of the stored file with hex digest `digest`"""
+    return os.path.join(os.path.expanduser(store_dir), digest[:2], digest)
+
+def remove_file(filename):
+    """Remove `filename`, even if it is read-only"""
+    try:
+        os.remove(filename)
+    except OSError:
+        # Windows does not remove read-only files
+        os.chmod(filename, stat.S_IWRITE)
+        os.remove(filename)
+
+def link_or_copy(src, dst):
+    """Hardlink `src` to `dst`, or copy it if that is not possible.
+
+    Any existing `dst` is replaced. A copy is always writable, even if
+    `src` is a read-only stored file, because it is not shared.
+
+    Returns : True if linked, False if copied
+    """
+    if os.path.lexists(dst):
+        remove_file(dst)
+    try:
+        os.link(src, dst)
+        return True
+    except (OSError, AttributeError):
+        # Another filesystem, or no hardlinks on this platform
+        shutil.copy2(src, dst)
+        os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+        return False
+
+def add_file(filename, store_dir=CONTENT_STORE_DIR):
+    """Put `filename` in the content store, if it is not already there.
+
+    The file is copied, not linked, because the original may be edited in
+    place. It is written under a temporary name, made read-only, and
+    renamed, so that a partially written file is never used.
+
+    Returns : the name of the stored file
+    """
+    digest = hash_file(filename)
+    store_filename = get_store_filename(digest, store_dir)
+
+    # A stored file that no longer matches its hash has been edited in
+    # place despite being read-only; replace it
+    if os.path.exists(store_filename):
+        if hash_file(store_filename) == digest:
+            return store_filename
+        print("warning: replacing corrupted stored file %s" % store_filename)
+
+    store_subdir = os.path.dirname(store_filename)
+    if not os.path.exists(store_subdir):
+        try:
+            os.makedirs(store_subdir)
+        except OSError:
+            # Made by another session at the same time
+            if not os.path.isdir(store_subdir):
+                raise
+
+    temp_filename = '%s.%d.tmp' % (store_filename, os.getpid())
+    shutil.copyfile(filename, temp_filename)
+    os.chmod(temp_filename, STORED_FILE_MODE)
+    if os.path.exists(store_filename):
+        remove_file(store_filename)
+    os.rename(temp_filename, store_filename)
+    return store_filename
+
+def copy_file(src, dst, store_dir=CONTENT_STORE_DIR):
+    """Copy `src` to `dst` by linking to its stored copy.
+
+    Falls back to an ordinary copy if the content store cannot be used.
+    """
+    try:
+        store_filename = add_file(src, store_dir)
+    except (IOError, OSError) as e:
+        print("warning: cannot use content store: %s" % e)
+        if os.path.lexists(dst):
+            remove_file(dst)
+        shutil.copyfile(src, dst)
+        return
+    link_or_copy(store_filename, dst)
+
+def save_tree(src, dst, ignore=None):
+    """Save a copy of directory `src` as `dst`, hardlinking every file.
+
+    The copy is made under a temporary name and then renamed to `dst`,
+    so `dst` either does not exist or is complete. Files still being
+    written in `src` (eg the logfile) are shared with `dst`, so `dst`
+    receives everything written to them until they are closed. This
+    does not use the content store, whose files are already shared by
+    the links in `src`.
+
+    ignore : passed to shutil.copytree
+
+    Raises IOError if `dst` already exists.
+    """
+    if os.path.exists(dst):
+        raise IOError("%s already exists" % dst)
+
+    # Hidden, so it is not taken for a sandbox. May be left over from an
+    # interrupted save.
+    dst_dir, dst_name = os.path.split(os.path.abspath(dst))
+    temp_dst = os.path.join(dst_dir, '.%s.tmp' % dst_name)
+    if os.path.exists(temp_dst):
+        shutil.rmtree(temp_dst)
+
+    shutil.copytree(src, temp_dst, ignore=ignore, copy_function=link_or_copy)
+    os.rename(temp_dst, dst)
@@ -0,0 +1,384 @@
+"""Software device that speaks TrialSpeak over a pseudo-terminal.
+
+This is a stand-in for an Arduino running a TwoChoice-like protocol. It
+opens a Linux pty and behaves like the sketches in this repository: every
+received line is echoed back as an ACK, SET and ACT commands are handled,
+and each RELEASE_TRL runs one simulated trial that emits TRL_RELEASED,
+TRL_START, TRLP, ST_CHG, TCH, EV and TRLR lines. A DBG line is announced
+every second, just like `communications` in libraries/chat. Until the
+host first writes, the announcement is the boot banner "DBG begin setup"
+instead, because a Chatter waits for the banner and the host discards
+anything sent before it opens the port.
+
+The path of the slave side of the pty (or a symlink to it) can be used as
+the `serial_port` for a Chatter, so the full session loop can be run and
+benchmarked on machines without any boards attached.
+
+Example:
+    python -m ArduFSM.emulator --link /tmp/ttyFAKE0
+Then set serial_port to /tmp/ttyFAKE0 in the runner parameters.
+
+The emulator also keeps track of the release latency: the host time
+between reporting the results of a trial (TRLR) and receiving the
+RELEASE_TRL for the next one. This is the time the Python side spends
+deciding on the next trial, and is summarized by `summary`.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import str
+from builtins import object
+import os
+import sys
+import time
+import errno
+import select
+import random
+import argparse
+import numpy as np
+from .TrialSpeak import (ack_token, release_trial_token, trial_released_token,
+    start_trial_token, trial_param_token, trial_result_token,
+    LEFT, RIGHT, NOGO, HIT, ERROR, SPOIL)
+
+# States, numbered as in TwoChoice/States.h
+WAIT_TO_START_TRIAL = 0
+TRIAL_START = 1
+RESPONSE_WINDOW = 7
+REWARD_L = 8
+REWARD_R = 9
+INTER_TRIAL_INTERVAL = 13
+ERROR_STATE = 14
+
+# Params that TwoChoice reports on every trial with TRLP
+TWOCHOICE_REPORTED_PARAMS = ('STPPOS', 'RWSD', 'SRVPOS', 'ISRND',
+    'DIRDEL', 'OPTO')
+
+# Same for LickTrain
+LICKTRAIN_REPORTED_PARAMS = ('RWSD', 'MRT')
+
+
+class TrialSpeakEmulator(object):
+    """Emulates an Arduino speaking TrialSpeak on a pseudo-terminal.
+
+    Call `update` repeatedly (or `run`) to handle input from the host and
+    advance the simulated trials. Call `close` to shut down the pty.
+    """
+    def __init__(self, link_name=None, trial_duration=2.0,
+        inter_trial_interval=0.5, hit_rate=0.7, spoil_rate=0.05,
+        touch_rate=2.0, dbg_rate=0.0, dbg_interval=1.0,
+        reported_params=TWOCHOICE_REPORTED_PARAMS, seed=None):
+        """Initialize a new emulator and open the pty.
+
+        link_name : if not None, a symlink to the slave side of the pty
+            is created with this name. Any existing file is replaced.
+        trial_duration : seconds between TRL_START and the response
+        inter_trial_interval : seconds between the response and the point
+            at which the next trial may start
+        hit_rate : probability that a non-spoiled trial is a hit
+        spoil_rate : probability that a trial is spoiled (NOGO response)
+        touch_rate : mean number of TCH events per second during trials
+        dbg_rate : mean number of extra DBG noise lines per second
+        dbg_interval : seconds between the regular DBG time announcements
+        reported_params : params reported with TRLP on every trial.
+            Params that have not been SET are reported as 0.
+        seed : seed for the random number generator
+        """
+        # Imported here because they are only available on Unix
+        import tty
+
+        ## Set up the pty
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        # Optionally link to it with a more memorable name
+        self.link_name = link_name
+        if self.link_name is not None:
+            if os.path.lexists(self.link_name):
+                os.remove(self.link_name)
+            os.symlink(self.port, self.link_name)
+
+        ## Timing and behavior
+        self.trial_duration = trial_duration
+        self.inter_trial_interval = inter_trial_interval
+        self.hit_rate = hit_rate
+        self.spoil_rate = spoil_rate
+        self.touch_rate = touch_rate
+        self.dbg_rate = dbg_rate
+        self.dbg_interval = dbg_interval
+        self.reported_params = list(reported_params)
+        self.rng = random.Random(seed)
+
+        ## State
+        self.start_time = time.time()
+        self.params = {}
+        self.receive_buffer = b''
+        self.flag_start_trial = False
+        self.current_state = WAIT_TO_START_TRIAL
+        self.state_exit_time = None
+        self.speak_at = self.dbg_interval
+        self.last_update_time = 0.
+        self.n_trials = 0
+        self.n_bytes_written = 0
+
+        ## Release latency
+        self.results_reported_time = None
+        self.release_latencies = []
+
+        # Whether anything has been received from the host
+        self.host_connected = False
+
+        self.write_line('DBG begin setup')
+
+    ## Time and output
+    def millis(self):
+        """Milliseconds since the emulator was started"""
+        return int((time.time() - self.start_time) * 1000)
+
+    def write_line(self, s, time_ms=None):
+        """Write `s` to the host, prefixed by the time"""
+        if time_ms is None:
+            time_ms = self.millis()
+        data = ('%d %s\n' % (time_ms, s)).encode('utf-8')
+        os.write(self.master_fd, data)
+        self.n_bytes_written += len(data)
+
+    def change_state(self, next_state):
+        """Announce a state change with ST_CHG and ST_CHG2"""
+        time_ms = self.millis()
+        self.write_line('ST_CHG %d %d' % (self.current_state, next_state),
+            time_ms)
+        self.write_line('ST_CHG2 %d %d' % (self.current_state, next_state),
+            time_ms)
+        self.current_state = next_state
+
+    ## Input
+    def read_lines_from_host(self):
+        """Return a list of complete lines received from the host"""
+        lines = []
+        while True:
+            readable, _, _ = select.select([self.master_fd], [], [], 0)
+            if len(readable) == 0:
+                break
+            try:
+                data = os.read(self.master_fd, 1024)
+            except OSError as err:
+                # EIO happens when the host side is not open
+                if err.errno in (errno.EIO, errno.EAGAIN):
+                    break
+                raise
+            if len(data) == 0:
+                break
+            self.receive_buffer += data
+
+        # Split off the complete lines and keep the remainder
+        while b'\n' in self.receive_buffer:
+            line, self.receive_buffer = self.receive_buffer.split(b'\n', 1)
+            lines.append(line.decode('utf-8').strip())
+
+        return lines
+
+    def handle_line(self, line):
+        """ACK `line` and act on it, as in handle_chat and take_action"""
+        if len(line) == 0:
+            return
+        self.write_line('%s %s' % (ack_token, line))
+
+        sp_line = line.split()
+        if sp_line[0] == 'SET':
+            if len(sp_line) != 3:
+                self.write_line('DBG RC_ERR 3')
+                return
+            try:
+                self.params[sp_line[1]] = int(sp_line[2])
+            except ValueError:
+                self.write_line('ERR SIC cannot parse -%s-' % sp_line[2])
+
+        elif sp_line[0] == release_trial_token:
+            self.flag_start_trial = True
+            if self.results_reported_time is not None:
+                self.release_latencies.append(
+                    time.time() - self.results_reported_time)
+                self.results_reported_time = None
+
+        elif sp_line[0] == 'ACT':
+            if len(sp_line) < 2:
+                self.write_line('DBG RC_ERR 3')
+            elif sp_line[1] == 'REWARD_L':
+                self.write_line('EV AAR_L')
+            elif sp_line[1] == 'REWARD_R':
+                self.write_line('EV AAR_R')
+            elif sp_line[1] == 'REWARD':
+                self.write_line('EV AAST')
+            elif sp_line[1] == 'HLON':
+                self.write_line('EV HLON')
+
+        else:
+            self.write_line('DBG RC_ERR 2')
+
+    ## Simulated trials
+    def choose_results(self):
+        """Return (response, outcome) for the current trial"""
+        rewside = self.params.get('RWSD', LEFT)
+        if self.rng.random() < self.spoil_rate:
+            return NOGO, SPOIL
+        if self.rng.random() < self.hit_rate:
+            return rewside, HIT
+        else:
+            return (RIGHT if rewside == LEFT else LEFT), ERROR
+
+    def run_state_machine(self, now):
+        """Advance the simulated trial, as in the loop() of the sketch"""
+        if self.current_state == WAIT_TO_START_TRIAL:
+            if self.flag_start_trial:
+                self.write_line(trial_released_token)
+                self.flag_start_trial = False
+                self.current_state = TRIAL_START
+
+        elif self.current_state == TRIAL_START:
+            time_ms = self.millis()
+            self.write_line(start_trial_token, time_ms)
+            for param_name in self.reported_params:
+                self.write_line('%s %s %d' % (trial_param_token, param_name,
+                    self.params.get(param_name, 0)), time_ms)
+            self.n_trials += 1
+            self.change_state(RESPONSE_WINDOW)
+            self.state_exit_time = now + self.trial_duration
+
+        elif self.current_state == RESPONSE_WINDOW:
+            if now >= self.state_exit_time:
+                response, outcome = self.choose_results()
+                if outcome == HIT:
+                    self.change_state(
+                        REWARD_L if response == LEFT else REWARD_R)
+                    self.write_line('EV R_L' if response == LEFT else 'EV R_R')
+                elif outcome == ERROR:
+                    self.change_state(ERROR_STATE)
+
+                # Report results
+                self.change_state(INTER_TRIAL_INTERVAL)
+                time_ms = self.millis()
+                self.write_line('%s RESP %d' % (trial_result_token, response),
+                    time_ms)
+                self.write_line('%s OUTC %d' % (trial_result_token, outcome),
+                    time_ms)
+                self.results_reported_time = time.time()
+                self.state_exit_time = now + self.inter_trial_interval
+
+        elif self.current_state == INTER_TRIAL_INTERVAL:
+            if now >= self.state_exit_time:
+                self.change_state(WAIT_TO_START_TRIAL)
+
+    def emit_random_events(self, dt):
+        """Emit TCH and DBG noise at the configured rates"""
+        if self.current_state == RESPONSE_WINDOW:
+            if self.rng.random() < self.touch_rate * dt:
+                self.write_line('TCH %d' % self.rng.choice([1, 2]))
+                self.write_line('TCH 0')
+        if self.rng.random() < self.dbg_rate * dt:
+            self.write_line('DBG noise %d' % self.rng.randint(0, 1023))
+
+    def update(self):
+        """Called repeatedly to handle input and advance the trial"""
+        now = time.time() - self.start_time
+        dt = now - self.last_update_time
+        self.last_update_time = now
+
+        # Announce the time, or the banner until the host connects
+        if now >= self.speak_at:
+            if self.host_connected:
+                self.write_line('DBG')
+            else:
+                self.write_line('DBG begin setup')
+            self.speak_at += self.dbg_interval
+
+        # Receive and deal with chat
+        for line in self.read_lines_from_host():
+            self.host_connected = True
+            self.handle_line(line)
+
+        # Trial logic
+        self.emit_random_events(dt)
+        self.run_state_machine(now)
+
+    def run(self, duration=None, interval=0.001):
+        """Call `update` every `interval` seconds.
+
+        Stops after `duration` seconds, or never if duration is None.
+        """
+        stop_at = None if duration is None else time.time() + duration
+        while stop_at is None or time.time() < stop_at:
+            self.update()
+            time.sleep(interval)
+
+    ## Reporting
+    def summary(self):
+        """Return a dict summarizing trial counts and release latency"""
+        latencies = np.asarray(self.release_latencies)
+        res = {
+            'n_trials': self.n_trials,
+            'n_bytes_written': self.n_bytes_written,
+            'process_time': time.process_time() if hasattr(
+                time, 'process_time') else time.clock(),
+            'n_releases_timed': len(latencies),
+        }
+        if len(latencies) > 0:
+            res['release_latency_mean'] = latencies.mean()
+            res['release_latency_median'] = np.median(latencies)
+            res['release_latency_p95'] = np.percentile(latencies, 95)
+            res['release_latency_max'] = latencies.max()
+        return res
+
+    def close(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+        if self.link_name is not None and os.path.islink(self.link_name):
+            os.remove(self.link_name)
+
+
+def run_till_interrupt(emulator, duration=None):
+    """Run the emulator until CTRL+C, then print a summary"""
+    try:
+        emulator.run(duration=duration)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received")
+    finally:
+        for key, val in sorted(emulator.summary().items()):
+            print("%s: %s" % (key, val))
+        emulator.close()
+        print("Closed.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Emulate an Arduino speaking TrialSpeak on a pty')
+    parser.add_argument('--link', default=None,
+        help='create a symlink to the pty with this name')
+    parser.add_argument('--protocol', default='TwoChoice',
+        choices=['TwoChoice', 'LickTrain'],
+        help='which params to report on each trial')
+    parser.add_argument('--trial-duration', type=float, default=2.0)
+    parser.add_argument('--iti', type=float, default=0.5)
+    parser.add_argument('--hit-rate', type=float, default=0.7)
+    parser.add_argument('--spoil-rate', type=float, default=0.05)
+    parser.add_argument('--touch-rate', type=float, default=2.0)
+    parser.add_argument('--dbg-rate', type=float, default=0.0)
+    parser.add_argument('--duration', type=float, default=None,
+        help='stop after this many seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    pargs = parser.parse_args()
+
+    if pargs.protocol == 'LickTrain':
+        reported_params = LICKTRAIN_REPORTED_PARAMS
+    else:
+        reported_params = TWOCHOICE_REPORTED_PARAMS
+
+    emulator = TrialSpeakEmulator(link_name=pargs.link,
+        trial_duration=pargs.trial_duration,
+        inter_trial_interval=pargs.iti,
+        hit_rate=pargs.hit_rate, spoil_rate=pargs.spoil_rate,
+        touch_rate=pargs.touch_rate, dbg_rate=pargs.dbg_rate,
+        reported_params=reported_params, seed=pargs.seed)
+    print("Emulating on %s" % (
+        emulator.port if pargs.link is None else pargs.link))
+    sys.stdout.flush()
+    run_till_interrupt(emulator, duration=pargs.duration)
@@ -0,0 +1,300 @@
+"""Store the parsed TrialSpeak events of a session in SQLite.
+
+The Chatter can insert every line from the device into a per-session
+SQLite database as it is received (see the `record_events` argument of
+Chatter). The database is in WAL mode, so the plotter, the UI, and
+external dashboards can query it while it is being written, without
+re-reading and re-parsing the logfile.
+
+Each line of the logfile that begins with a time is a row in `events`:
+    line : line number in the logfile
+    time : Arduino time (ms)
+    command : eg, TRLP
+    trial : trial number, or -1 before the first TRL_START
+    argument : the rest of the line, or NULL
+    name, value : for TRLP and TRLR, the parameter name and its value
+        (as an integer if possible, otherwise as a real or text)
+Lines that do not begin with a time are skipped, as in
+TrialSpeak.parse_lines_into_df.
+
+Usage:
+    store = EventStore(logfilename + '.sqlite')
+    trial_matrix = store.get_trial_matrix()
+    licks = store.get_events(command='LICK', start_time=10000)
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import sqlite3
+import time
+import pandas
+import numpy as np
+
+# Extension of the database, after the logfile name
+EVENT_STORE_SUFFIX = '.sqlite'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS events (
+        line INTEGER PRIMARY KEY, time INTEGER, command TEXT,
+        trial INTEGER, argument TEXT, name TEXT, value)''',
+    'CREATE INDEX IF NOT EXISTS events_trial ON events (trial, command)',
+    'CREATE INDEX IF NOT EXISTS events_command ON events (command, time)',
+    'CREATE INDEX IF NOT EXISTS events_time ON events (time)',
+    ]
+
+# Commands whose argument is a name and a value
+NAMED_VALUE_COMMANDS = ('TRLP', 'TRLR')
+
+
+def get_event_store_filename(logfilename):
+    """Returns the name of the event store for `logfilename`"""
+    return logfilename + EVENT_STORE_SUFFIX
+
+def parse_value(s):
+    """Returns `s` as an int if possible, then a float, else unchanged"""
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+class EventSink(object):
+    """Parses lines from the device and inserts them into an event store.
+
+    Inserts are batched into transactions, which are committed when
+    `commit_interval` seconds have passed since the last commit (checked
+    on each call to `write`), when `commit_lines` rows are pending, or
+    when a trial ends (TRLR), so that readers see trial results promptly.
+
+    Call `close` to commit everything and close the database.
+    """
+    def __init__(self, filename, commit_interval=0.5, commit_lines=1000,
+        start_trial_token='TRL_START', trial_result_token='TRLR'):
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.commit_lines = commit_lines
+        self.start_trial_token = start_trial_token
+        self.trial_result_token = trial_result_token
+
+        # isolation_level=None so that transactions are explicit
+        self.conn = sqlite3.connect(filename, isolation_level=None,
+            check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+        self.pending_rows = []
+        self.partial_line = ''
+        self.n_lines = 0
+        self.trial = -1
+        self.results_pending = False
+        self.last_commit_time = time.time()
+
+        # Counters
+        self.n_commits = 0
+
+    def parse_line(self, line):
+        """Returns the row for `line`, or None if it has no time"""
+        sp_line = line.split(None, 2)
+        try:
+            arduino_time = int(sp_line[0])
+        except (IndexError, ValueError):
+            return None
+        command = sp_line[1] if len(sp_line) > 1 else None
+        argument = sp_line[2].strip() if len(sp_line) > 2 else None
+
+        if command == self.start_trial_token:
+            self.trial += 1
+        elif command == self.trial_result_token:
+            self.results_pending = True
+
+        name, value = None, None
+        if command in NAMED_VALUE_COMMANDS and argument is not None:
+            sp_argument = argument.split()
+            name = sp_argument[0]
+            if len(sp_argument) > 1:
+                value = parse_value(sp_argument[1])
+
+        return (self.n_lines, arduino_time, command, self.trial, argument,
+            name, value)
+
+    def write(self, lines):
+        """Parse `lines` and commit them if required.
+
+        Partially received lines are held until their newline arrives.
+
+        Returns : True if committed
+        """
+        for line in lines:
+            if not line.endswith('\n'):
+                self.partial_line += line
+                continue
+            if self.partial_line:
+                line, self.partial_line = self.partial_line + line, ''
+
+            row = self.parse_line(line)
+            if row is not None:
+                self.pending_rows.append(row)
+            self.n_lines += 1
+
+        if len(self.pending_rows) == 0:
+            return False
+
+        if (self.results_pending or
+            len(self.pending_rows) >= self.commit_lines or
+            time.time() - self.last_commit_time >= self.commit_interval):
+            self.commit()
+            return True
+        return False
+
+    def commit(self):
+        """Insert all pending rows in one transaction"""
+        if len(self.pending_rows) > 0:
+            self.conn.execute('BEGIN')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)',
+                self.pending_rows)
+            self.conn.execute('COMMIT')
+            self.n_commits += 1
+
+        self.pending_rows = []
+        self.results_pending = False
+        self.last_commit_time = time.time()
+
+    def close(self):
+        """Commit everything, including any partial line, and close"""
+        if self.partial_line:
+            row = self.parse_line(self.partial_line)
+            if row is not None:
+                self.pending_rows.append(row)
+            self.partial_line = ''
+        self.commit()
+        self.conn.close()
+
+
+class EventStore(object):
+    """Queries an event store, which may still be being written."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+
+    def close(self):
+        self.conn.close()
+
+    def query(self, sql, params=()):
+        """Returns the result of `sql` as a DataFrame"""
+        return pandas.read_sql_query(sql, self.conn, params=params)
+
+    def get_events(self, trial=None, command=None, start_time=None,
+        stop_time=None, columns='*'):
+        """Returns the events matching all of the arguments.
+
+        trial : a trial number, or a list of them
+        command : a command, or a list of them
+        start_time, stop_time : only events with start_time <= time <
+            stop_time (ms)
+        columns : the columns to return, as SQL
+
+        Returns : DataFrame, sorted by line
+        """
+        conditions, params = [], []
+        for column, value in (('trial', trial), ('command', command)):
+            if value is None:
+                continue
+            if np.iterable(value) and not isinstance(value, str):
+                value = list(value)
+                conditions.append('%s IN (%s)' % (
+                    column, ', '.join(['?'] * len(value))))
+                params += value
+            else:
+                conditions.append('%s = ?' % column)
+                params.append(value)
+        if start_time is not None:
+            conditions.append('time >= ?')
+            params.append(start_time)
+        if stop_time is not None:
+            conditions.append('time < ?')
+            params.append(stop_time)
+
+        sql = 'SELECT %s FROM events' % columns
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY line'
+        return self.query(sql, params)
+
+    def get_n_trials(self):
+        """Returns the number of trials started"""
+        return self.conn.execute(
+            'SELECT COALESCE(MAX(trial), -1) + 1 FROM events').fetchone()[0]
+
+    def get_lines(self, trial=None):
+        """Returns the text of the stored lines, as in the logfile.
+
+        Whitespace is normalized, and lines without a time are missing.
+        """
+        events = self.get_events(trial=trial,
+            columns='time, command, argument')
+        lines = []
+        for arduino_time, command, argument in events.itertuples(
+            index=False):
+            line = str(arduino_time)
+            if command is not None:
+                line += ' ' + command
+            if argument is not None:
+                line += ' ' + argument
+            lines.append(line + '\n')
+        return lines
+
+    def get_trial_matrix(self, always_insert=('resp', 'outc')):
+        """Returns the trial matrix, as make_trials_matrix_from_logfile_lines2
+        """
+        # Parameters and results, pivoted on trial
+        named_values = self.query('SELECT trial, name, value FROM events '
+            'WHERE command IN (?, ?) AND value IS NOT NULL',
+            NAMED_VALUE_COMMANDS)
+        if len(named_values) > 0:
+            named_values['value'] = pandas.to_numeric(
+                named_values['value'], errors='coerce')
+            res = named_values.pivot_table(
+                index='trial', values='value', columns='name')
+        else:
+            res = pandas.DataFrame()
+
+        # Timings, except for the setup lines
+        timings = self.query('SELECT trial, command, time FROM events '
+            'WHERE command IN (?, ?) AND trial >= 0',
+            ('TRL_START', 'TRL_RELEASED'))
+        if len(timings) == 0:
+            return pandas.DataFrame(np.zeros((0, len(always_insert))),
+                columns=always_insert)
+        timings = timings.pivot_table(
+            index='trial', values='time', columns='command') / 1000.
+        res = pandas.concat([res, timings], axis=1, verify_integrity=True)
+
+        # Lower case and rename, as make_trials_matrix_from_logfile_lines2
+        res.columns = [col.lower() for col in res.columns]
+        res = res.rename(columns={
+            'trl_start': 'start_time',
+            'trl_released': 'release_time',
+            })
+        if 'release_time' not in res.columns:
+            res['release_time'] = np.nan
+        res['duration'] = res['release_time'] - res['start_time']
+
+        ordered_cols = ['start_time', 'release_time', 'duration']
+        for col in sorted(res.columns):
+            if col not in ordered_cols:
+                ordered_cols.append(col)
+        res = res[ordered_cols].copy()
+
+        for col in always_insert:
+            if col not in res:
+                res[col] = np.nan
+
+        res.index.name = 'trial'
+        return res
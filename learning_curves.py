@@ -0,0 +1,198 @@
+"""Performance across sessions, for learning curves.
+
+Trial matrices from many sessions are concatenated into a single table
+of trials, and performance is computed for any grouping (eg mouse, date,
+trial type) in one groupby over indicator columns, rather than per
+session or per group.
+
+The trial matrices are untranslated, as from
+TrialSpeak.make_trials_matrix_from_logfile_lines2, so outcomes, choices,
+and sides are the numeric codes in TrialSpeak.
+
+Performance is computed as in TrialMatrix.calculate_nhit_ntot: hits over
+all completed trials, including spoiled trials. The bias is the fraction
+of choices to the right minus the fraction to the left, over trials in
+which a choice was made, from -1 (all left) to 1 (all right).
+
+Usage:
+    index = session_index.SessionIndex()
+    trials = load_trials(index, mouse=['KF79', 'KF80'], min_trials=100)
+    perf = aggregate_performance(trials, by=['mouse', 'date'])
+    hit_rates = learning_curves(perf)
+    hit_rates.plot()
+"""
+from __future__ import print_function
+from __future__ import division
+import os
+import pickle
+import pandas
+import numpy as np
+from . import TrialSpeak
+from . import session_index
+
+# Columns of the trial matrix that define the trial type, if present
+TRIAL_TYPE_KEYS = ('rwsd', 'srvpos', 'stppos')
+
+# Session columns from the session index copied onto each trial
+SESSION_COLUMNS = ('mouse', 'date', 'board', 'box', 'experimenter')
+
+
+def concat_trial_matrices(trial_matrices, sessions=None):
+    """Concatenate trial matrices from many sessions into one DataFrame.
+
+    trial_matrices : dict from session name to trial matrix
+    sessions : DataFrame from SessionIndex.query, or None. If provided,
+        the columns in SESSION_COLUMNS are added to each trial, matched
+        on the session name.
+
+    Returns : DataFrame with a row for each trial and the columns
+        'session' and 'trial', plus the union of the trial matrix columns
+    """
+    names = sorted(trial_matrices.keys())
+    if len(names) == 0:
+        return pandas.DataFrame(columns=['session', 'trial'])
+
+    trials = pandas.concat([trial_matrices[name] for name in names],
+        keys=names, names=['session', 'trial'], sort=True).reset_index()
+
+    if sessions is not None:
+        session_info = sessions.set_index('name')[[column
+            for column in SESSION_COLUMNS if column in sessions.columns]]
+        trials = trials.join(session_info, on='session')
+    return trials
+
+def add_indicators(trials, unforced_only=False):
+    """Add indicator columns for the outcomes and choices of each trial.
+
+    Trials that have not been completed are not counted. Trials with
+    isrnd == NO are not counted if `unforced_only`.
+
+    Returns : trials, with the columns n_hit, n_error, n_spoil, n_tot,
+        n_left, and n_right added in place
+    """
+    outcome = trials['outc'].values if 'outc' in trials else np.nan
+    response = trials['resp'].values if 'resp' in trials else np.nan
+    counted = np.isin(outcome, (TrialSpeak.HIT, TrialSpeak.ERROR,
+        TrialSpeak.SPOIL))
+    if unforced_only and 'isrnd' in trials:
+        counted &= (trials['isrnd'].values != TrialSpeak.NO)
+
+    trials['n_hit'] = counted & (outcome == TrialSpeak.HIT)
+    trials['n_error'] = counted & (outcome == TrialSpeak.ERROR)
+    trials['n_spoil'] = counted & (outcome == TrialSpeak.SPOIL)
+    trials['n_tot'] = counted
+    trials['n_left'] = counted & (response == TrialSpeak.LEFT)
+    trials['n_right'] = counted & (response == TrialSpeak.RIGHT)
+    return trials
+
+def aggregate_performance(trials, by=('mouse', 'date'), by_trial_type=False,
+    trial_type_keys=TRIAL_TYPE_KEYS, unforced_only=False):
+    """Count trials and compute performance for each group.
+
+    trials : DataFrame from concat_trial_matrices
+    by : columns to group by
+    by_trial_type : if True, also group by those of `trial_type_keys`
+        that are present
+    unforced_only : passed to add_indicators
+
+    Returns : DataFrame indexed by the groups with columns n_hit, n_error,
+        n_spoil, n_tot, n_left, n_right, n_sessions, hit_rate, and bias
+    """
+    by = list(by)
+    if by_trial_type:
+        by += [key for key in trial_type_keys if key in trials.columns]
+
+    indicators = ['n_hit', 'n_error', 'n_spoil', 'n_tot', 'n_left',
+        'n_right']
+    trials = add_indicators(trials[by + [column for column in
+        ('session', 'outc', 'resp', 'isrnd') if column in trials.columns]
+        ].copy(), unforced_only=unforced_only)
+
+    grouped = trials.groupby(by, sort=True)
+    res = grouped[indicators].sum().astype(np.int)
+    res['n_sessions'] = grouped['session'].nunique()
+
+    # Derived measures, nan where undefined
+    n_tot = res['n_tot'].values.astype(np.float)
+    n_choices = (res['n_left'] + res['n_right']).values.astype(np.float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res['hit_rate'] = np.where(n_tot > 0, res['n_hit'] / n_tot, np.nan)
+        res['bias'] = np.where(n_choices > 0,
+            (res['n_right'] - res['n_left']) / n_choices, np.nan)
+    return res
+
+def learning_curves(perf, values='hit_rate', index='date', columns='mouse'):
+    """Pivot aggregated performance into a table for plotting.
+
+    perf : DataFrame from aggregate_performance
+    values : column to plot
+    index : the x-axis, eg 'date'
+    columns : one line per value of this, eg 'mouse'. May be a list,
+        eg ['mouse', 'rwsd'] when grouped by trial type.
+
+    Returns : DataFrame with `index` as the index and a column for each
+        line
+    """
+    return perf.reset_index().pivot_table(index=index, columns=columns,
+        values=values)
+
+
+## Loading from the session index
+def load_trial_matrix(name, logfilename, signature, cache_dir=None):
+    """Returns the trial matrix of a session, caching it in `cache_dir`
+
+    name : the session name, used to name the cache file
+    signature : the cached trial matrix is used only if it was made from
+        a sandbox with the same signature (see session_index.get_signature)
+    """
+    cache_filename = None
+    if cache_dir is not None:
+        cache_filename = os.path.join(os.path.expanduser(cache_dir),
+            name + '.trial_matrix.pkl')
+        try:
+            with open(cache_filename, 'rb') as fi:
+                cached_signature, trial_matrix = pickle.load(fi)
+            if cached_signature == signature:
+                return trial_matrix
+        except Exception:
+            # Missing, or written by an incompatible version
+            pass
+
+    trial_matrix = session_index.read_trial_matrix(logfilename)
+
+    if cache_filename is not None:
+        try:
+            with open(cache_filename, 'wb') as fi:
+                pickle.dump((signature, trial_matrix), fi, protocol=2)
+        except (IOError, OSError):
+            print("warning: cannot write trial matrix cache %s" %
+                cache_filename)
+    return trial_matrix
+
+def load_trials(index, cache_dir=None, verbose=False, **query_kwargs):
+    """Load the trials of every matching session in the session index.
+
+    index : session_index.SessionIndex
+    cache_dir : if not None, trial matrices are cached in this directory
+    query_kwargs : passed to index.query. By default, a session that was
+        saved is only loaded once, from its '-saved' copy.
+
+    Returns : DataFrame from concat_trial_matrices
+    """
+    sessions = index.query(**query_kwargs)
+    if cache_dir is not None and not os.path.exists(
+        os.path.expanduser(cache_dir)):
+        os.makedirs(os.path.expanduser(cache_dir))
+
+    trial_matrices = {}
+    for name, logfilename, signature in zip(sessions['name'],
+        sessions['logfilename'], sessions['signature']):
+        if logfilename is None:
+            continue
+        try:
+            trial_matrices[name] = load_trial_matrix(name, logfilename,
+                signature, cache_dir=cache_dir)
+        except Exception as e:
+            if verbose:
+                print("warning: cannot load %s: %s" % (name, e))
+    return concat_trial_matrices(trial_matrices, sessions)
@@ -0,0 +1,206 @@
+"""Per-stage timing of the session main loop.
+
+A LoopTimer records, for every iteration of the main loop, how long each
+stage took (e.g., chatter update, log reading, trial matrix, scheduler,
+UI, plotting), plus the serial bytes in and out and the ACK round-trip
+time reported by the Chatter. Results are kept in a fixed-size ring
+buffer so memory does not grow over a session.
+
+Usage in a main loop:
+    loop_timer.start_iteration()
+    chatter.update()
+    loop_timer.mark('chatter')
+    ...
+    loop_timer.end_iteration(chatter)
+
+At the end of the session, call `summary` or `write_summary`.
+
+The protocol scripts only create a LoopTimer when instrumentation is
+requested, and only call it behind a flag, so there is no cost when
+it is disabled.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import time
+import json
+import numpy as np
+
+# Highest resolution clock available
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# Columns that are always present, after the stages
+COUNTER_COLUMNS = ['total', 'bytes_in', 'bytes_out', 'ack_rtt']
+
+
+class LoopTimer(object):
+    """Records per-iteration and per-stage timings into a ring buffer."""
+    def __init__(self, capacity=10000, max_stages=12):
+        """Initialize a new LoopTimer.
+
+        capacity : number of iterations to keep. Older iterations are
+            overwritten, but still count towards `n_iterations`.
+        max_stages : maximum number of distinct stage names
+        """
+        self.capacity = capacity
+        self.max_stages = max_stages
+
+        # Stage names are assigned columns as they are first marked
+        self.stage2col = {}
+        self.stage_names = []
+
+        # The ring buffer. Unmarked stages remain nan.
+        self.n_columns = max_stages + len(COUNTER_COLUMNS)
+        self.buffer = np.full((capacity, self.n_columns), np.nan)
+        self.n_iterations = 0
+
+        # Where we are in the current iteration
+        self.row = self.buffer[0]
+        self.iteration_start = None
+        self.last_mark = None
+
+        # Previous chatter byte counters, to take differences
+        self.last_bytes_in = 0
+        self.last_bytes_out = 0
+
+    def start_iteration(self):
+        """Call at the start of each iteration of the main loop"""
+        self.row = self.buffer[self.n_iterations % self.capacity]
+        self.row[:] = np.nan
+        self.iteration_start = clock()
+        self.last_mark = self.iteration_start
+
+    def mark(self, stage):
+        """Record the time since the last mark as the duration of `stage`
+
+        If the same stage is marked more than once in an iteration, the
+        durations are summed.
+        """
+        now = clock()
+        try:
+            col = self.stage2col[stage]
+        except KeyError:
+            col = self._add_stage(stage)
+
+        if np.isnan(self.row[col]):
+            self.row[col] = now - self.last_mark
+        else:
+            self.row[col] += now - self.last_mark
+        self.last_mark = now
+
+    def _add_stage(self, stage):
+        """Assign a column to a new stage name and return it"""
+        if len(self.stage_names) >= self.max_stages:
+            raise ValueError("too many stages, increase max_stages")
+        col = len(self.stage_names)
+        self.stage2col[stage] = col
+        self.stage_names.append(stage)
+        return col
+
+    def end_iteration(self, chatter=None):
+        """Call at the end of each iteration of the main loop
+
+        If `chatter` is provided, its byte counters and the ACK round-trip
+        time from its last update are also stored.
+        """
+        self.row[self.max_stages] = clock() - self.iteration_start
+
+        if chatter is not None:
+            self.row[self.max_stages + 1] = (
+                chatter.n_bytes_from_device - self.last_bytes_in)
+            self.row[self.max_stages + 2] = (
+                chatter.n_bytes_to_device - self.last_bytes_out)
+            self.last_bytes_in = chatter.n_bytes_from_device
+            self.last_bytes_out = chatter.n_bytes_to_device
+            if chatter.last_ack_rtt is not None:
+                self.row[self.max_stages + 3] = chatter.last_ack_rtt
+
+        self.n_iterations += 1
+
+    def get_recent(self):
+        """Return the stored iterations, oldest first, as a 2d array"""
+        if self.n_iterations <= self.capacity:
+            return self.buffer[:self.n_iterations]
+        start = self.n_iterations % self.capacity
+        return np.concatenate([self.buffer[start:], self.buffer[:start]])
+
+    def get_column(self, name):
+        """Return the stored values of stage or counter `name`"""
+        if name in self.stage2col:
+            col = self.stage2col[name]
+        else:
+            col = self.max_stages + COUNTER_COLUMNS.index(name)
+        return self.get_recent()[:, col]
+
+    def get_stats(self):
+        """Return dict of stats about each stage and counter
+
+        Times are in milliseconds. Each value is a dict with keys 'n',
+        'mean', 'median', 'p95', 'max'. For bytes, also 'sum'.
+        """
+        res = {}
+        for name in self.stage_names + COUNTER_COLUMNS:
+            vals = self.get_column(name)
+            vals = vals[~np.isnan(vals)]
+            if name not in ('bytes_in', 'bytes_out'):
+                vals = vals * 1000.
+
+            stats = {'n': len(vals)}
+            if len(vals) > 0:
+                stats['mean'] = float(np.mean(vals))
+                stats['median'] = float(np.median(vals))
+                stats['p95'] = float(np.percentile(vals, 95))
+                stats['max'] = float(np.max(vals))
+                if name in ('bytes_in', 'bytes_out'):
+                    stats['sum'] = float(np.sum(vals))
+            res[name] = stats
+        return res
+
+    def summary(self):
+        """Return a human-readable table of stats"""
+        stats = self.get_stats()
+        lines = ['Loop timing over %d iterations (last %d kept)' % (
+            self.n_iterations, min(self.n_iterations, self.capacity))]
+        lines.append('%-14s %6s %8s %8s %8s %8s' % (
+            'stage', 'n', 'mean', 'median', 'p95', 'max'))
+        for name in self.stage_names + COUNTER_COLUMNS:
+            s = stats[name]
+            if s['n'] == 0:
+                lines.append('%-14s %6d' % (name, 0))
+                continue
+            lines.append('%-14s %6d %8.2f %8.2f %8.2f %8.2f' % (
+                name, s['n'], s['mean'], s['median'], s['p95'], s['max']))
+        return '\n'.join(lines)
+
+    def write_summary(self, filename):
+        """Write the stats as JSON to `filename`"""
+        with open(filename, 'w') as fi:
+            json.dump({
+                'n_iterations': self.n_iterations,
+                'stats': self.get_stats(),
+                }, fi, indent=4)
+
+    def get_panel_string(self, n_recent=50):
+        """Return a one-line summary of the most recent iterations
+
+        This is used by the UI. Shows the mean duration of each stage
+        in milliseconds over the last `n_recent` iterations.
+        """
+        n_recent = min(n_recent, self.n_iterations, self.capacity)
+        if n_recent == 0:
+            return 'loop: no data'
+        recent = self.buffer[
+            np.arange(self.n_iterations - n_recent, self.n_iterations) %
+            self.capacity]
+
+        s = 'loop %0.0fms:' % (
+            1000 * np.nanmean(recent[:, self.max_stages]))
+        for stage in self.stage_names:
+            vals = recent[:, self.stage2col[stage]]
+            if np.all(np.isnan(vals)):
+                continue
+            s += ' %s=%0.1f' % (stage[:6], 1000 * np.nanmean(vals))
+        return s
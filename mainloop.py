@@ -4,6 +4,7 @@ import os.path
 import pandas
 import numpy as np
 from .TrialSpeak import YES, NO, MD
+from . import stim_registry
 
 
 def get_params_table():
@@ -318,11 +319,9 @@ def assign_rig_specific_params_passive_detect(rigname, params_table):
     return params_table
 
 def get_trial_types(name, directory='~/dev/ArduFSM/stim_sets'):
-    """Loads and returns the trial types file"""
+    """Loads and returns the trial types file
     
-    filename = os.path.join(os.path.expanduser(directory), name)
-    try:
-        trial_types = pandas.read_csv(filename)
-    except IOError:
-        raise ValueError("cannot find trial type file %s" % name)
-    return trial_types
+    The trial types come from the stim registry, so they are validated,
+    and the same DataFrame is returned on each call.
+    """
+    return stim_registry.get_trial_types(name, directory)
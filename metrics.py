@@ -0,0 +1,542 @@
+"""Live metrics of the running sessions, to see every rig at once.
+
+Each session publishes a snapshot of its metrics every few seconds to a
+file named after its box, eg
+    ~/sandbox_root/.metrics/B1.prom
+The snapshot is in the Prometheus text exposition format, so it can be
+read by anything that understands that format, or simply with cat. It
+is written to a temporary file and renamed, so it is always complete,
+and it is removed when the session ends.
+
+Every sample is labeled with the box, board, and mouse. The metrics are
+    ardufsm_trials_total{outcome}       completed trials
+    ardufsm_trials_per_hour             over the last RATE_WINDOW s
+    ardufsm_released_trials             from the TrialSetter
+    ardufsm_release_latency_seconds     from the results of a trial to
+                                        the ACK of the next release, in
+                                        device time
+    ardufsm_rewards_total{side, kind}   reward events
+    ardufsm_water_microliters_total     estimated from the rewards
+    ardufsm_serial_bytes_total{direction}
+    ardufsm_serial_bytes_per_second{direction}
+    ardufsm_connected, ardufsm_reconnects_total
+    ardufsm_link_*                      from the LinkWatchdog
+    ardufsm_last_update_timestamp_seconds
+
+The aggregator combines the snapshots of every session on this computer
+and serves them over HTTP, without any other services:
+    python -m ArduFSM.metrics --port 9470
+/metrics is the combined snapshots, in the same format, and / is a table
+of the sessions. Snapshots older than `max_age` (eg from a session that
+crashed) are left out. By default it only listens on localhost; use
+--host 0.0.0.0 to serve the rig network.
+
+Usage in a protocol script:
+    session_metrics = SessionMetrics(chatter, ts_obj=ts_obj,
+        labels={'box': 'B1', 'board': 'CR1', 'mouse': 'KF79'})
+    while True:
+        chatter.update()
+        session_metrics.update()
+    ...
+    session_metrics.close()
+"""
+from __future__ import print_function
+from __future__ import division
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import os
+import re
+import time
+import glob
+import argparse
+import collections
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from .chat import monotonic
+from .TrialSpeak import (ack_token, release_trial_token, trial_result_token,
+    reward_name2event, HIT, ERROR, SPOIL)
+
+# Where the sessions publish their snapshots
+METRICS_DIR = '~/sandbox_root/.metrics'
+METRICS_EXTENSION = '.prom'
+
+# Port the aggregator serves on by default
+DEFAULT_PORT = 9470
+
+# Seconds over which trials_per_hour is computed
+RATE_WINDOW = 600.
+
+outcome2name = {HIT: 'hit', ERROR: 'error', SPOIL: 'spoil'}
+event2reward_name = dict([(event, evname)
+    for evname, event in list(reward_name2event.items())])
+
+
+## Formatting and parsing the exposition format
+def format_labels(labels):
+    """Returns `labels` formatted as {key="value",...}, or ''"""
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (key, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())])
+
+def format_value(value):
+    """Returns `value` formatted as a sample value"""
+    if isinstance(value, int):
+        return '%d' % value
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    return repr(value)
+
+def format_metrics(families, labels=None):
+    """Returns metrics in the text exposition format.
+
+    families : list of (name, type, help, samples). Each sample is
+        (sample name, dict of labels, value). The sample name is the
+        family name, or with a suffix such as _sum.
+    labels : dict of labels added to every sample
+    """
+    if labels is None:
+        labels = {}
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample_name, sample_labels, value in samples:
+            all_labels = dict(labels)
+            all_labels.update(sample_labels)
+            lines.append('%s%s %s' % (sample_name, format_labels(all_labels),
+                format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def parse_families(text):
+    """Split text in the exposition format into metric families.
+
+    Returns : list of (name, list of comment and sample lines), in order.
+        Samples before any # TYPE line are in a family named ''.
+    """
+    families = []
+    name2lines = {}
+    current = ''
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        sp_line = line.split()
+        if len(sp_line) > 2 and sp_line[0] == '#' and sp_line[1] in (
+            'HELP', 'TYPE'):
+            current = sp_line[2]
+        if current not in name2lines:
+            name2lines[current] = []
+            families.append((current, name2lines[current]))
+        name2lines[current].append(line)
+    return families
+
+# name{labels} value
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def parse_sample(line):
+    """Returns (name, dict of labels, value) of a sample line, or None"""
+    match = SAMPLE_RE.match(line)
+    if match is None:
+        return None
+    name, label_string, value = match.groups()
+    labels = {}
+    if label_string is not None:
+        for key, label_value in LABEL_RE.findall(label_string):
+            labels[key] = label_value.replace('\\n', '\n').replace(
+                '\\"', '"').replace('\\\\', '\\')
+    try:
+        value = float(value)
+    except ValueError:
+        return None
+    return name, labels, value
+
+
+## Publishing from a session
+def get_metrics_filename(name, metrics_dir=METRICS_DIR):
+    """Returns the name of the snapshot file of session `name`"""
+    return os.path.join(os.path.expanduser(metrics_dir),
+        name + METRICS_EXTENSION)
+
+class SessionMetrics(object):
+    """Counts events in a session and publishes snapshots of its metrics."""
+    def __init__(self, chatter, ts_obj=None, watchdog=None, labels=None,
+        name=None, reward_volume=None, interval=5.,
+        metrics_dir=METRICS_DIR):
+        """Initialize a new SessionMetrics.
+
+        chatter : the Chatter of the session
+        ts_obj : the TrialSetter, or None
+        watchdog : the watchdog.LinkWatchdog, or None
+        labels : dict of labels for every sample, eg box, board, mouse
+        name : name of the snapshot file. If None, the box label, or
+            else the process id.
+        reward_volume : estimated volume of each reward (uL). If None,
+            the water delivered is not published.
+        interval : seconds between snapshots
+        """
+        self.chatter = chatter
+        self.ts_obj = ts_obj
+        self.watchdog = watchdog
+        self.labels = dict(labels) if labels is not None else {}
+        self.reward_volume = reward_volume
+        self.interval = interval
+
+        if name is None:
+            name = str(self.labels.get('box', 'session-%d' % os.getpid()))
+        self.filename = get_metrics_filename(name, metrics_dir)
+
+        # Counts of completed trials by outcome, and of rewards by name
+        self.n_trials = dict([(outcome, 0)
+            for outcome in list(outcome2name.values()) + ['other']])
+        self.n_rewards = dict([(evname, 0) for evname in reward_name2event])
+
+        # Host times at which trials were completed, for trials_per_hour
+        self.trial_times = collections.deque()
+
+        # Device time of the last results, to time the next release
+        self.results_time = None
+        self.release_latency_sum = 0.
+        self.release_latency_count = 0
+        self.last_release_latency = None
+
+        self.partial_line = ''
+        self.start_time = monotonic()
+
+        # The first snapshot is written after one interval, and its rates
+        # do not include what was sent before the session started
+        self.last_write_time = self.start_time
+        self.last_bytes_in = chatter.n_bytes_from_device
+        self.last_bytes_out = chatter.n_bytes_to_device
+        self.next_write_time = self.start_time + self.interval
+
+    def update(self):
+        """Count the events in the new lines, and publish if it is time.
+
+        Call after every chatter.update.
+        """
+        for line in self.chatter.new_device_lines:
+            self.partial_line += line
+            if not self.partial_line.endswith('\n'):
+                continue
+            line, self.partial_line = self.partial_line, ''
+            self.handle_line(line)
+
+        if monotonic() >= self.next_write_time:
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                print("warning: cannot write metrics %s: %s" % (
+                    self.filename, e))
+            self.next_write_time = monotonic() + self.interval
+
+    def handle_line(self, line):
+        """Count the trial results, releases, and rewards in `line`"""
+        sp_line = line.split()
+        if len(sp_line) < 3:
+            return
+
+        if sp_line[1] == trial_result_token and sp_line[2] == 'OUTC':
+            try:
+                outcome = outcome2name.get(int(sp_line[3]), 'other')
+            except (IndexError, ValueError):
+                outcome = 'other'
+            self.n_trials[outcome] += 1
+            self.trial_times.append(monotonic())
+            try:
+                self.results_time = int(sp_line[0])
+            except ValueError:
+                self.results_time = None
+
+        elif sp_line[1] == ack_token and sp_line[2] == release_trial_token:
+            if self.results_time is not None:
+                try:
+                    latency = (int(sp_line[0]) - self.results_time) / 1000.
+                except ValueError:
+                    latency = -1
+                # Negative if the device was reset in between
+                if latency >= 0:
+                    self.release_latency_sum += latency
+                    self.release_latency_count += 1
+                    self.last_release_latency = latency
+            self.results_time = None
+
+        elif sp_line[1] == 'EV' and sp_line[2] in event2reward_name:
+            self.n_rewards[event2reward_name[sp_line[2]]] += 1
+
+    def get_trials_per_hour(self):
+        """Returns the rate of completed trials over the last RATE_WINDOW
+
+        Early in the session, the rate is over the time since it started,
+        but at least one `interval`, so that one trial does not give a
+        huge rate.
+        """
+        now = monotonic()
+        while (len(self.trial_times) > 0 and
+            self.trial_times[0] < now - RATE_WINDOW):
+            self.trial_times.popleft()
+        window = max(min(RATE_WINDOW, now - self.start_time), self.interval)
+        return len(self.trial_times) * 3600. / window
+
+    def get_families(self):
+        """Returns the current metrics, as for format_metrics"""
+        chatter = self.chatter
+        now = monotonic()
+        elapsed = now - self.last_write_time
+
+        families = [
+            ('ardufsm_trials_total', 'counter', 'Completed trials.',
+                [('ardufsm_trials_total', {'outcome': outcome}, n)
+                for outcome, n in sorted(self.n_trials.items())]),
+            ('ardufsm_trials_per_hour', 'gauge',
+                'Completed trials per hour, over the last %d s.' % RATE_WINDOW,
+                [('ardufsm_trials_per_hour', {}, self.get_trials_per_hour())]),
+            ('ardufsm_release_latency_seconds', 'summary',
+                'Device time from the results of a trial to the ACK of the '
+                'next release.', [
+                ('ardufsm_release_latency_seconds_sum', {},
+                    self.release_latency_sum),
+                ('ardufsm_release_latency_seconds_count', {},
+                    self.release_latency_count),
+                ]),
+            ('ardufsm_rewards_total', 'counter', 'Reward events.',
+                [('ardufsm_rewards_total', dict(zip(('side', 'kind'),
+                evname.split())), n)
+                for evname, n in sorted(self.n_rewards.items())]),
+            ('ardufsm_serial_bytes_total', 'counter',
+                'Bytes received from and sent to the device.', [
+                ('ardufsm_serial_bytes_total', {'direction': 'in'},
+                    chatter.n_bytes_from_device),
+                ('ardufsm_serial_bytes_total', {'direction': 'out'},
+                    chatter.n_bytes_to_device),
+                ]),
+            ('ardufsm_serial_bytes_per_second', 'gauge',
+                'Bytes per second since the last snapshot.', [
+                ('ardufsm_serial_bytes_per_second', {'direction': 'in'},
+                    (chatter.n_bytes_from_device - self.last_bytes_in) /
+                    elapsed if elapsed > 0 else 0.),
+                ('ardufsm_serial_bytes_per_second', {'direction': 'out'},
+                    (chatter.n_bytes_to_device - self.last_bytes_out) /
+                    elapsed if elapsed > 0 else 0.),
+                ]),
+            ('ardufsm_connected', 'gauge',
+                '1 if the serial port is open, else 0.',
+                [('ardufsm_connected', {},
+                int(getattr(chatter, 'connected', True)))]),
+            ('ardufsm_reconnects_total', 'counter',
+                'Times the serial port was reopened.',
+                [('ardufsm_reconnects_total', {},
+                getattr(chatter, 'n_reconnects', 0))]),
+            ]
+
+        if self.reward_volume is not None:
+            families.append(('ardufsm_water_microliters_total', 'counter',
+                'Water delivered, estimated from the rewards.',
+                [('ardufsm_water_microliters_total', {}, float(
+                self.reward_volume * sum(self.n_rewards.values())))]))
+
+        if self.ts_obj is not None:
+            families.append(('ardufsm_released_trials', 'gauge',
+                'Trials released by the TrialSetter.',
+                [('ardufsm_released_trials', {},
+                self.ts_obj.last_released_trial + 1)]))
+
+        if self.watchdog is not None:
+            status = self.watchdog.get_status()
+            families += [
+                ('ardufsm_link_line_age_seconds', 'gauge',
+                    'Seconds since the last line from the device.',
+                    [('ardufsm_link_line_age_seconds', {},
+                    status['line_age'])]),
+                ('ardufsm_link_stalled', 'gauge',
+                    '1 if the device has stopped sending lines, else 0.',
+                    [('ardufsm_link_stalled', {},
+                    int(status['line_stalled']))]),
+                ('ardufsm_link_queue_depth', 'gauge',
+                    'Writes waiting to be sent to the device.',
+                    [('ardufsm_link_queue_depth', {},
+                    status['queue_depth'])]),
+                ('ardufsm_link_events_total', 'counter',
+                    'Retransmits, ACK timeouts, line stalls, and resets.',
+                    [('ardufsm_link_events_total', {'event': event},
+                    status['n_' + event]) for event in ('retransmits',
+                    'ack_timeouts', 'line_stalls', 'resets')]),
+                ]
+
+        families.append(('ardufsm_last_update_timestamp_seconds', 'gauge',
+            'Wall time of this snapshot.',
+            [('ardufsm_last_update_timestamp_seconds', {}, time.time())]))
+        return families
+
+    def write(self):
+        """Publish a snapshot of the metrics"""
+        text = format_metrics(self.get_families(), self.labels)
+
+        metrics_dir = os.path.dirname(self.filename)
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        temp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(temp_filename, 'w') as fi:
+            fi.write(text)
+        os.rename(temp_filename, self.filename)
+
+        self.last_write_time = monotonic()
+        self.last_bytes_in = self.chatter.n_bytes_from_device
+        self.last_bytes_out = self.chatter.n_bytes_to_device
+
+    def close(self):
+        """Remove the snapshot, because the session has ended"""
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+## Aggregating the sessions
+def read_snapshots(metrics_dir=METRICS_DIR, max_age=60.):
+    """Returns list of (name, text) of the snapshots newer than `max_age`"""
+    res = []
+    for filename in sorted(glob.glob(os.path.join(
+        os.path.expanduser(metrics_dir), '*' + METRICS_EXTENSION))):
+        try:
+            if time.time() - os.path.getmtime(filename) > max_age:
+                continue
+            with open(filename) as fi:
+                text = fi.read()
+        except (IOError, OSError):
+            # Removed as the session ended
+            continue
+        res.append((os.path.basename(filename)[:-len(METRICS_EXTENSION)],
+            text))
+    return res
+
+def combine_snapshots(texts):
+    """Combine snapshots into one, with each metric family once"""
+    families = []
+    name2lines = {}
+    for text in texts:
+        for name, lines in parse_families(text):
+            if name not in name2lines:
+                name2lines[name] = []
+                families.append(name)
+            else:
+                # Only the first HELP and TYPE
+                lines = [line for line in lines if not line.startswith('#')]
+            name2lines[name] += lines
+    return '\n'.join(['\n'.join(name2lines[name])
+        for name in families]) + '\n'
+
+def format_session_table(snapshots):
+    """Returns a table of the sessions in `snapshots` as a string"""
+    columns = ['session', 'box', 'mouse', 'trials', 'hit%', 'trials/h',
+        'latency', 'bytes/s', 'water', 'link', 'age']
+    rows = []
+    for name, text in snapshots:
+        # Sum the samples of each metric, and keep the labels
+        values = collections.defaultdict(float)
+        labels = {}
+        for line in text.splitlines():
+            parsed = None if line.startswith('#') else parse_sample(line)
+            if parsed is None:
+                continue
+            sample_name, sample_labels, value = parsed
+            labels = sample_labels
+            values[sample_name] += value
+            if sample_name == 'ardufsm_trials_total':
+                values['trials_' + sample_labels.get('outcome', '')] += value
+
+        n_trials = values['ardufsm_trials_total']
+        n_latencies = values['ardufsm_release_latency_seconds_count']
+        if values['ardufsm_connected'] == 0:
+            link = 'down'
+        elif values['ardufsm_link_stalled'] > 0:
+            link = 'stalled'
+        else:
+            link = 'ok'
+        rows.append([
+            name,
+            labels.get('box', ''),
+            labels.get('mouse', ''),
+            '%d' % n_trials,
+            '%0.0f' % (100 * values['trials_hit'] / n_trials)
+                if n_trials > 0 else '',
+            '%0.0f' % values['ardufsm_trials_per_hour'],
+            '%0.0fms' % (1000 * values['ardufsm_release_latency_seconds_sum']
+                / n_latencies) if n_latencies > 0 else '',
+            '%0.0f' % values['ardufsm_serial_bytes_per_second'],
+            '%0.0fuL' % values['ardufsm_water_microliters_total']
+                if 'ardufsm_water_microliters_total' in values else '',
+            link,
+            '%0.0fs' % (time.time() -
+                values['ardufsm_last_update_timestamp_seconds']),
+            ])
+
+    widths = [max([len(str(row[ncol])) for row in rows] + [len(column)])
+        for ncol, column in enumerate(columns)]
+    lines = ['  '.join([column.ljust(width)
+        for column, width in zip(columns, widths)]).rstrip()]
+    lines.append('  '.join(['-' * width for width in widths]))
+    for row in rows:
+        lines.append('  '.join([str(value).ljust(width)
+            for value, width in zip(row, widths)]).rstrip())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics and the table at /, from the server's metrics_dir"""
+    def do_GET(self):
+        snapshots = read_snapshots(self.server.metrics_dir,
+            self.server.max_age)
+        if self.path.split('?')[0] == '/metrics':
+            body = combine_snapshots([text for name, text in snapshots])
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path.split('?')[0] == '/':
+            body = format_session_table(snapshots)
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, so do not print every request
+        pass
+
+def serve(host='127.0.0.1', port=DEFAULT_PORT, metrics_dir=METRICS_DIR,
+    max_age=60.):
+    """Serve the combined snapshots until CTRL+C"""
+    server = HTTPServer((host, port), MetricsHandler)
+    server.metrics_dir = metrics_dir
+    server.max_age = max_age
+    print("Serving metrics from %s on http://%s:%d/" % (
+        metrics_dir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Keyboard interrupt received")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve the metrics of every running session')
+    parser.add_argument('--host', default='127.0.0.1',
+        help='address to listen on, eg 0.0.0.0 for the rig network')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--dir', default=METRICS_DIR,
+        help='where the sessions publish their snapshots')
+    parser.add_argument('--max-age', type=float, default=60.,
+        help='leave out snapshots older than this many seconds')
+    pargs = parser.parse_args()
+
+    serve(host=pargs.host, port=pargs.port, metrics_dir=pargs.dir,
+        max_age=pargs.max_age)
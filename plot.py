@@ -36,10 +36,11 @@ import scipy.stats
 #from trials_info_tools import count_hits_by_type_from_trials_info, calculate_nhit_ntot
 from .TrialMatrix import count_hits_by_type_from_trials_info, calculate_nhit_ntot
 
-class TrialTypesError(object):
+class TrialTypesError(Exception):
     pass
 
 from . import TrialSpeak, TrialMatrix
+from . import stim_registry
 from .TrialSpeak import YES, NO
 
 o2c = {'hit': 'lightgreen', 'error': 'r', 'spoil': 'k', 'curr': 'white'}
@@ -59,14 +60,8 @@ def count_rewards(splines):
         splines containing the number of each event on each trial.
     """
     # Get the rewards by each trial in splines
-    evname2token = {
-        'left auto' : 'EV R_L',
-        'right auto' : 'EV R_R',
-        'left manual' : 'EV AAR_L',
-        'right manual' : 'EV AAR_R',
-        'left direct' : 'EV DDR_L',
-        'right direct' : 'EV DDR_R',
-        }
+    evname2token = dict([(evname, 'EV ' + event) for evname, event in
+        list(TrialSpeak.reward_name2event.items())])
     evname2list = dict([(evname, []) for evname in evname2token])
 
     # Iterate over trials
@@ -101,6 +96,12 @@ class Plotter(object):
         self.cached_anova_len2 = 0       
         self.cached_anova_text3 = ''
         self.cached_anova_len3 = 0
+        
+        # Trial type caching, see match_trial_types
+        self.trial_type_lookups = {}
+        self.trial_type_lookups_source = None
+        self.cached_trial_types = pandas.Series([], dtype=np.object)
+        self.cached_trial_types_keys = None
     
     def init_handles(self):
         """Create graphics handles"""
@@ -146,6 +147,148 @@ class Plotter(object):
         Does nothing by default but child classes will redefine."""
         pass
     
+    def match_trial_types(self, trials_info, pick_kwargs):
+        """Returns a copy of trials_info with a column called trial_type.
+        
+        Used by child classes that match trials to the rows of
+        self.trial_types. 
+        
+        pick_kwargs : dict. The key is the name in self.trial_types, and 
+            the value is the name in trials_info.
+        
+        Trials are matched with a TrialMatrix.TrialTypeLookup, which is built
+        once per set of keys. Trials with missing data are matched on the 
+        remaining keys with my.pick, as are all trials if the keys cannot 
+        be compared. Finalized trials (all but the last) that matched 
+        cleanly are cached and not matched again on the next update.
+        
+        Warnings are issued if keywords are missing, data is missing, or
+        multiple matches are found (in which case the first is used).
+        If no match is found, TrialTypesError is raised.
+        """
+        trials_info = trials_info.copy()
+        pick_kwargs = dict(pick_kwargs)
+        
+        # Test for missing kwargs
+        warn_missing_kwarg = []
+        for key, val in list(pick_kwargs.items()):
+            if val not in trials_info.columns:
+                pick_kwargs.pop(key)
+                warn_missing_kwarg.append(key)
+        if len(warn_missing_kwarg) > 0:
+            print("warning: missing kwargs to match trial type:" + \
+                ' '.join(warn_missing_kwarg))
+        keys = sorted(pick_kwargs.keys())
+        
+        # Rebuild the lookups if the trial types changed
+        # If they came from the stim registry, share its lookups
+        if self.trial_type_lookups_source is not self.trial_types:
+            stim_set = stim_registry.find_stim_set(self.trial_types)
+            if stim_set is not None:
+                self.trial_type_lookups = stim_set.lookups
+            else:
+                self.trial_type_lookups = {}
+            self.trial_type_lookups_source = self.trial_types
+            self.cached_trial_types_keys = None
+        
+        # Reset the cache if the keys changed or the trials don't match
+        n_cached = len(self.cached_trial_types)
+        if (self.cached_trial_types_keys != keys or
+            n_cached > len(trials_info) - 1 or
+            not trials_info.index[:n_cached].equals(
+            self.cached_trial_types.index)):
+            self.cached_trial_types = pandas.Series([], dtype=np.object)
+            self.cached_trial_types_keys = keys
+            n_cached = 0
+        new_trials_info = trials_info.iloc[n_cached:]
+        
+        # Keys of the new trials
+        key_df = pandas.DataFrame(dict([
+            (key, new_trials_info[pick_kwargs[key]].values) for key in keys]),
+            index=new_trials_info.index, columns=keys)
+        complete_msk = ~key_df.isnull().any(axis=1).values
+        
+        # Hash join the trials that have all of the keys
+        labels = np.empty(len(key_df), dtype=np.object)
+        multiple_msk = np.zeros(len(key_df), dtype=np.bool)
+        joined_msk = np.zeros(len(key_df), dtype=np.bool)
+        if len(keys) > 0 and complete_msk.any():
+            if tuple(keys) not in self.trial_type_lookups:
+                self.trial_type_lookups[tuple(keys)] = (
+                    TrialMatrix.TrialTypeLookup(self.trial_types, keys))
+            try:
+                labels[complete_msk], multiple_msk[complete_msk] = (
+                    self.trial_type_lookups[tuple(keys)].lookup(
+                    key_df[complete_msk]))
+                joined_msk = complete_msk
+            except (ValueError, TypeError):
+                # typically, comparing string with int
+                # Fall back to my.pick below
+                pass
+        
+        # Pick the rest one at a time
+        warn_missing_data = []
+        warn_type_error = []
+        for nrow in np.where(~joined_msk)[0]:
+            idx = key_df.index[nrow]
+            
+            # Pick the matching row in trial_types
+            trial_pick_kwargs = dict([
+                (k, key_df[k].iat[nrow]) for k in keys
+                if not pandas.isnull(key_df[k].iat[nrow])])
+            
+            # Try to pick
+            try:
+                pick_idxs = my.pick(self.trial_types, **trial_pick_kwargs)
+            except TypeError:
+                # typically, comparing string with int
+                warn_type_error.append(idx)
+                pick_idxs = [0]
+            
+            # error check missing data
+            if len(trial_pick_kwargs) < len(pick_kwargs):
+                warn_missing_data.append(idx)
+            
+            if len(pick_idxs) > 0:
+                labels[nrow] = pick_idxs[0]
+                multiple_msk[nrow] = len(pick_idxs) > 1
+        
+        # error-check matches
+        no_match_msk = np.array([label is None for label in labels], 
+            dtype=np.bool)
+        warn_no_matches = list(key_df.index[no_match_msk])
+        warn_multiple_matches = list(key_df.index[multiple_msk])
+        if len(warn_no_matches) > 0:
+            print("error: no matches found in some trials " + \
+                ' '.join(map(str, warn_no_matches)))
+            raise TrialTypesError("no matching trial type")
+
+        # issue warnings
+        if len(warn_type_error) > 0:
+            print("error: type error in pick on trials " + \
+                ' '.join(map(str, warn_type_error)))
+        if len(warn_missing_data) > 0:
+            print("error: missing data on trials " + \
+                ' '.join(map(str, warn_missing_data)))
+        if len(warn_multiple_matches) > 0:
+            print("error: multiple matches found on some trials")
+        
+        # Cache the leading run of finalized trials that matched cleanly
+        new_trial_types = pandas.Series(labels, index=key_df.index, 
+            dtype=np.object)
+        clean_msk = joined_msk & ~multiple_msk
+        clean_msk[len(trials_info) - 1 - n_cached:] = False
+        n_clean = len(clean_msk) if clean_msk.all() else np.argmin(clean_msk)
+        if n_clean > 0:
+            self.cached_trial_types = pandas.concat([
+                self.cached_trial_types, new_trial_types.iloc[:n_clean]])
+
+        # Put into trials_info and return
+        trials_info['trial_type'] = pandas.concat([
+            self.cached_trial_types.iloc[:n_cached], 
+            new_trial_types]).values
+        return trials_info
+    
     def update(self, filename):   
         """Read info from filename and update the plot"""
         ## Load data and make trials_info
@@ -608,87 +751,15 @@ class PlotterWithServoThrow(Plotter):
         corresponding rows of self.trial_types. The index of the matching row
         is the trial type for that trial.
         
-        Warnings are issued if keywords are missing, multiple matches are 
-        found (in which case the first is used), or no match is found
-        (in which case the first trial type is used, although this should
-        probably be changed to None).
+        See Plotter.match_trial_types for how matching and warnings work.
         """
-        trials_info = trials_info.copy()
-        
         # Set up the pick kwargs for how we're going to pick the matching type
         # The key is the name in self.trial_types, and the value is the name
         # in trials_info
         pick_kwargs = {'stppos': 'stepper_pos', 'srvpos': 'servo_pos', 
             'rewside': 'rewside'}
         
-        # Test for missing kwargs
-        warn_missing_kwarg = []
-        for key, val in list(pick_kwargs.items()):
-            if val not in trials_info.columns:
-                pick_kwargs.pop(key)
-                warn_missing_kwarg.append(key)
-        if len(warn_missing_kwarg) > 0:
-            print("warning: missing kwargs to match trial type:" + \
-                ' '.join(warn_missing_kwarg))
-        
-        # Iterate over trials
-        # Could probably be done more efficiently with a groupby
-        trial_types_l = []
-        warn_no_matches = []
-        warn_multiple_matches = []
-        warn_missing_data = []
-        warn_type_error = []
-        for idx, ti_row in trials_info.iterrows():
-            # Pick the matching row in trial_types
-            trial_pick_kwargs = dict([
-                (k, ti_row[v]) for k, v in list(pick_kwargs.items()) 
-                if not pandas.isnull(ti_row[v])])
-            
-            # Try to pick
-            try:
-                pick_idxs = my.pick(self.trial_types, **trial_pick_kwargs)
-            except TypeError:
-                # typically, comparing string with int
-                warn_type_error.append(idx)
-                pick_idxs = [0]
-            
-            # error check missing data
-            if len(trial_pick_kwargs) < len(pick_kwargs):
-                warn_missing_data.append(idx)            
-            
-            # error-check and reduce to single index
-            if len(pick_idxs) == 0:
-                # no match, use the first trial type
-                raise TrialTypesError
-                warn_no_matches.append(idx)
-                pick_idx = 0
-            elif len(pick_idxs) > 1:
-                # multiple match
-                warn_multiple_matches.append(idx)
-                pick_idx = pick_idxs[0]
-            else:
-                # no error
-                pick_idx = pick_idxs[0]
-            
-            # Store result
-            trial_types_l.append(pick_idx)
-
-        # issue warnings
-        if len(warn_type_error) > 0:
-            print("error: type error in pick on trials " + \
-                ' '.join(map(str, warn_type_error)))
-        if len(warn_missing_data) > 0:
-            print("error: missing data on trials " + \
-                ' '.join(map(str, warn_missing_data)))
-        if len(warn_no_matches) > 0:
-            print("error: no matches found in some trials " + \
-                ' '.join(map(str, warn_no_matches)))
-        elif len(warn_multiple_matches) > 0:
-            print("error: multiple matches found on some trials")
-
-        # Put into trials_info and return
-        trials_info['trial_type'] = trial_types_l
-        return trials_info
+        return self.match_trial_types(trials_info, pick_kwargs)
 
     def get_list_of_trial_type_names(self):
         """Name of each trial type."""
@@ -709,90 +780,18 @@ class PlotterPassiveDetect(Plotter):
     def assign_trial_type_to_trials_info(self, trials_info):
         """Returns a copy of trials_info with a column called trial_type.
         
-        We match the srvpos and stppos variables in trials_info to the 
-        corresponding rows of self.trial_types. The index of the matching row
-        is the trial type for that trial.
+        We match the isgo variable in trials_info to the corresponding rows 
+        of self.trial_types. The index of the matching row is the trial type 
+        for that trial.
         
-        Warnings are issued if keywords are missing, multiple matches are 
-        found (in which case the first is used), or no match is found
-        (in which case the first trial type is used, although this should
-        probably be changed to None).
+        See Plotter.match_trial_types for how matching and warnings work.
         """
-        trials_info = trials_info.copy()
-        
         # Set up the pick kwargs for how we're going to pick the matching type
         # The key is the name in self.trial_types, and the value is the name
         # in trials_info
         pick_kwargs = {'isgo': 'isgo'}
         
-        # Test for missing kwargs
-        warn_missing_kwarg = []
-        for key, val in list(pick_kwargs.items()):
-            if val not in trials_info.columns:
-                pick_kwargs.pop(key)
-                warn_missing_kwarg.append(key)
-        if len(warn_missing_kwarg) > 0:
-            print("warning: missing kwargs to match trial type:" + \
-                ' '.join(warn_missing_kwarg))
-        
-        # Iterate over trials
-        # Could probably be done more efficiently with a groupby
-        trial_types_l = []
-        warn_no_matches = []
-        warn_multiple_matches = []
-        warn_missing_data = []
-        warn_type_error = []
-        for idx, ti_row in trials_info.iterrows():
-            # Pick the matching row in trial_types
-            trial_pick_kwargs = dict([
-                (k, ti_row[v]) for k, v in list(pick_kwargs.items()) 
-                if not pandas.isnull(ti_row[v])])
-            
-            # Try to pick
-            try:
-                pick_idxs = my.pick(self.trial_types, **trial_pick_kwargs)
-            except TypeError:
-                # typically, comparing string with int
-                warn_type_error.append(idx)
-                pick_idxs = [0]
-            
-            # error check missing data
-            if len(trial_pick_kwargs) < len(pick_kwargs):
-                warn_missing_data.append(idx)            
-            
-            # error-check and reduce to single index
-            if len(pick_idxs) == 0:
-                # no match, use the first trial type
-                old_div(1,0)
-                warn_no_matches.append(idx)
-                pick_idx = 0
-            elif len(pick_idxs) > 1:
-                # multiple match
-                warn_multiple_matches.append(idx)
-                pick_idx = pick_idxs[0]
-            else:
-                # no error
-                pick_idx = pick_idxs[0]
-            
-            # Store result
-            trial_types_l.append(pick_idx)
-
-        # issue warnings
-        if len(warn_type_error) > 0:
-            print("error: type error in pick on trials " + \
-                ' '.join(map(str, warn_type_error)))
-        if len(warn_missing_data) > 0:
-            print("error: missing data on trials " + \
-                ' '.join(map(str, warn_missing_data)))
-        if len(warn_no_matches) > 0:
-            print("error: no matches found in some trials " + \
-                ' '.join(map(str, warn_no_matches)))
-        elif len(warn_multiple_matches) > 0:
-            print("error: multiple matches found on some trials")
-
-        # Put into trials_info and return
-        trials_info['trial_type'] = trial_types_l
-        return trials_info
+        return self.match_trial_types(trials_info, pick_kwargs)
 
     def get_list_of_trial_type_names(self):
         """Name of each trial type."""
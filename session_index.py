@@ -0,0 +1,443 @@
+"""Index of the sessions in the Runner sandbox archive.
+
+Each session run by the Runner is in its own sandbox directory:
+    sandbox_root/experimenter/year/month/<date>-<mouse>-<board>-<box>
+with '-saved' appended to the copy made when the session is saved. The
+Python parameters are in Script/parameters.json, and the logfile and the
+results entered at the end of the session are in Script/logfiles.
+
+SessionIndex scans the archive into an SQLite database, with one row per
+sandbox: the session parameters from the directory name, selected Python
+parameters and results, and summary statistics from the trial matrix.
+Updates are incremental: a sandbox is only read again if its logfile,
+parameters, or results have changed.
+
+Usage:
+    index = SessionIndex()
+    index.update('~/sandbox_root')
+    sessions = index.query(mouse='KF79', start_date='2018-03-01',
+        stop_date='2018-04-01', min_trials=200, script='TwoChoice.py')
+    trial_matrices = index.get_trial_matrices(sessions)
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import os
+import re
+import json
+import datetime
+import sqlite3
+import pandas
+import numpy as np
+from . import TrialSpeak
+from . import chunked_log
+from . import event_store
+
+DEFAULT_SANDBOX_ROOT = '~/sandbox_root'
+DEFAULT_INDEX_FILENAME = '~/sandbox_root/.session_index.sqlite'
+
+# Increment whenever the columns or the summaries change, to reindex
+INDEX_VERSION = 2
+
+# Sandbox names, as made by Runner.Sandbox.create_sandbox, after removing
+# SAVED_SUFFIX. The mouse may contain '-', but the board and box may not.
+SANDBOX_NAME_RE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})-(.+)-([^-]+)-([^-]+)$')
+SAVED_SUFFIX = '-saved'
+
+# Logfile names, as made by chat.Chatter
+LOGFILE_NAME_RE = re.compile(r'^ardulines\.\d+$')
+
+# Python parameters copied into the index
+INDEXED_PARAMETERS = ('stimulus_set', 'scheduler', 'serial_port')
+
+COLUMNS = [
+    ('path', 'TEXT PRIMARY KEY'),
+    ('name', 'TEXT'),
+    ('experimenter', 'TEXT'),
+    ('datetime', 'TEXT'),
+    ('date', 'TEXT'),
+    ('mouse', 'TEXT'),
+    ('board', 'TEXT'),
+    ('box', 'TEXT'),
+    ('saved', 'INTEGER'),
+    ('script', 'TEXT'),
+    ('stimulus_set', 'TEXT'),
+    ('scheduler', 'TEXT'),
+    ('serial_port', 'TEXT'),
+    ('logfilename', 'TEXT'),
+    ('mouse_mass', 'REAL'),
+    ('n_trials', 'INTEGER'),
+    ('n_hits', 'INTEGER'),
+    ('n_errors', 'INTEGER'),
+    ('n_spoils', 'INTEGER'),
+    ('perf', 'REAL'),
+    ('duration', 'REAL'),
+    ('parameters', 'TEXT'),
+    ('results', 'TEXT'),
+    ('signature', 'TEXT'),
+    ('error', 'TEXT'),
+    ]
+
+
+def parse_sandbox_name(name):
+    """Parse the date, mouse, board, and box from a sandbox name.
+
+    Returns : dict, or None if `name` is not a sandbox name
+    """
+    saved = name.endswith(SAVED_SUFFIX)
+    if saved:
+        name = name[:-len(SAVED_SUFFIX)]
+    match = SANDBOX_NAME_RE.match(name)
+    if match is None:
+        return None
+    date_string, mouse, board, box = match.groups()
+    try:
+        dt = datetime.datetime.strptime(date_string, '%Y-%m-%d-%H-%M-%S')
+    except ValueError:
+        return None
+    return {
+        'datetime': dt.isoformat(),
+        'date': dt.date().isoformat(),
+        'mouse': mouse,
+        'board': board,
+        'box': box,
+        'saved': saved,
+        }
+
+def find_sandboxes(sandbox_root=DEFAULT_SANDBOX_ROOT):
+    """Yields the path to every sandbox in the archive"""
+    sandbox_root = os.path.expanduser(sandbox_root)
+    for experimenter in sorted(os.listdir(sandbox_root)):
+        experimenter_path = os.path.join(sandbox_root, experimenter)
+        if not os.path.isdir(experimenter_path):
+            continue
+        for year in sorted(os.listdir(experimenter_path)):
+            year_path = os.path.join(experimenter_path, year)
+            if not year.isdigit() or not os.path.isdir(year_path):
+                continue
+            for month in sorted(os.listdir(year_path)):
+                month_path = os.path.join(year_path, month)
+                if not month.isdigit() or not os.path.isdir(month_path):
+                    continue
+                for name in sorted(os.listdir(month_path)):
+                    path = os.path.join(month_path, name)
+                    if (parse_sandbox_name(name) is not None and
+                        os.path.isdir(path)):
+                        yield path
+
+def get_sandbox_filenames(path):
+    """Returns the parameters, results, and logfile of a sandbox.
+
+    Each is None if it does not exist. If only the compressed version of
+    the logfile exists, returns its name.
+    """
+    script_path = os.path.join(path, 'Script')
+    logfile_path = os.path.join(script_path, 'logfiles')
+
+    parameters = os.path.join(script_path, 'parameters.json')
+    if not os.path.exists(parameters):
+        parameters = None
+
+    results = os.path.join(logfile_path, 'results')
+    if not os.path.exists(results):
+        results = None
+
+    logfilename = None
+    if os.path.isdir(logfile_path):
+        for name in sorted(os.listdir(logfile_path)):
+            if LOGFILE_NAME_RE.match(name) or (
+                chunked_log.is_chunked_log(name) and
+                LOGFILE_NAME_RE.match(name[:-len(
+                chunked_log.CHUNKED_LOG_SUFFIX)])):
+                logfilename = os.path.join(logfile_path, name)
+                break
+    return parameters, results, logfilename
+
+def get_signature(filenames):
+    """Returns a string that changes when any of `filenames` changes"""
+    sig_l = [str(INDEX_VERSION)]
+    for filename in filenames:
+        if filename is None:
+            sig_l.append('none')
+        else:
+            stat = os.stat(filename)
+            sig_l.append('%s:%d:%d' % (
+                os.path.split(filename)[1], stat.st_size, stat.st_mtime))
+    return ' '.join(sig_l)
+
+def clean_logfile_lines(lines):
+    """Returns the lines of a logfile without the malformed ones.
+
+    make_trials_matrix_from_logfile_lines2 fails on lines without a time,
+    and on TRLP or TRLR lines without exactly a name and an integer value,
+    eg lines garbled by a noisy serial connection.
+    """
+    res = []
+    for line in lines:
+        sp_line = line.split()
+        try:
+            int(sp_line[0])
+            if sp_line[1] in (TrialSpeak.trial_param_token,
+                TrialSpeak.trial_result_token):
+                if len(sp_line) != 4:
+                    continue
+                int(sp_line[3])
+        except (IndexError, ValueError):
+            continue
+        if not line.endswith('\n'):
+            line = line + '\n'
+        res.append(line)
+    return res
+
+def read_trial_matrix(logfilename, warnings=None):
+    """Returns the trial matrix of a logfile, using the event store if any
+
+    If the logfile cannot be parsed, it is parsed again without its
+    malformed lines (see clean_logfile_lines), and if `warnings` is a
+    list, a message with the number of lines skipped is appended to it.
+    """
+    store_filename = event_store.get_event_store_filename(logfilename)
+    if os.path.exists(store_filename):
+        store = event_store.EventStore(store_filename)
+        try:
+            return store.get_trial_matrix()
+        finally:
+            store.close()
+    lines = TrialSpeak.read_lines_from_file(logfilename)
+    try:
+        return TrialSpeak.make_trials_matrix_from_logfile_lines2(lines)
+    except Exception:
+        cleaned_lines = clean_logfile_lines(lines)
+        if len(cleaned_lines) == len(lines):
+            raise
+    if warnings is not None:
+        warnings.append('skipped %d malformed lines' % (
+            len(lines) - len(cleaned_lines)))
+    return TrialSpeak.make_trials_matrix_from_logfile_lines2(cleaned_lines)
+
+def summarize_trial_matrix(trial_matrix):
+    """Returns summary statistics of an untranslated trial matrix"""
+    n_hits, n_errors, n_spoils = 0, 0, 0
+    if 'outc' in trial_matrix.columns:
+        outcomes = trial_matrix['outc'].values
+        n_hits = int(np.sum(outcomes == TrialSpeak.HIT))
+        n_errors = int(np.sum(outcomes == TrialSpeak.ERROR))
+        n_spoils = int(np.sum(outcomes == TrialSpeak.SPOIL))
+
+    perf = None
+    if n_hits + n_errors > 0:
+        perf = n_hits / float(n_hits + n_errors)
+
+    duration = None
+    if len(trial_matrix) > 0 and 'start_time' in trial_matrix.columns:
+        duration = float(trial_matrix['start_time'].max() -
+            trial_matrix['start_time'].min())
+
+    return {
+        'n_trials': len(trial_matrix),
+        'n_hits': n_hits,
+        'n_errors': n_errors,
+        'n_spoils': n_spoils,
+        'perf': perf,
+        'duration': duration,
+        }
+
+def read_sandbox(path):
+    """Returns the row of the index for the sandbox at `path`
+
+    Problems reading the logfile are recorded in the 'error' column
+    rather than raised, so that one bad session does not stop the scan.
+    """
+    experimenter_path = os.path.split(os.path.split(os.path.split(
+        path)[0])[0])[0]
+    name = os.path.split(path)[1]
+    row = dict([(column, None) for column, sql_type in COLUMNS])
+    row.update(parse_sandbox_name(name))
+    row['path'] = path
+    row['name'] = name
+    row['experimenter'] = os.path.split(experimenter_path)[1]
+
+    parameters_filename, results_filename, logfilename = \
+        get_sandbox_filenames(path)
+    row['signature'] = get_signature(
+        [parameters_filename, results_filename, logfilename])
+    row['logfilename'] = logfilename
+
+    # The script is the only .py file in the Script directory
+    script_path = os.path.join(path, 'Script')
+    if os.path.isdir(script_path):
+        scripts = sorted([script for script in os.listdir(script_path)
+            if script.endswith('.py')])
+        if len(scripts) > 0:
+            row['script'] = scripts[0]
+
+    error_l = []
+    if parameters_filename is not None:
+        try:
+            with open(parameters_filename) as fi:
+                parameters = json.load(fi)
+            row['parameters'] = json.dumps(parameters)
+            for key in INDEXED_PARAMETERS:
+                if key in parameters:
+                    row[key] = str(parameters[key])
+        except ValueError as e:
+            error_l.append('parameters: %s' % e)
+
+    if results_filename is not None:
+        try:
+            with open(results_filename) as fi:
+                results = json.load(fi)
+            row['results'] = json.dumps(results)
+            try:
+                row['mouse_mass'] = float(results.get('mouse_mass'))
+            except (TypeError, ValueError):
+                pass
+        except ValueError as e:
+            error_l.append('results: %s' % e)
+
+    if logfilename is not None:
+        try:
+            warnings = []
+            row.update(summarize_trial_matrix(read_trial_matrix(logfilename,
+                warnings=warnings)))
+            error_l += ['logfile: %s' % warning for warning in warnings]
+        except Exception as e:
+            error_l.append('logfile: %s' % e)
+
+    if len(error_l) > 0:
+        row['error'] = '; '.join(error_l)
+    return row
+
+
+class SessionIndex(object):
+    """An SQLite index of the sessions in the sandbox archive."""
+    def __init__(self, filename=DEFAULT_INDEX_FILENAME):
+        self.filename = os.path.expanduser(filename)
+        self.conn = sqlite3.connect(self.filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sessions (%s)' %
+            ', '.join(['%s %s' % column for column in COLUMNS]))
+        for column in ('mouse', 'date', 'board', 'box', 'n_trials'):
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_%s ON sessions (%s)' % (
+                column, column))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, sandbox_root=DEFAULT_SANDBOX_ROOT, verbose=False):
+        """Index new and changed sandboxes, and remove deleted ones.
+
+        Returns : number of sandboxes that were read
+        """
+        signatures = dict(self.conn.execute(
+            'SELECT path, signature FROM sessions').fetchall())
+
+        n_read = 0
+        found = set()
+        sql = 'INSERT OR REPLACE INTO sessions VALUES (%s)' % (
+            ', '.join(['?'] * len(COLUMNS)))
+        for path in find_sandboxes(sandbox_root):
+            found.add(path)
+
+            # Skip if unchanged
+            parameters_filename, results_filename, logfilename = \
+                get_sandbox_filenames(path)
+            signature = get_signature(
+                [parameters_filename, results_filename, logfilename])
+            if signatures.get(path) == signature:
+                continue
+
+            if verbose:
+                print("indexing %s" % path)
+            row = read_sandbox(path)
+            self.conn.execute(sql,
+                [row[column] for column, sql_type in COLUMNS])
+            n_read += 1
+
+        # Remove sandboxes that no longer exist under this root
+        sandbox_root = os.path.expanduser(sandbox_root)
+        for path in signatures:
+            if path.startswith(sandbox_root) and path not in found:
+                self.conn.execute(
+                    'DELETE FROM sessions WHERE path = ?', (path,))
+
+        self.conn.commit()
+        return n_read
+
+    def query(self, mouse=None, board=None, box=None, experimenter=None,
+        script=None, start_date=None, stop_date=None, min_trials=None,
+        saved=None, unique=True, where=None, params=()):
+        """Returns the sessions matching all of the arguments.
+
+        mouse, board, box, experimenter, script : a value, or a list of them
+        start_date, stop_date : only sessions with start_date <= date <
+            stop_date, as 'YYYY-MM-DD'
+        min_trials : only sessions with at least this many trials
+        saved : if not None, only saved or unsaved sandboxes
+        unique : if True, a sandbox and its '-saved' copy are the same
+            session, so only the saved copy is returned
+        where, params : additional SQL condition and its parameters
+
+        Returns : DataFrame, sorted by datetime
+        """
+        conditions, sql_params = [], []
+        for column, value in (('mouse', mouse), ('board', board),
+            ('box', box), ('experimenter', experimenter), ('script', script)):
+            if value is None:
+                continue
+            if np.iterable(value) and not isinstance(value, str):
+                value = list(value)
+                conditions.append('%s IN (%s)' % (
+                    column, ', '.join(['?'] * len(value))))
+                sql_params += value
+            else:
+                conditions.append('%s = ?' % column)
+                sql_params.append(value)
+        if start_date is not None:
+            conditions.append('date >= ?')
+            sql_params.append(start_date)
+        if stop_date is not None:
+            conditions.append('date < ?')
+            sql_params.append(stop_date)
+        if min_trials is not None:
+            conditions.append('n_trials >= ?')
+            sql_params.append(min_trials)
+        if saved is not None:
+            conditions.append('saved = ?')
+            sql_params.append(int(saved))
+        if where is not None:
+            conditions.append('(%s)' % where)
+            sql_params += list(params)
+
+        sql = 'SELECT * FROM sessions'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY datetime'
+        sessions = pandas.read_sql_query(sql, self.conn, params=sql_params)
+
+        if unique and len(sessions) > 0:
+            # The saved copy sorts first, and has the complete logfile
+            sessions['base_path'] = [
+                path[:-len(SAVED_SUFFIX)] if is_saved else path
+                for path, is_saved in zip(sessions['path'], sessions['saved'])]
+            sessions = sessions.sort_values(['base_path', 'saved'],
+                ascending=[True, False]).drop_duplicates('base_path')
+            sessions = sessions.drop('base_path', axis=1).sort_values(
+                ['datetime', 'path']).reset_index(drop=True)
+        return sessions
+
+    def get_trial_matrices(self, sessions):
+        """Returns a dict from session name to trial matrix.
+
+        sessions : DataFrame from `query`. Sessions without a logfile are
+            skipped.
+        """
+        res = {}
+        for name, logfilename in zip(sessions['name'],
+            sessions['logfilename']):
+            if logfilename is None:
+                continue
+            res[name] = read_trial_matrix(logfilename)
+        return res
@@ -0,0 +1,84 @@
+"""Timing of the steps in starting a session.
+
+A StartupTimer records when each step of starting a session finished
+(imports, connecting to the Arduino, the first trial, the GUI), measured
+from the start of the script, and how long each heavy module took to
+import when it is imported through the timer.
+
+Usage in a protocol script:
+    STARTUP_TIME = time.time()
+    ...
+    startup_timer = StartupTimer(start_time=STARTUP_TIME)
+    plt = startup_timer.import_module('matplotlib.pyplot')
+    ...
+    startup_timer.mark('chatter')
+
+At the end of the session, call `summary` or `write_summary`.
+
+For a full report of every module imported, run the script with
+`python -X importtime` instead.
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import time
+import json
+import importlib
+
+
+class StartupTimer(object):
+    """Records the time at which each startup step finished."""
+    def __init__(self, start_time=None):
+        """Initialize a new StartupTimer.
+
+        start_time : time.time() at the start of the script. If None,
+            now.
+        """
+        if start_time is None:
+            start_time = time.time()
+        self.start_time = start_time
+
+        # List of (step name, seconds since start_time), in order
+        self.marks = []
+
+        # List of (module name, seconds to import), in order
+        self.import_times = []
+
+    def mark(self, step):
+        """Record that `step` finished now. Only the first mark counts."""
+        if not self.is_marked(step):
+            self.marks.append((step, time.time() - self.start_time))
+
+    def is_marked(self, step):
+        """Returns True if `step` has been marked"""
+        return step in [name for name, t in self.marks]
+
+    def import_module(self, name):
+        """Import and return module `name`, recording how long it took
+
+        A module that was already imported takes almost no time.
+        """
+        t0 = time.time()
+        module = importlib.import_module(name)
+        self.import_times.append((name, time.time() - t0))
+        return module
+
+    def summary(self):
+        """Return a human-readable table of the steps and imports"""
+        lines = ['Startup timing (s since start of script)']
+        for name, t in self.marks:
+            lines.append('%-20s %8.2f' % (name, t))
+        if len(self.import_times) > 0:
+            lines.append('Imports (s)')
+            for name, duration in self.import_times:
+                lines.append('%-20s %8.2f' % (name, duration))
+        return '\n'.join(lines)
+
+    def write_summary(self, filename):
+        """Write the steps and imports as JSON to `filename`"""
+        with open(filename, 'w') as fi:
+            json.dump({
+                'start_time': self.start_time,
+                'marks': self.marks,
+                'import_times': self.import_times,
+                }, fi, indent=4)
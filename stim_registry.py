@@ -0,0 +1,244 @@
+"""Registry of the stim sets (trial types files) in stim_sets.
+
+Every file in the stim_sets directory is read and validated once, and
+compiled into a StimSet. The StimSet holds the trial_types DataFrame that
+is passed to schedulers and plotters, plus precomputed typed arrays, the
+subsets of trial types by rewside and srvpos, and the TrialTypeLookup
+used by the plotters to assign trial types.
+
+The compiled StimSets are cached in a pickle in the stim_sets directory,
+keyed on the size and modification time of each file, so a session
+normally starts without parsing any CSV.
+
+Schedulers and plotters receive the trial_types DataFrame as before, and
+can get the StimSet back with `find_stim_set`, which matches by identity.
+Copies of trial_types (as made by some schedulers) are not matched, and
+those callers fall back to computing their subsets directly.
+
+Usage:
+    trial_types = stim_registry.get_trial_types('trial_types_CCL_3srvpos_r')
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import object
+import os
+import pickle
+import pandas
+import numpy as np
+import my
+from . import TrialMatrix
+
+DEFAULT_DIRECTORY = '~/dev/ArduFSM/stim_sets'
+
+# Name of the cache file within the stim_sets directory
+CACHE_FILENAME = '.stim_registry_cache.pkl'
+
+# Increment whenever StimSet changes, to invalidate old caches
+CACHE_VERSION = 1
+
+# Allowed values of rewside, if present
+REWSIDES = ('left', 'right', 'nogo')
+
+
+def validate_trial_types(trial_types):
+    """Check that a trial types DataFrame is usable.
+
+    Raises ValueError describing the first problem found.
+    """
+    if len(trial_types) == 0:
+        raise ValueError("no trial types")
+    if 'name' not in trial_types.columns:
+        raise ValueError("missing column 'name'")
+
+    null_cols = trial_types.columns[trial_types.isnull().any()]
+    if len(null_cols) > 0:
+        raise ValueError("missing values in columns %s" %
+            ', '.join(null_cols))
+
+    if 'rewside' in trial_types.columns:
+        bad = ~trial_types['rewside'].isin(REWSIDES)
+        if bad.any():
+            raise ValueError("invalid rewside %r" %
+                trial_types['rewside'][bad].iloc[0])
+
+    for col in ('srvpos', 'stppos', 'isgo', 'iti'):
+        if (col in trial_types.columns and
+            not np.issubdtype(trial_types[col].dtype, np.number)):
+            raise ValueError("column %s is not numeric" % col)
+
+
+class StimSet(object):
+    """A validated and compiled set of trial types.
+
+    Attributes:
+        name : name of the file in stim_sets
+        trial_types : the DataFrame to give to schedulers and plotters
+        arrays : dict from column name to the values as an array
+        subsets : dict from ((column, value), ...) to the rows of
+            trial_types matching all of those values. Precomputed for
+            each rewside and each srvpos, and filled in on demand by
+            `get_subset`. These are shared and should not be modified.
+        lookups : dict from tuple of key columns to TrialTypeLookup,
+            filled in on demand by `get_lookup`
+    """
+    def __init__(self, name, trial_types):
+        self.name = name
+        self.trial_types = trial_types
+        self.arrays = dict([(col, trial_types[col].values)
+            for col in trial_types.columns])
+
+        # Precompute the subsets used by the schedulers
+        self.subsets = {}
+        for col in ('rewside', 'srvpos'):
+            if col in trial_types.columns:
+                for value in np.unique(self.arrays[col]):
+                    self.get_subset(**{col: value})
+
+        # Precompute the lookup used by PlotterWithServoThrow
+        self.lookups = {}
+        servo_throw_keys = ['rewside', 'srvpos', 'stppos']
+        if np.all([key in trial_types.columns for key in servo_throw_keys]):
+            self.get_lookup(servo_throw_keys)
+
+    def get_subset(self, **kwargs):
+        """Returns the rows of trial_types matching kwargs, as my.pick_rows"""
+        key = tuple(sorted(kwargs.items()))
+        try:
+            return self.subsets[key]
+        except KeyError:
+            subset = my.pick_rows(self.trial_types, **kwargs)
+            self.subsets[key] = subset
+            return subset
+
+    def get_lookup(self, keys):
+        """Returns a TrialMatrix.TrialTypeLookup on the columns `keys`"""
+        keys = tuple(sorted(keys))
+        try:
+            return self.lookups[keys]
+        except KeyError:
+            lookup = TrialMatrix.TrialTypeLookup(self.trial_types, keys)
+            self.lookups[keys] = lookup
+            return lookup
+
+
+class StimRegistry(object):
+    """All of the stim sets in a directory."""
+    def __init__(self, directory=DEFAULT_DIRECTORY, use_cache=True):
+        """Load every stim set in directory.
+
+        Files that fail validation are recorded in `errors`, and a
+        ValueError is raised only when they are requested.
+
+        use_cache : if True, read and write the compiled stim sets in a
+            pickle in `directory`.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.cache_filename = os.path.join(self.directory, CACHE_FILENAME)
+        self.stim_sets = {}
+        self.errors = {}
+
+        # Size and mtime of each file, to check the cache
+        self.file_stats = {}
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                filename = os.path.join(self.directory, name)
+                if name.startswith('.') or not os.path.isfile(filename):
+                    continue
+                stat = os.stat(filename)
+                self.file_stats[name] = (stat.st_size, stat.st_mtime)
+
+        if use_cache and self.load_cache():
+            return
+
+        self.compile_all()
+        if use_cache:
+            self.save_cache()
+
+    def compile_all(self):
+        """Read, validate, and compile every file"""
+        for name in self.file_stats:
+            filename = os.path.join(self.directory, name)
+            try:
+                trial_types = pandas.read_csv(filename)
+                validate_trial_types(trial_types)
+            except (IOError, ValueError, pandas.errors.ParserError) as e:
+                self.errors[name] = str(e)
+                continue
+            self.stim_sets[name] = StimSet(name, trial_types)
+
+    def load_cache(self):
+        """Load the compiled stim sets from the cache if it is current.
+
+        Returns True if it was loaded.
+        """
+        try:
+            with open(self.cache_filename, 'rb') as fi:
+                cached = pickle.load(fi)
+        except Exception:
+            # Missing, or written by an incompatible version
+            return False
+
+        if (cached.get('version') != CACHE_VERSION or
+            cached.get('file_stats') != self.file_stats):
+            return False
+
+        self.stim_sets = cached['stim_sets']
+        self.errors = cached['errors']
+        return True
+
+    def save_cache(self):
+        """Write the compiled stim sets to the cache, if possible"""
+        tmp_filename = self.cache_filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as fi:
+                pickle.dump({
+                    'version': CACHE_VERSION,
+                    'file_stats': self.file_stats,
+                    'stim_sets': self.stim_sets,
+                    'errors': self.errors,
+                    }, fi, protocol=2)
+            os.rename(tmp_filename, self.cache_filename)
+        except (IOError, OSError):
+            print("warning: cannot write stim set cache %s" %
+                self.cache_filename)
+
+    def get(self, name):
+        """Returns the StimSet called `name`"""
+        try:
+            return self.stim_sets[name]
+        except KeyError:
+            pass
+        if name in self.errors:
+            raise ValueError("invalid trial type file %s: %s" % (
+                name, self.errors[name]))
+        raise ValueError("cannot find trial type file %s" % name)
+
+
+## Module-level registries, one per directory
+registries = {}
+
+def get_registry(directory=DEFAULT_DIRECTORY):
+    """Returns the StimRegistry for directory, creating it if needed"""
+    directory = os.path.expanduser(directory)
+    try:
+        return registries[directory]
+    except KeyError:
+        registry = StimRegistry(directory)
+        registries[directory] = registry
+        return registry
+
+def get_stim_set(name, directory=DEFAULT_DIRECTORY):
+    """Returns the StimSet called `name`"""
+    return get_registry(directory).get(name)
+
+def get_trial_types(name, directory=DEFAULT_DIRECTORY):
+    """Loads and returns the trial types file"""
+    return get_stim_set(name, directory).trial_types
+
+def find_stim_set(trial_types):
+    """Returns the StimSet whose trial_types is `trial_types`, or None"""
+    for registry in list(registries.values()):
+        for stim_set in list(registry.stim_sets.values()):
+            if stim_set.trial_types is trial_types:
+                return stim_set
+    return None
@@ -50,12 +50,23 @@ def generate_trial_types():
 
 class TrialSetter(object):
     """Object to determine state of trial and call scheduler as necessary"""
-    def __init__(self, chatter, params_table, scheduler):
+    def __init__(self, chatter, params_table, scheduler, loop_timer=None):
+        """Initialize a new TrialSetter.
+        
+        loop_timer : if not None, a loop_timer.LoopTimer that is used
+            to time the 'trial_matrix' and 'scheduler' stages of update.
+        """
         self.initial_params_sent = False
         self.chatter = chatter
         self.params_table = params_table
         self.scheduler = scheduler
         self.last_released_trial = -1
+        self.loop_timer = loop_timer
+        
+        # Disconnects and reconnects of the chatter that have been dealt
+        # with by end_interrupted_trial and resync
+        self.n_disconnects_handled = 0
+        self.n_reconnects_handled = 0
     
     def send_initial_params_when_ready(self, splines):
         """Sends initial params at the right time
@@ -87,11 +98,78 @@ class TrialSetter(object):
                 # Mark as sent
                 self.initial_params_sent = True  
                     
+    def end_interrupted_trial(self, logfile_lines):
+        """End the current trial as spoiled, after the device was lost.
+        
+        The device will be reset, so the results of a trial that had begun
+        but not finished are lost. TRLR lines are written to the log by the
+        chatter. Because it is disconnected, they are written before the
+        reconnect marker and anything from the reset device, and their
+        time is the last time received before the reset.
+        """
+        trial_matrix = TrialSpeak.make_trials_matrix_from_logfile_lines2(
+            logfile_lines)
+        current_trial = len(trial_matrix) - 1
+        if (current_trial >= 0 and 
+            self.last_released_trial == current_trial and
+            is_current_trial_incomplete(
+            TrialSpeak.translate_trial_matrix(trial_matrix))):
+            self.chatter.write_host_lines([
+                '%d %s RESP %d\n' % (self.chatter.last_device_time,
+                    TrialSpeak.trial_result_token, TrialSpeak.NOGO),
+                '%d %s OUTC %d\n' % (self.chatter.last_device_time,
+                    TrialSpeak.trial_result_token, TrialSpeak.SPOIL),
+                ])
+    
+    def resync(self, logfile_lines):
+        """Restore the state of the device after it was reconnected.
+        
+        Reconnecting resets the device, so the initial params are sent
+        again, with their current values. A trial that had been released
+        but not begun is released again. (A trial that had begun was
+        already ended by end_interrupted_trial.)
+        """
+        if not self.initial_params_sent:
+            # They will be sent as usual
+            return
+        
+        # Re-send the initial params
+        iparams = self.params_table[self.params_table['send_on_init']]
+        for param_name, param_val in iparams['current-value'].items():
+            self.chatter.queued_write_to_device(
+                TrialSpeak.command_set_parameter(param_name, param_val))
+        
+        # Release again a trial whose release was lost
+        trial_matrix = TrialSpeak.make_trials_matrix_from_logfile_lines2(
+            logfile_lines)
+        current_trial = len(trial_matrix) - 1
+        if self.last_released_trial == current_trial + 1:
+            self.last_released_trial = current_trial
+    
     def update(self, splines, logfile_lines):
         """Main loop of trial setter
         
         Releases trials as necessary by parsing splines and calling scheduler
         """
+        ## End the interrupted trial if the device was lost
+        n_disconnects = getattr(self.chatter, 'n_disconnects', 0)
+        if n_disconnects > self.n_disconnects_handled:
+            if self.initial_params_sent:
+                self.end_interrupted_trial(logfile_lines)
+            self.n_disconnects_handled = n_disconnects
+        
+        # Nothing is sent or released until it is reconnected
+        if not getattr(self.chatter, 'connected', True):
+            return TrialSpeak.translate_trial_matrix(
+                TrialSpeak.make_trials_matrix_from_logfile_lines2(
+                logfile_lines))
+        
+        ## Re-sync the device if it was reconnected
+        n_reconnects = getattr(self.chatter, 'n_reconnects', 0)
+        if n_reconnects > self.n_reconnects_handled:
+            self.resync(logfile_lines)
+            self.n_reconnects_handled = n_reconnects
+        
         ## Initialization check
         # Try to send initial params
         if not self.initial_params_sent:
@@ -111,6 +189,8 @@ class TrialSetter(object):
         
         # Translate
         translated_trial_matrix = TrialSpeak.translate_trial_matrix(trial_matrix)
+        if self.loop_timer is not None:
+            self.loop_timer.mark('trial_matrix')
         
         ## Trial releasing logic
         # Don't move unless a trial was just released
@@ -151,6 +231,9 @@ class TrialSetter(object):
         else:
             raise ValueError("too many trials have been released, somehow")
         
+        if self.loop_timer is not None:
+            self.loop_timer.mark('scheduler')
+        
         # Move if requested (only after released)
         # And don't do anything at all if MANIPULATOR_PIPE is None
         if MANIPULATOR_PIPE is not None and move_manipulator_to is not None:
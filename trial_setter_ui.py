@@ -5,6 +5,7 @@ from builtins import chr
 from builtins import str
 from builtins import object
 import curses
+import time
 import numpy as np
 import os.path, shutil
 from . import TrialSpeak
@@ -172,7 +173,8 @@ class UIActionTaker(object):
 
 
 class UI(object):
-    def __init__(self, chatter, logfilename, ts_obj, timeout=1000, banner=None):
+    def __init__(self, chatter, logfilename, ts_obj, timeout=1000, banner=None,
+        loop_timer=None, watchdog=None, min_redraw_interval=0.5):
         """Create new UI object.
         
         chatter : chatter object
@@ -180,6 +182,13 @@ class UI(object):
         ts_obj : Trial Setter object
         timeout : time between updates
         banner : text that will be displayed on the top line
+        loop_timer : if not None, a loop_timer.LoopTimer whose recent
+            stage timings are displayed on the bottom line
+        watchdog : if not None, a watchdog.LinkWatchdog whose status
+            is displayed on the bottom line. If there is also a 
+            loop_timer, it is moved below, which needs 24 rows.
+        min_redraw_interval : update_data redraws the screen at most this
+            often (seconds). Keypresses are still handled every update.
         
         Actions are taken by directly modifying params and scheduler
         within ts_obj.
@@ -189,6 +198,9 @@ class UI(object):
         self.ts_obj = ts_obj
         self.timeout = timeout
         self.banner = banner
+        self.loop_timer = loop_timer
+        self.watchdog = watchdog
+        self.min_redraw_interval = min_redraw_interval
 
         # Create default positioning tables
         self.element_row = {
@@ -203,7 +215,11 @@ class UI(object):
             'addl_input_prompt': 20,
             'addl_input_response': 21,
             'logfile_lines': 10,
+            'loop_timer': 22,
+            'watchdog': 22,
             }
+        if self.loop_timer is not None and self.watchdog is not None:
+            self.element_row['loop_timer'] = 23
         self.element_col = {
             'param_list': 30,
             'scheduler_panel': 55,
@@ -215,6 +231,24 @@ class UI(object):
             'logfile_lines': 10
             }
         self.logfile_lines = []
+        
+        # The panels, in the order they are drawn. Each render function 
+        # returns a list of (row, col, string) to write.
+        self.panels = [
+            ('banner', self.render_banner),
+            ('headings', self.render_headings),
+            ('actions', self.render_actions),
+            ('params', self.render_params),
+            ('scheduler', self.render_scheduler),
+            ('logfile_lines', self.render_logfile_lines),
+            ('loop_timer', self.render_loop_timer),
+            ('watchdog', self.render_watchdog),
+            ]
+        
+        # What was last drawn in each panel, to find the ones that changed
+        # None means the screen has to be cleared and fully redrawn
+        self.drawn_items = None
+        self.last_draw_time = None
 
         # Create an action taker
         self.ui_action_taker = UIActionTaker(self, self.chatter)
@@ -267,14 +301,22 @@ class UI(object):
         curses.endwin()
         
     def update_data(self, params_table=None, scheduler=None, logfile_lines=None):
-        """Update info about params and scheduler and redraw menu"""
+        """Update info about params and scheduler and redraw menu
+        
+        Only the last few logfile_lines are kept, because only those are
+        displayed. The menu is redrawn at most every min_redraw_interval.
+        """
         if params_table is not None:
             self.ts_obj.params_table = params_table
         if scheduler is not None:
             self.ts_obj.scheduler = scheduler
         if logfile_lines is not None:
-            self.logfile_lines = logfile_lines
-        self.draw_menu()
+            self.logfile_lines = list(
+                logfile_lines[-self.panel_height['logfile_lines']:])
+        
+        if (self.last_draw_time is None or 
+            time.time() - self.last_draw_time >= self.min_redraw_interval):
+            self.draw_menu()
     
     def get_and_handle_keypress(self):
         """Take appropriate action for keypress
@@ -379,18 +421,63 @@ class UI(object):
         # Could print individual lines separately
         self.stdscr.addstr(row, col, '\n'.join(splines))
     
-    def draw_menu(self):
-        """Writes the whole menu to the screen."""
-        self.stdscr.clear()
-        self.write_banner()
-        self.write_headings()
-        self.write_actions()
-        self.write_params()
-        self.write_scheduler()
-        self.write_logfile_lines()
+    def draw_menu(self, force=False):
+        """Redraws the panels whose contents have changed.
+        
+        Each panel is rendered into a list of strings to write, which is
+        compared with what was drawn last time. Changed panels are blanked 
+        out and redrawn. Any other panel that overlaps the blanked area is 
+        also redrawn, in the original order, so that the screen matches a
+        full redraw.
+        
+        If `force`, or on the first call, the screen is cleared and every
+        panel is drawn.
+        """
+        items = dict([(name, render()) for name, render in self.panels])
+        
+        if force or self.drawn_items is None:
+            self.stdscr.clear()
+            dirty = set(items.keys())
+        else:
+            # Panels whose contents changed
+            dirty = set([name for name in items 
+                if items[name] != self.drawn_items[name]])
+            
+            # Blank out what was drawn there before
+            blanked = []
+            for name in dirty:
+                for row, col, s in self.drawn_items[name]:
+                    self.write_item(row, col, ' ' * len(s))
+                    blanked.append((row, col, col + len(s)))
+            
+            # Also redraw anything that overlapped the blanked area
+            for name in items:
+                if name in dirty:
+                    continue
+                for row, col, s in items[name]:
+                    if any([row == brow and col < bstop and col + len(s) > bstart
+                        for brow, bstart, bstop in blanked]):
+                        dirty.add(name)
+                        break
+        
+        # Draw in the original order
+        for name, render in self.panels:
+            if name in dirty:
+                for row, col, s in items[name]:
+                    self.write_item(row, col, s)
+        
+        self.drawn_items = items
+        self.last_draw_time = time.time()
+    
+    def write_item(self, row, col, s):
+        """Write string at row and col, ignoring writes off the screen"""
+        try:
+            self.stdscr.addstr(row, col, s)
+        except curses.error:
+            pass
     
-    def write_banner(self):
-        """Write a simple banner at the top"""
+    def render_banner(self):
+        """Render a simple banner at the top"""
         if self.banner is None:
             s = "Port: %s. Logfile: %s." % (
                 self.chatter.ser.port, 
@@ -399,26 +486,26 @@ class UI(object):
         else:
             s = self.banner
         
-        self.stdscr.addstr(self.element_row['banner'], 0, s)
+        return [(self.element_row['banner'], 0, s)]
     
-    def write_headings(self):
-        """Write out headings for action, params, and scheduler panels"""
-        self.stdscr.addstr(self.element_row['headings'], 0, HEADINGS)
+    def render_headings(self):
+        """Render headings for action, params, and scheduler panels"""
+        start_row = self.element_row['headings']
+        return [(start_row + nrow, 0, line) 
+            for nrow, line in enumerate(HEADINGS.split('\n')) if line != '']
     
-    def write_actions(self):
-        """Write out each action in the action panel"""
+    def render_actions(self):
+        """Render each action in the action panel"""
         col = 0
         start_row = self.element_row['action_list']
         
-        # Write out each action
-        for nrow, (key, desc, func) in enumerate(self.ui_actions):
-            s = '(%s) %s' % (key, desc)
-            self.stdscr.addstr(start_row + nrow, col, s)
+        return [(start_row + nrow, col, '(%s) %s' % (key, desc))
+            for nrow, (key, desc, func) in enumerate(self.ui_actions)]
     
-    def write_params(self):
-        """Write out the current value of everything in self.params"""
+    def render_params(self):
+        """Render the current value of everything in self.params"""
         if self.ts_obj.params_table is None:
-            return
+            return []
         
         # Where to write
         start_row = self.element_row['param_list']
@@ -428,41 +515,61 @@ class UI(object):
         uparams = self.ts_obj.params_table[
             self.ts_obj.params_table['ui-accessible']]
         
+        res = []
         for nparam, (name, value) in enumerate(uparams['current-value'].items()):
             s = '%s = %s' % (name, str(value))
-            self.stdscr.addstr(start_row + nparam, col, s)
+            res.append((start_row + nparam, col, s))
+        return res
     
-    def write_scheduler(self):
-        """Write out the scheduler panel"""
+    def render_scheduler(self):
+        """Render the scheduler panel"""
         start_row = self.element_row['scheduler_panel']
         col = self.element_col['scheduler_panel']
+        res = []
         
         if hasattr(self.ts_obj.scheduler, 'name'):
-            self.stdscr.addstr(start_row, col, self.ts_obj.scheduler.name)
+            res.append((start_row, col, self.ts_obj.scheduler.name))
         
         if hasattr(self.ts_obj.scheduler, 'params'):
             for nparam, (name, value) in enumerate(self.ts_obj.scheduler.params.items()):
                 s = '%s = %s' % (name, str(value))
-                self.stdscr.addstr(start_row + nparam + 1, col, s)
+                res.append((start_row + nparam + 1, col, s))
         
         # write out other choices for scheduler
         start_row = self.element_row['schedule_list']
         col = self.element_col['scheduler_panel']
         for nrow, (key, desc, func) in enumerate(self.ui_schedulers):
             s = '(%s) %s' % (key, desc)
-            self.stdscr.addstr(start_row + nrow, col, s)      
+            res.append((start_row + nrow, col, s))
+        return res
     
-    def write_logfile_lines(self):
-        """Write out the most recent lines in the logfile"""
+    def render_logfile_lines(self):
+        """Render the most recent lines in the logfile"""
         start_row = self.element_row['logfile_lines']
         nrows = self.panel_height['logfile_lines']
         
         # Write backwards from the end
+        res = []
         for nline, line in enumerate(self.logfile_lines[-1:-nrows:-1]):
             row = start_row + nrows - nline - 1
-            #~ self.clear_line(row)
-            self.safe_print(line.strip(), row, col=0, max_width=40)
+            res.append((row, 0, line.strip().split('\n')[0][:40]))
+        return res
     
+    def render_loop_timer(self):
+        """Render the recent stage timings, if a loop_timer is available"""
+        if self.loop_timer is None:
+            return []
+        
+        return [(self.element_row['loop_timer'], 0, 
+            self.loop_timer.get_panel_string()[:79])]
+    
+    def render_watchdog(self):
+        """Render the status of the serial link, if a watchdog is available"""
+        if self.watchdog is None:
+            return []
+        
+        return [(self.element_row['watchdog'], 0, 
+            self.watchdog.get_panel_string()[:79])]
     
 class UI_GNG(UI):
     """Derived class for go/nogo tasks.
@@ -0,0 +1,334 @@
+"""Detection of a stalled serial link.
+
+A LinkWatchdog checks the Chatter after every update for two kinds of
+stall:
+
+* The device sends nothing for `line_timeout` seconds. Once running
+  trials, a sketch announces the time with a DBG line every second (see
+  communications() in libraries/chat), so this means it is hung or the
+  link is broken. This is logged, and logged again when lines resume. If
+  the Chatter can reconnect, the port is closed and reopened after
+  `reset_timeout` seconds, which resets the device; the TrialSetter then
+  re-sends the parameters (see TrialSetter.resync).
+  
+  During setup, from "DBG begin setup" until the first TRL_START, the
+  device is silent while it waits for the parameters and the first
+  release (in setup() of TwoChoice.ino, communications() is passed a
+  time that does not advance). So stalls are not checked, and the device
+  is never reset, during setup.
+
+* The last line sent is not acknowledged within `ack_timeout` seconds.
+  Every queued write waits behind it, so it is retransmitted, up to
+  `max_retransmits` times, and then given up on so that the queue moves
+  again. Only commands that are safe to repeat (see RETRANSMIT_COMMANDS)
+  are retransmitted; eg an ACT REWARD might deliver a second reward.
+
+* A RELEASE_TRL is not acknowledged. The device ACKs every command as
+  soon as it receives it, so if it has sent other lines since, and has
+  not released the trial (TRL_RELEASED or TRL_START), the release was
+  never received. During setup, when the device is silent, this is
+  assumed once nothing at all is received for `reset_timeout` seconds
+  after the send. The release is then retransmitted once. If that is
+  not received either, the device is reset, as for a stall, and the
+  TrialSetter releases the trial again; in setup, or if the Chatter
+  cannot reconnect, the release is given up on so that the queue moves
+  again. While the device is silent outside setup, the release may have
+  been received, so it waits for the stall to be handled.
+
+Each event is written to the log as
+    "<last device time> DBG WATCHDOG <event> <detail>"
+and kept in `events`. `get_status` returns the age of the last line, the
+age of the outstanding ACK, and the queue depth, for the UI.
+
+Usage in a main loop:
+    chatter.update()
+    watchdog.update()
+"""
+from __future__ import print_function
+from __future__ import division
+from builtins import object
+import time
+import collections
+from .chat import monotonic
+from .TrialSpeak import (release_trial_token, trial_released_token,
+    start_trial_token)
+
+watchdog_token = 'WATCHDOG'
+
+# Commands that have the same effect if the device receives them twice
+RETRANSMIT_COMMANDS = ('SET',)
+
+# Times a RELEASE_TRL that was not received is retransmitted
+MAX_RELEASE_RETRANSMITS = 1
+
+# The device has just started, and is in setup, after a line containing
+# this. Setup ends when the first trial starts.
+setup_token = 'DBG begin setup'
+
+
+class LinkWatchdog(object):
+    """Detects and recovers from stalls in the link to the device."""
+    def __init__(self, chatter, line_timeout=3., ack_timeout=2.,
+        max_retransmits=2, reset_timeout=10., max_events=100):
+        """Initialize a new LinkWatchdog.
+
+        chatter : the Chatter to watch
+        line_timeout : seconds without a line from the device before it
+            is considered stalled
+        ack_timeout : seconds to wait for an ACK before retransmitting
+        max_retransmits : retransmits before giving up on an ACK
+        reset_timeout : seconds without a line before the device is reset
+            by reconnecting, or None to never reset. Also how long to wait
+            for any line after a RELEASE_TRL during setup.
+        max_events : number of recent events to keep in `events`
+        """
+        self.chatter = chatter
+        self.line_timeout = line_timeout
+        self.ack_timeout = ack_timeout
+        self.max_retransmits = max_retransmits
+        self.reset_timeout = reset_timeout
+
+        # Recent events, as (time.time(), event, detail)
+        self.events = collections.deque(maxlen=max_events)
+
+        # Event lines waiting to be written to the log
+        self.pending_log_lines = []
+
+        # The send that is waiting for an ACK, identified by its time
+        self.send_time = None
+        self.retransmitted_line = None
+        self.n_line_retransmits = 0
+        self.released_since_send = False
+        self.release_ack_missing = False
+        # chatter.last_receive_time when the send was first seen
+        self.send_receive_time = None
+
+        # The device has just been opened, which resets it
+        self.in_setup = True
+        self.line_stalled = False
+
+        # Counters
+        self.n_retransmits = 0
+        self.n_ack_timeouts = 0
+        self.n_line_stalls = 0
+        self.n_resets = 0
+
+    def log_event(self, event, detail=''):
+        """Record an event and write it to the log"""
+        self.events.append((time.time(), event, detail))
+        self.pending_log_lines.append('%d DBG %s %s %s\n' % (
+            self.chatter.get_last_device_time(), watchdog_token, event,
+            detail))
+
+    def update(self):
+        """Check for stalls. Call after every chatter.update."""
+        chatter = self.chatter
+
+        # While reconnecting, nothing is sent or received. The device will
+        # be reset.
+        if not chatter.connected:
+            self.send_time = None
+            self.line_stalled = False
+            self.in_setup = True
+            return
+
+        self.check_setup()
+        self.check_lines()
+        if chatter.connected:
+            self.check_ack()
+
+        self.write_log_lines()
+
+    def write_log_lines(self):
+        """Pass the event lines to the chatter to be written to the log
+
+        They are held while a line from the device is partially received.
+        """
+        last_device_line = self.chatter.last_device_line
+        if len(self.pending_log_lines) > 0 and (last_device_line is None or
+            last_device_line.endswith('\n')):
+            self.chatter.write_host_lines(self.pending_log_lines)
+            self.pending_log_lines = []
+
+    def check_setup(self):
+        """Keep track of whether the device is in setup"""
+        for line in self.chatter.new_device_lines:
+            if setup_token in line:
+                self.in_setup = True
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] == start_trial_token:
+                self.in_setup = False
+
+    def can_reset(self):
+        """Returns True if the device may be reset by reconnecting"""
+        return (self.reset_timeout is not None and self.chatter.reconnect
+            and not self.in_setup)
+
+    def reset(self, reason):
+        """Reset the device by reconnecting"""
+        self.n_resets += 1
+        self.log_event('RESET', reason)
+        self.write_log_lines()
+        self.chatter.handle_disconnect(IOError(reason))
+
+    def check_lines(self):
+        """Log stalls in the lines from the device, and reset if needed"""
+        line_age = self.get_line_age()
+        if self.line_stalled:
+            if line_age < self.line_timeout:
+                self.line_stalled = False
+                self.log_event('LINE_RESUMED')
+            elif self.can_reset() and line_age >= self.reset_timeout:
+                self.reset("no lines from device for %0.1fs" % line_age)
+        elif line_age >= self.line_timeout and not self.in_setup:
+            self.line_stalled = True
+            self.n_line_stalls += 1
+            self.log_event('LINE_STALL', '%0.1f' % line_age)
+
+    def check_ack(self):
+        """Retransmit or give up on a line that was not acknowledged"""
+        chatter = self.chatter
+        if chatter.last_sent_line_acknowledged:
+            self.send_time = None
+            return
+
+        if chatter.last_sent_time != self.send_time:
+            # A new send. Retransmits of the same line are counted together.
+            self.send_time = chatter.last_sent_time
+            self.released_since_send = False
+            self.release_ack_missing = False
+            self.send_receive_time = chatter.last_receive_time
+            if chatter.last_sent_line != self.retransmitted_line:
+                self.retransmitted_line = None
+                self.n_line_retransmits = 0
+            return
+
+        # These lines arrived after the send
+        for line in chatter.new_device_lines:
+            sp_line = line.split()
+            if len(sp_line) > 1 and sp_line[1] in (trial_released_token,
+                start_trial_token):
+                self.released_since_send = True
+
+        line = chatter.last_sent_line
+        command = line.split()[0] if len(line.split()) > 0 else ''
+        if command == release_trial_token and self.released_since_send:
+            # The device received it, but the ACK was lost
+            chatter.last_sent_line_acknowledged = True
+            self.send_time = None
+            return
+
+        if self.get_ack_age() < self.ack_timeout:
+            return
+
+        if command == release_trial_token:
+            self.check_release(line)
+        elif (command in RETRANSMIT_COMMANDS and
+            self.n_line_retransmits < self.max_retransmits):
+            # Sent again by the next chatter.update, ahead of the queue
+            self.n_line_retransmits += 1
+            self.n_retransmits += 1
+            self.retransmitted_line = line
+            self.log_event('RETRANSMIT', line.strip())
+            chatter.queued_writes.insert(0, line)
+            chatter.last_sent_line_acknowledged = True
+        else:
+            # Give up, so that the queue moves again
+            self.n_ack_timeouts += 1
+            self.retransmitted_line = None
+            self.n_line_retransmits = 0
+            self.log_event('ACK_TIMEOUT', line.strip())
+            chatter.last_sent_line_acknowledged = True
+            self.send_time = None
+
+    def check_release(self, line):
+        """Retransmit, reset, or give up on a RELEASE_TRL that was lost"""
+        chatter = self.chatter
+        if chatter.last_receive_time > self.send_receive_time:
+            # The device is sending lines, so it would have ACKed it
+            lost = True
+        elif self.in_setup:
+            # Finishing setup would have ended the silence
+            lost = (self.reset_timeout is not None and
+                self.get_ack_age() >= self.reset_timeout)
+        else:
+            # The device is silent; this is handled as a stall
+            lost = False
+        
+        if not lost:
+            if not self.release_ack_missing:
+                self.release_ack_missing = True
+                self.n_ack_timeouts += 1
+                self.log_event('ACK_TIMEOUT', line.strip())
+            return
+        
+        if self.n_line_retransmits < MAX_RELEASE_RETRANSMITS:
+            self.n_line_retransmits += 1
+            self.n_retransmits += 1
+            self.retransmitted_line = line
+            self.log_event('RETRANSMIT', line.strip())
+            chatter.queued_writes.insert(0, line)
+            chatter.last_sent_line_acknowledged = True
+        elif self.can_reset():
+            self.retransmitted_line = None
+            self.n_line_retransmits = 0
+            self.send_time = None
+            self.reset("release not received")
+        else:
+            self.n_ack_timeouts += 1
+            self.retransmitted_line = None
+            self.n_line_retransmits = 0
+            self.log_event('ACK_TIMEOUT', line.strip())
+            chatter.last_sent_line_acknowledged = True
+            self.send_time = None
+
+    def get_line_age(self):
+        """Returns seconds since the last line was received"""
+        return monotonic() - self.chatter.last_receive_time
+
+    def get_ack_age(self):
+        """Returns seconds since the unacknowledged line was sent, or None"""
+        if self.chatter.last_sent_line_acknowledged:
+            return None
+        return time.time() - self.chatter.last_sent_time
+
+    def get_status(self):
+        """Returns dict of the current state of the link and the counters"""
+        return {
+            'connected': self.chatter.connected,
+            'line_age': self.get_line_age(),
+            'line_stalled': self.line_stalled,
+            'ack_age': self.get_ack_age(),
+            'queue_depth': len(self.chatter.queued_writes),
+            'n_retransmits': self.n_retransmits,
+            'n_ack_timeouts': self.n_ack_timeouts,
+            'n_line_stalls': self.n_line_stalls,
+            'n_resets': self.n_resets,
+            }
+
+    def get_panel_string(self):
+        """Return a one-line summary of the link, for the UI"""
+        if not self.chatter.connected:
+            return 'link: RECONNECTING'
+        status = self.get_status()
+        s = 'link%s: line %0.0fs ack %s queue %d' % (
+            ' STALLED' if status['line_stalled'] else '',
+            status['line_age'],
+            '-' if status['ack_age'] is None else
+                '%0.1fs' % status['ack_age'],
+            status['queue_depth'])
+        s += ' retx=%d ack_to=%d stalls=%d' % (status['n_retransmits'],
+            status['n_ack_timeouts'], status['n_line_stalls'])
+        if status['n_resets'] > 0:
+            s += ' resets=%d' % status['n_resets']
+        return s
+
+    def summary(self):
+        """Return a human-readable list of the events"""
+        lines = ['Link watchdog: %d retransmits, %d ACK timeouts, '
+            '%d line stalls, %d resets' % (self.n_retransmits,
+            self.n_ack_timeouts, self.n_line_stalls, self.n_resets)]
+        for event_time, event, detail in self.events:
+            lines.append('%s %s %s' % (time.strftime('%H:%M:%S',
+                time.localtime(event_time)), event, detail))
+        return '\n'.join(lines)